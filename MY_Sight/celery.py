@@ -1,8 +1,36 @@
 import os
 from celery import Celery
+from celery.schedules import crontab
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'MY_Sight.settings')
 
 app = Celery('MY_Sight')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
+
+app.conf.beat_schedule = {
+    'drain-email-outbox': {
+        'task': 'Users.tasks.drain_email_outbox',
+        'schedule': 15.0,  # safety net, enqueue_email also wakes a worker
+    },
+    'sweep-due-reminders': {
+        'task': 'Users.tasks.sweep_due_reminders',
+        'schedule': 30.0,  # seconds
+    },
+    'compact-location-history': {
+        'task': 'Users.tasks.compact_location_history',
+        'schedule': crontab(minute=15),  # hourly
+    },
+    'build-missing-photo-variants': {
+        'task': 'Users.tasks.build_missing_photo_variants',
+        'schedule': 300.0,  # catches uploads whose process_photo task was never queued
+    },
+    'collect-media-garbage': {
+        'task': 'Users.tasks.collect_media_garbage',
+        'schedule': crontab(minute=45),  # hourly
+    },
+    'archive-notifications': {
+        'task': 'Users.tasks.archive_notifications',
+        'schedule': crontab(hour=3, minute=30),  # daily
+    },
+}
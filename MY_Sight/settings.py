@@ -32,6 +32,7 @@ INSTALLED_APPS = [
 
 # --- Middleware ---
 MIDDLEWARE = [
+    'Users.metrics.RequestMetricsMiddleware',  # first, so its latency covers every other middleware
     'corsheaders.middleware.CorsMiddleware',  # CORS must be before CommonMiddleware
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -71,6 +72,25 @@ DATABASES = {
     }
 }
 
+# --- Cache ---
+# Local memory by default; set REDIS_CACHE_URL to share the cache between processes
+if os.environ.get('REDIS_CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_CACHE_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+LOGIN_PROFILE_CACHE_TIMEOUT = 60 * 60  # seconds; entries are also invalidated on every profile change
+RELATION_CACHE_TIMEOUT = 60 * 60  # companion <-> patient links (Users/relations.py), invalidated on relinking
+
 # --- Password validation ---
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -89,6 +109,23 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 
+# --- Media (uploaded photos, see Users/photos.py) ---
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+FILE_UPLOAD_MAX_MEMORY_SIZE = 256 * 1024  # bigger uploads are spooled to a temp file and moved into place
+PHOTO_VARIANT_SIZES = {'thumb': 128, 'medium': 512}  # longest edge in pixels, rendered as WebP and JPEG
+PHOTO_VARIANT_QUALITY = 80
+
+# Uploads are stored by content hash and shared between rows (Users/storage.py, Users/blobs.py)
+STORAGES = {
+    'default': {'BACKEND': 'Users.storage.ContentAddressedStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+MEDIA_BLOB_CACHE_CONTROL = 'public, max-age=31536000, immutable'  # a blob's URL never changes content
+MEDIA_BLOB_GC_GRACE = timedelta(hours=6)  # unreferenced files are kept this long before deletion
+MEDIA_BLOB_GC_BATCH_SIZE = 500
+MEDIA_BLOB_GC_MAX_BATCHES = 20
+
 # --- Custom User Model ---
 AUTH_USER_MODEL = 'Users.User'
 
@@ -102,21 +139,99 @@ EMAIL_HOST_PASSWORD = 'xuka ntgw ftis tpgr'  # 🔐 NOT safe in production
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 PASSWORD_RESET_TIMEOUT = 7200  # 2 hours
 
+# Outbound mail is queued (Users/mail.py) and sent by a Celery worker, never inside a request
+EMAIL_OUTBOX_BATCH_SIZE = 100  # messages sent per SMTP connection
+EMAIL_OUTBOX_MAX_BATCHES = 50  # per drain run
+EMAIL_OUTBOX_MAX_ATTEMPTS = 5  # then the message moves to DeadLetterEmail
+EMAIL_OUTBOX_RETRY_BASE_SECONDS = 30  # backoff doubles after every failed attempt
+EMAIL_OUTBOX_RETRY_MAX_SECONDS = 3600
+
 # --- REST Framework + JWT ---
 REST_FRAMEWORK = {
+    # Served from token claims; views that edit the user row use RevocableJWTAuthentication
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'Users.authentication.StatelessJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
+    'DEFAULT_PAGINATION_CLASS': 'Users.pagination.KeysetPagination',
+    'PAGE_SIZE': 50,
+    'DEFAULT_FILTER_BACKENDS': (
+        'Users.filters.QueryParamFilterBackend',
+    ),
+    # Throttles key anonymous clients on get_ident(); without this it trusts a client-sent X-Forwarded-For.
+    # Set to the number of proxies in front of the app that append to the header.
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 0)),
 }
 
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
     'AUTH_HEADER_TYPES': ('Bearer',),
+    'TOKEN_REFRESH_SERIALIZER': 'Users.serializers.CustomTokenRefreshSerializer',
+}
+
+# --- Throttling (see Users/throttling.py) ---
+# scope: (burst, tokens refilled per minute), per user or client IP; SOS is never throttled
+THROTTLE_BUCKETS = {
+    'login': (10, 10),  # every attempt runs PBKDF2
+    'register': (5, 2),
+    'password_reset': (5, 2),
+    'password_reset_email': (3, 0.5),  # per target address, whatever the client
 }
+# InMemoryBucketStore counts per process; use RedisBucketStore with several workers
+THROTTLE_STORE = os.environ.get('THROTTLE_STORE', 'Users.throttling.InMemoryBucketStore')
+THROTTLE_REDIS_URL = os.environ.get('THROTTLE_REDIS_URL', 'redis://localhost:6379/2')
+
+# --- Request metrics (see Users/metrics.py), scraped from /metrics/ ---
+METRICS_ENABLED = True
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # /metrics/ answers 404 unless sent as a Bearer token
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+# Requests at least this slow are logged with their SQL; None turns the log (and SQL capture) off
+METRICS_SLOW_REQUEST_MS = int(os.environ['METRICS_SLOW_REQUEST_MS']) if os.environ.get('METRICS_SLOW_REQUEST_MS') else None
+METRICS_SLOW_SQL_LIMIT = 50  # statements kept per request
+
+# --- Location ingestion ---
+LOCATION_BULK_MAX_ITEMS = 1000  # max fixes accepted by POST /locations/bulk/
+LOCATION_RAW_RETENTION_DAYS = 7  # raw fixes older than this are compacted into per-minute rollups
+LOCATION_MINUTE_RETENTION_DAYS = 90  # per-minute rollups older than this are compacted into per-hour rollups
+LOCATION_HISTORY_RAW_MAX_SPAN = timedelta(days=1)  # longest range /locations/history/ serves at full resolution
+LOCATION_HISTORY_MINUTE_MAX_SPAN = timedelta(days=7)  # longest range served per minute, beyond that per hour
+ROUTE_SIMPLIFY_TOLERANCE_M = 10  # default Douglas-Peucker tolerance of /locations/route/
+ROUTE_DWELL_RADIUS_M = 50  # a dwell is a stay within this radius ...
+ROUTE_DWELL_MINUTES = 10  # ... for at least this long
+ROUTE_MAX_SPAN = timedelta(days=31)
+
+EXPORT_CHUNK_SIZE = 2000  # rows fetched per database round trip by the history exports
+EXPORT_FLUSH_BYTES = 64 * 1024  # encoded size handed to the response at a time
+
+PROVISION_HASH_WORKERS = int(os.environ.get('PROVISION_HASH_WORKERS', 0)) or None  # provision_accounts pool; None = one per CPU
+PROVISION_BATCH_SIZE = 1000  # rows per INSERT when provisioning accounts
+PROVISION_API_MAX_ROWS = 100  # the API hashes in-process; larger files go through `manage.py provision_accounts`
+
+# --- Geofences (see Users/geofences.py) ---
+GEOFENCE_GRID_DEGREES = 0.01  # index cell size, about 1.1 km of latitude
+GEOFENCE_GRID_MAX_CELLS = 2500  # fences covering more cells are tested against every fix
+GEOFENCE_CACHE_TIMEOUT = 60 * 60  # a patient's fence definitions, invalidated on every fence change
+
+# --- Reminder scheduler (see Users/scheduler.py) ---
+REMINDER_SWEEP_BATCH_SIZE = 500  # due rows claimed per transaction
+REMINDER_SWEEP_MAX_BATCHES = 20  # per model per sweep, keeps one beat run bounded
+
+# --- SOS alerts (see Users/alerts.py) ---
+SOS_DEDUP_WINDOW = timedelta(seconds=60)  # repeated presses within this window notify nobody again
+
+# --- Notification inbox (see Users/inbox.py) ---
+NOTIFICATION_SYNC_PAGE_SIZE = 200  # max notifications per /notifications/inbox/ poll
+NOTIFICATION_RETENTION_DAYS = 90  # older notifications move to NotificationArchive
+NOTIFICATION_ARCHIVE_BATCH_SIZE = 1000
+NOTIFICATION_ARCHIVE_MAX_BATCHES = 50
+
+# --- Realtime events (websocket push, see Users/realtime.py) ---
+# InMemoryBroker only reaches sockets in the same process; use RedisBroker with several workers
+REALTIME_BROKER = os.environ.get('REALTIME_BROKER', 'Users.realtime.InMemoryBroker')
+REALTIME_REDIS_URL = os.environ.get('REALTIME_REDIS_URL', 'redis://localhost:6379/1')
 
 # --- Swagger settings ---
 SWAGGER_SETTINGS = {
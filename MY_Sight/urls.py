@@ -1,5 +1,8 @@
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, re_path
+from Users.metrics import metrics_view
+from Users.storage import serve_media
 from Users import views
 from Users.views import (
     PasswordResetRequestView,
@@ -32,6 +35,7 @@ urlpatterns = [
     # Admin Panel
     path('admin/', admin.site.urls),
     path('sos/', views.SOSView.as_view(), name='sos'),
+    path('metrics/', metrics_view, name='metrics'),
 
     # Swagger Docs
     re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
@@ -40,6 +44,7 @@ urlpatterns = [
 
     # Authentication
     path('auth/register/', UserRegistrationView.as_view(), name='register'),
+    path('auth/provision/', views.BulkProvisionView.as_view(), name='provision'),
     path('auth/login/', CustomTokenObtainPairView.as_view(), name='custom_token_obtain_pair'),
     path('auth/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('auth/logout/', UserLogoutView.as_view(), name='logout'),
@@ -53,6 +58,7 @@ urlpatterns = [
     # Patients
     path('patients/', views.PatientListCreateView.as_view(), name='patient-list'),
     path('patients/<int:pk>/', views.PatientDetailView.as_view(), name='patient-detail'),
+    path('patients/<int:pk>/export/<str:kind>/', views.PatientExportView.as_view(), name='patient-export'),
 
     # Companions
     path('companions/', views.CompanionListCreateView.as_view(), name='companion-list'),
@@ -64,15 +70,32 @@ urlpatterns = [
 
     # Locations
     path('locations/', views.LocationListCreateView.as_view(), name='location-list'),
+    path('locations/bulk/', views.LocationBulkCreateView.as_view(), name='location-bulk'),
+    path('locations/history/', views.LocationHistoryView.as_view(), name='location-history'),
+    path('locations/route/', views.LocationRouteView.as_view(), name='location-route'),
+    path('locations/latest/', views.LastKnownPositionView.as_view(), name='location-latest'),
     path('locations/<int:pk>/', views.LocationDetailView.as_view(), name='location-detail'),
 
+    # Geofences
+    path('geofences/', views.GeofenceListCreateView.as_view(), name='geofence-list'),
+    path('geofences/<int:pk>/', views.GeofenceDetailView.as_view(), name='geofence-detail'),
+
     # Tasks
     path('tasks/', views.TaskListCreateView.as_view(), name='task-list'),
     path('tasks/<int:pk>/', views.TaskDetailView.as_view(), name='task-detail'),
 
     # Notifications
     path('notifications/', views.NotificationListCreateView.as_view(), name='notification-list'),
+    path('notifications/inbox/', views.NotificationInboxView.as_view(), name='notification-inbox'),
+    path('notifications/inbox/read/', views.NotificationReadView.as_view(), name='notification-inbox-read'),
+    path('notifications/unread-count/', views.NotificationUnreadCountView.as_view(), name='notification-unread-count'),
     path('notifications/<int:pk>/', views.NotificationDetailView.as_view(), name='notification-detail'),
 
     path('profile/', views.ProfileUpdateView.as_view(), name='profile-update'),
 ]
+
+# Uploaded photos; served by the web server in production (with MEDIA_BLOB_CACHE_CONTROL on /media/blobs/)
+if settings.DEBUG:
+    urlpatterns += [
+        re_path(r'^%s(?P<path>.*)$' % settings.MEDIA_URL.lstrip('/'), serve_media, {'document_root': settings.MEDIA_ROOT}),
+    ]
@@ -1,5 +1,9 @@
 from django.contrib import admin
-from .models import User, Companion, Patient, Reminder, Location, Task, Notification
+from . import inbox
+from .models import (
+    User, Companion, Patient, Reminder, Location, LocationRollup, Task, Notification,
+    OutboundEmail, DeadLetterEmail, MediaBlob, NotificationArchive, Geofence, LastKnownPosition
+)
 
 
 @admin.register(User)
@@ -12,38 +16,90 @@ class UserAdmin(admin.ModelAdmin):
 @admin.register(Patient)
 class PatientAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'medical_condition', 'current_gps_location')
+    list_select_related = ('user',)
     search_fields = ('user__username', 'medical_condition')
     list_filter = ('medical_condition',)
 
 @admin.register(Companion)
 class CompanionAdmin(admin.ModelAdmin):
     list_display = ('user', 'relationship', 'patient_display')
+    list_select_related = ('user', 'patient')
 
     def patient_display(self, obj):
-        # نحاول الحصول على المريض المرتبط بالمرافق عبر المستخدم
-        return obj.user.patients.name if hasattr(obj.user, 'patients') else "No Patient"
+        return obj.patient.name if obj.patient else "No Patient"
 
     patient_display.short_description = "Patient"
 
 @admin.register(Reminder)
 class ReminderAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'transmission_time', 'reminder_message')
+    list_select_related = ('user',)
     search_fields = ('user__username', 'reminder_message')
     list_filter = ('transmission_time',)
 
 @admin.register(Location)
 class LocationAdmin(admin.ModelAdmin):
-    list_display = ('id', 'gps_coordinates', 'time_coordinates', 'patient')
+    list_display = ('id', 'gps_coordinates', 'latitude', 'longitude', 'time_coordinates', 'patient')
+    list_select_related = ('patient',)
     search_fields = ('gps_coordinates', 'patient__user__username')
 
+@admin.register(LastKnownPosition)
+class LastKnownPositionAdmin(admin.ModelAdmin):
+    list_display = ('patient', 'gps_coordinates', 'recorded_at', 'updated_at')
+    list_select_related = ('patient',)
+
+@admin.register(LocationRollup)
+class LocationRollupAdmin(admin.ModelAdmin):
+    list_display = ('id', 'patient', 'resolution', 'bucket_start', 'fix_count', 'latitude', 'longitude')
+    list_filter = ('resolution',)
+
+@admin.register(Geofence)
+class GeofenceAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'patient', 'shape', 'radius_m', 'is_active', 'patient_inside', 'state_changed_at')
+    list_select_related = ('patient',)
+    list_filter = ('shape', 'is_active')
+    readonly_fields = ('patient_inside', 'state_changed_at')
+
 @admin.register(Task)
 class TaskAdmin(admin.ModelAdmin):
     list_display = ('id', 'task_name', 'task_description', 'reminder_time', 'patient')
+    list_select_related = ('patient',)
     search_fields = ('task_name', 'patient__user__username')
     list_filter = ('reminder_time',)
 
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'transmission_time', 'notification_type', 'message')
+    list_display = ('id', 'user', 'transmission_time', 'notification_type', 'message', 'is_read')
+    list_select_related = ('user',)
+    search_fields = ('user__username', 'message')
+    list_filter = ('notification_type', 'transmission_time', 'is_read')
+    readonly_fields = ('is_read', 'read_at')
+
+    # Keep User.unread_notifications in step (see inbox.py)
+    def delete_model(self, request, obj):
+        inbox.discard(Notification.objects.filter(pk=obj.pk))
+
+    def delete_queryset(self, request, queryset):
+        inbox.discard(queryset)
+
+@admin.register(NotificationArchive)
+class NotificationArchiveAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'transmission_time', 'notification_type', 'is_read', 'archived_at')
+    list_select_related = ('user',)
     search_fields = ('user__username', 'message')
-    list_filter = ('notification_type', 'transmission_time')
+
+@admin.register(OutboundEmail)
+class OutboundEmailAdmin(admin.ModelAdmin):
+    list_display = ('id', 'subject', 'recipients', 'attempts', 'next_attempt_at', 'created_at')
+    search_fields = ('subject',)
+
+@admin.register(DeadLetterEmail)
+class DeadLetterEmailAdmin(admin.ModelAdmin):
+    list_display = ('id', 'subject', 'recipients', 'attempts', 'last_error', 'failed_at')
+    search_fields = ('subject',)
+
+@admin.register(MediaBlob)
+class MediaBlobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'refcount', 'unreferenced_since')
+    search_fields = ('name',)
+    readonly_fields = ('name', 'refcount', 'unreferenced_since')
@@ -0,0 +1,88 @@
+"""
+SOS alert dispatch.
+
+A press costs the same few queries however many companions a patient has:
+the sender's row is flipped by one conditional UPDATE, which also drops
+repeated presses within ``SOS_DEDUP_WINDOW``; recipients come from the
+relationship cache and are notified with one ``bulk_create`` and one
+unread-counter UPDATE; all of it in one transaction, with the realtime
+event published on commit.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .inbox import deliver
+from .models import Companion, Notification, Patient
+from .relations import companions_of_patient, patient_of_companion
+from .realtime import publish_event
+
+SENT = 'sent'
+DUPLICATE = 'duplicate'
+CLEARED = 'cleared'
+NO_RECIPIENTS = 'no_recipients'
+
+
+def _flip(model, pk, is_active, now):
+    """Store the alert state; returns False for a repeated press inside the window."""
+    rows = model.objects.filter(pk=pk)
+    if not is_active:
+        rows.update(sos_alert=False, updated_at=now)
+        return True
+    fresh = rows.filter(
+        Q(sos_alert=False) | Q(last_sos_time__isnull=True) | Q(last_sos_time__lte=now - settings.SOS_DEDUP_WINDOW)
+    )
+    if fresh.update(sos_alert=True, last_sos_time=now, updated_at=now):
+        return True
+    if not rows.exists():
+        raise model.DoesNotExist
+    return False
+
+
+def _recipients(sender):
+    if sender.account_type == 'patients':
+        return [companion['user_id'] for companion in companions_of_patient(sender.id)]
+    patient = patient_of_companion(sender.id)
+    return [patient['user_id']] if patient is not None else []
+
+
+def dispatch_sos(sender, is_active, now=None):
+    """
+    Raise or clear the SOS of ``sender`` (a ``ClaimsUser``) and notify the
+    other side of the link. Returns ``SENT``, ``DUPLICATE``, ``CLEARED`` or
+    ``NO_RECIPIENTS``.
+    """
+    now = now or timezone.now()
+    patient_id = sender.patient_id
+    if sender.account_type == 'patients':
+        model, pk = Patient, patient_id
+    else:
+        model, pk = Companion, sender.companion_id
+
+    with transaction.atomic():
+        fresh = _flip(model, pk, is_active, now)
+        if not is_active:
+            return CLEARED
+        # Checked before the dedup so a repeated press with nobody to notify is still refused
+        user_ids = _recipients(sender) if patient_id is not None else []
+        if not user_ids:
+            return NO_RECIPIENTS
+        if not fresh:
+            return DUPLICATE
+
+        deliver([
+            Notification(
+                user_id=user_id,
+                transmission_time=now,
+                notification_type='security',
+                message=f"تنبيه SOS من {sender.name}"
+            )
+            for user_id in user_ids
+        ])
+        publish_event(patient_id, 'sos', {
+            "sender_type": sender.account_type,
+            "sender_name": sender.name,
+            "time": now
+        })
+    return SENT
@@ -0,0 +1,127 @@
+"""
+JWT authentication without a per-request ``User`` lookup.
+
+Tokens issued by ``/auth/login/`` carry the caller's ``account_type``,
+``name``, ``patient_id``/``companion_id`` and a session id (``sid``, the
+refresh token's jti, copied onto every access token minted from it).
+``StatelessJWTAuthentication`` serves requests straight from those claims.
+
+Two short-lived cache entries keep this safe:
+
+* ``jwt-denylist:<sid>`` is set by logout and rejects the session's refresh
+  and access tokens until the refresh token would have expired anyway.
+* ``jwt-claims-stale:<user_id>`` is set when a companion is linked to a
+  different patient; tokens whose claims were read before it (``claims_at``,
+  or ``iat`` for older tokens) fall back to a DB lookup.
+
+Views that edit the user row itself use ``RevocableJWTAuthentication``,
+which loads the model instance but honours the same denylist.
+
+Both markers live in the default cache. With the default ``LocMemCache``
+they only apply to the process that set them: a logout or re-link handled
+by one worker is not seen by the others, so run several workers against a
+shared cache (set ``REDIS_CACHE_URL``).
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication, JWTStatelessUserAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+DENYLIST_KEY = 'jwt-denylist:{}'
+CLAIMS_STALE_KEY = 'jwt-claims-stale:{}'
+
+CLAIM_NAMES = ('account_type', 'name', 'patient_id', 'companion_id')
+
+
+def add_profile_claims(token, user, profile):
+    """Copy the fields hot endpoints need from the login profile into ``token``."""
+    token['account_type'] = user.account_type
+    token['name'] = user.name
+    token['patient_id'] = profile.get('patient_id')
+    token['companion_id'] = profile.get('companion_id')
+    # A refreshed access token keeps the refresh token's iat, so staleness is judged on when the claims were read
+    token['claims_at'] = time.time()
+    return token
+
+
+def _remaining_lifetime():
+    return int(settings.SIMPLE_JWT['REFRESH_TOKEN_LIFETIME'].total_seconds())
+
+
+def revoke_session(token):
+    """Deny every token of ``token``'s login session (used by logout)."""
+    sid = token.get('sid') or token.get(api_settings.JTI_CLAIM)
+    timeout = max(1, int(token['exp'] - time.time())) if 'exp' in token else _remaining_lifetime()
+    cache.set(DENYLIST_KEY.format(sid), True, timeout)
+
+
+def mark_claims_stale(*user_ids):
+    """Tokens issued up to now for these users no longer carry valid link claims."""
+    now = time.time()
+    cache.set_many({CLAIMS_STALE_KEY.format(user_id): now for user_id in user_ids}, _remaining_lifetime())
+
+
+def token_state(token):
+    """Return ``(revoked, claims_stale)`` for a validated token with one cache round trip."""
+    sid = token.get('sid')
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    deny_key, stale_key = DENYLIST_KEY.format(sid), CLAIMS_STALE_KEY.format(user_id)
+    state = cache.get_many([deny_key, stale_key] if sid else [stale_key])
+    stale_since = state.get(stale_key)
+    claims_stale = stale_since is not None and token.get('claims_at', token.get('iat', 0)) <= stale_since
+    return deny_key in state, claims_stale
+
+
+class ClaimsUser(TokenUser):
+    """``request.user`` built from token claims; no database row is loaded."""
+
+    @property
+    def account_type(self):
+        return self.token.get('account_type')
+
+    @property
+    def name(self):
+        return self.token.get('name', '')
+
+    @property
+    def patient_id(self):
+        return self.token.get('patient_id')
+
+    @property
+    def companion_id(self):
+        return self.token.get('companion_id')
+
+
+class RevocableJWTAuthentication(JWTAuthentication):
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        revoked, _stale = token_state(token)
+        if revoked:
+            raise InvalidToken(_("Token has been revoked"))
+        return token
+
+
+class StatelessJWTAuthentication(JWTStatelessUserAuthentication):
+    def get_validated_token(self, raw_token):
+        token = super().get_validated_token(raw_token)
+        revoked, stale = token_state(token)
+        if revoked:
+            raise InvalidToken(_("Token has been revoked"))
+        token.claims_usable = not stale and all(claim in token for claim in CLAIM_NAMES)
+        return token
+
+    def get_user(self, validated_token):
+        if getattr(validated_token, 'claims_usable', False):
+            return ClaimsUser(validated_token)
+        # Tokens from before this scheme, or with stale link claims, take this DB path (the user row; the profile
+        # is cached) on every request until they expire; a refresh mints an access token with a new claims_at
+        from .profile_cache import get_login_profile
+
+        user = JWTAuthentication.get_user(self, validated_token)
+        claims = add_profile_claims(dict(validated_token.payload), user, get_login_profile(user))
+        return ClaimsUser(claims)
@@ -0,0 +1,259 @@
+"""
+Benchmark data and an in-process load driver for the API hot paths.
+
+``seed`` bulk-inserts ``bench-*`` patients, companions, locations,
+notifications and tasks with ``bulk_create`` (no signals, one password hash
+shared by every account), so 10^7 rows take minutes, not hours. ``run``
+drives the real URLs through Django's test client and reports latency
+percentiles and query counts per scenario; each scenario runs in a
+transaction that is rolled back, so repeated runs see the same data.
+
+Use a dedicated database: ``python manage.py seed_benchmark`` and
+``python manage.py run_benchmark``.
+"""
+import itertools
+import math
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.db import connections, transaction
+from django.db.models import Max
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .authentication import add_profile_claims
+from .models import Companion, LastKnownPosition, Location, Notification, Patient, Task, User
+from .profile_cache import get_login_profile
+
+PREFIX = 'bench-'
+PASSWORD = 'bench-pass-123'
+
+VOLUMES = {'patients': 10 ** 5, 'locations': 10 ** 7, 'notifications': 10 ** 6, 'tasks': 10 ** 6}
+
+SCENARIOS = ('login', 'sos', 'location_ingest', 'latest_position', 'notification_poll', 'task_list')
+
+
+def _insert(model, rows, batch_size):
+    rows = iter(rows)
+    total = 0
+    while batch := list(itertools.islice(rows, batch_size)):
+        model.objects.bulk_create(batch, batch_size=batch_size)
+        total += len(batch)
+    return total
+
+
+def _spread(total, owners):
+    """Yield ``(owner, n)`` for ``total`` rows spread over ``owners`` as evenly as possible."""
+    per_owner, extra = divmod(total, len(owners))
+    for index, owner in enumerate(owners):
+        yield owner, per_owner + (index < extra)
+
+
+def seed(patients, locations, notifications, tasks, batch_size=5000, now=None, log=None):
+    """Insert the benchmark rows; each patient gets one companion. Returns the row counts."""
+    now = now or timezone.now()
+    log = log or (lambda message: None)
+    password = make_password(PASSWORD)
+    start = User.objects.filter(username__startswith=PREFIX).count() // 2
+
+    def users(account_type, tag, phone_prefix):
+        for i in range(start, start + patients):
+            yield User(
+                username=f'{PREFIX}{tag}{i}', email=f'{PREFIX}{tag}{i}@example.com', password=password,
+                account_type=account_type, name=f'Bench {tag}{i}', phone_number=f'{phone_prefix}{i:011d}',
+            )
+
+    counts = {}
+    with transaction.atomic():
+        patient_users = User.objects.bulk_create(users('patients', 'p', 9), batch_size=batch_size)
+        companion_users = User.objects.bulk_create(users('companions', 'c', 8), batch_size=batch_size)
+        patient_rows = Patient.objects.bulk_create([
+            Patient(user_id=user.pk, name=user.name, email=user.email, phone_number=user.phone_number,
+                    medical_condition='', current_gps_location='30.0444,31.2357',
+                    current_latitude=30.0444, current_longitude=31.2357)
+            for user in patient_users
+        ], batch_size=batch_size)
+        companion_rows = Companion.objects.bulk_create([
+            Companion(user_id=user.pk, patient_id=patient.pk, name=user.name, email=user.email,
+                      phone_number=user.phone_number, relationship='child')
+            for user, patient in zip(companion_users, patient_rows)
+        ], batch_size=batch_size)
+    counts['patients'] = len(patient_rows)
+    counts['companions'] = len(companion_rows)
+    log(f"Inserted {counts['patients']} patients and {counts['companions']} companions.")
+
+    def location_rows():
+        for patient, n in _spread(locations, patient_rows):
+            for k in range(n):
+                latitude, longitude = 30.0 + (k % 1000) * 1e-4, 31.2 + (k % 997) * 1e-4
+                yield Location(patient_id=patient.pk, gps_coordinates=f'{latitude:.6f},{longitude:.6f}',
+                               latitude=latitude, longitude=longitude, time_coordinates=now - timedelta(minutes=k))
+
+    counts['locations'] = _insert(Location, location_rows(), batch_size)
+    # The k=0 fix of each patient is the newest
+    _insert(LastKnownPosition, (
+        LastKnownPosition(patient_id=patient.pk, gps_coordinates='30.000000,31.200000',
+                          latitude=30.0, longitude=31.2, recorded_at=now)
+        for patient, n in _spread(locations, patient_rows) if n
+    ), batch_size)
+    log(f"Inserted {counts['locations']} locations.")
+
+    # Every other notification is read; the unread counters are set to match
+    def notification_rows():
+        for user, n in _spread(notifications, patient_users):
+            for k in range(n):
+                read = k % 2 == 1
+                yield Notification(user_id=user.pk, transmission_time=now - timedelta(minutes=k),
+                                   notification_type='reminder', message=f'Reminder {k}',
+                                   is_read=read, read_at=now if read else None)
+
+    counts['notifications'] = _insert(Notification, notification_rows(), batch_size)
+    by_unread = defaultdict(list)
+    for user, n in _spread(notifications, patient_users):
+        by_unread[math.ceil(n / 2)].append(user.pk)
+    for unread, user_ids in by_unread.items():
+        for offset in range(0, len(user_ids), batch_size):
+            User.objects.filter(pk__in=user_ids[offset:offset + batch_size]).update(unread_notifications=unread)
+    log(f"Inserted {counts['notifications']} notifications.")
+
+    def task_rows():
+        pairs = list(zip(patient_rows, companion_rows))
+        for (patient, companion), n in _spread(tasks, pairs):
+            for k in range(n):
+                yield Task(patient_id=patient.pk, companion_id=companion.pk, task_name=f'Task {k}',
+                           task_description='', reminder_time=now + timedelta(hours=k), is_sent=False)
+
+    counts['tasks'] = _insert(Task, task_rows(), batch_size)
+    log(f"Inserted {counts['tasks']} tasks.")
+    return counts
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list."""
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def bearer(user):
+    return f'Bearer {add_profile_claims(AccessToken.for_user(user), user, get_login_profile(user))}'
+
+
+def _scenarios(users):
+    now = timezone.now()
+    tokens = {user.pk: bearer(user) for user in users}
+    since = dict(
+        Notification.objects.filter(user_id__in=tokens).values('user_id')
+        .annotate(latest=Max('id')).values_list('user_id', 'latest')
+    )
+
+    def pick(i):
+        return users[i % len(users)]
+
+    def login(client, i):
+        return client.post(reverse('custom_token_obtain_pair'),
+                           {'email': pick(i).email, 'password': PASSWORD}, content_type='application/json')
+
+    def sos(client, i):
+        # Raise then clear on each patient so the dedup window never short-circuits a press
+        user = pick(i // 2)
+        return client.post(reverse('sos'), {'is_active': i % 2 == 0}, content_type='application/json',
+                           HTTP_AUTHORIZATION=tokens[user.pk])
+
+    def location_ingest(client, i):
+        fixes = [
+            {'gps_coordinates': f'30.{i % 1000:04d},31.{k:04d}',
+             'time_coordinates': (now + timedelta(seconds=i * 50 + k)).isoformat()}
+            for k in range(50)
+        ]
+        return client.post(f"{reverse('location-bulk')}?patient={pick(i).patients.pk}", fixes,
+                           content_type='application/json')
+
+    def latest_position(client, i):
+        return client.get(reverse('location-latest'), HTTP_AUTHORIZATION=tokens[pick(i).pk])
+
+    def notification_poll(client, i):
+        user = pick(i)
+        return client.get(reverse('notification-inbox'), {'since': since.get(user.pk, 1) - 1},
+                          HTTP_AUTHORIZATION=tokens[user.pk])
+
+    def task_list(client, i):
+        return client.get(reverse('task-list'), {'patient': pick(i).patients.pk})
+
+    return {
+        'login': login, 'sos': sos, 'location_ingest': location_ingest, 'latest_position': latest_position,
+        'notification_poll': notification_poll, 'task_list': task_list,
+    }
+
+
+def run(scenarios=SCENARIOS, requests=200, warmup=10):
+    """Drive each scenario ``requests`` times and return the report as a dict."""
+    sample = list(
+        User.objects.filter(username__startswith=f'{PREFIX}p', account_type='patients')
+        .select_related('patients').order_by('id')[:max(requests, 1)]
+    )
+    if not sample:
+        raise ValueError("No benchmark data; run seed_benchmark first.")
+    counter = QueryCounter()
+    report = {}
+    # Limits and host checks would measure the throttle, not the endpoints
+    with override_settings(THROTTLE_BUCKETS={}, ALLOWED_HOSTS=['testserver']):
+        handlers = _scenarios(sample)
+        client = Client()
+        for name in scenarios:
+            handler = handlers[name]
+            latencies, queries, statuses = [], [], Counter()
+            with transaction.atomic():
+                for i in range(warmup):
+                    handler(client, requests + i)
+                for i in range(requests):
+                    counter.count = 0
+                    with ExitStack() as stack:
+                        for connection in connections.all():
+                            stack.enter_context(connection.execute_wrapper(counter))
+                        start = time.perf_counter()
+                        response = handler(client, i)
+                        latencies.append((time.perf_counter() - start) * 1000)
+                    queries.append(counter.count)
+                    statuses[str(response.status_code)] += 1
+                transaction.set_rollback(True)
+            latencies.sort()
+            queries.sort()
+            report[name] = {
+                'requests': requests,
+                'p50_ms': round(percentile(latencies, 0.5), 3),
+                'p99_ms': round(percentile(latencies, 0.99), 3),
+                'max_ms': round(latencies[-1], 3),
+                'mean_ms': round(sum(latencies) / len(latencies), 3),
+                'queries_p50': percentile(queries, 0.5),
+                'queries_max': queries[-1],
+                'statuses': dict(statuses),
+            }
+    return report
+
+
+def regressions(report, baseline, tolerance):
+    """Scenarios whose p99 grew by more than ``tolerance`` or that issue more queries than ``baseline``."""
+    found = []
+    for name, result in report.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            found.append(f"{name}: p99 {result['p99_ms']} ms vs {base['p99_ms']} ms")
+        if result['queries_max'] > base['queries_max']:
+            found.append(f"{name}: {result['queries_max']} queries vs {base['queries_max']}")
+    return found
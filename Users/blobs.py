@@ -0,0 +1,61 @@
+"""
+Reference counts for media files (see ``Users/storage.py``).
+
+``MediaBlob`` holds one row per stored file. The photo receivers in
+``Users/models.py`` ``retain`` the files a ``User``, ``Companion`` or
+``Patient`` row starts pointing at (photo and variants) and ``release`` the
+ones it stops pointing at, in the same transaction as the row.
+``collect_garbage`` deletes files that have been unreferenced for longer than
+``MEDIA_BLOB_GC_GRACE``; the grace period covers uploads whose row has not
+been committed yet.
+"""
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import MediaBlob
+
+
+def _by_count(names):
+    groups = defaultdict(list)
+    for name, count in Counter(name for name in names if name).items():
+        groups[count].append(name)
+    return groups
+
+
+def register(names):
+    """Make sure every file has a row, so the collector can find it."""
+    MediaBlob.objects.bulk_create([MediaBlob(name=name) for name in set(names) if name], ignore_conflicts=True)
+
+
+def retain(names):
+    register(names)
+    for count, group in _by_count(names).items():
+        MediaBlob.objects.filter(name__in=group).update(refcount=F('refcount') + count)
+
+
+def release(names, now=None):
+    now = now or timezone.now()
+    for count, group in _by_count(names).items():
+        MediaBlob.objects.filter(name__in=group).update(refcount=F('refcount') - count, unreferenced_since=now)
+
+
+def collect_garbage(now=None, batch_size=None):
+    """Delete one batch of orphaned files; returns how many were removed."""
+    now = now or timezone.now()
+    batch_size = batch_size or settings.MEDIA_BLOB_GC_BATCH_SIZE
+    with transaction.atomic():
+        orphans = list(
+            MediaBlob.objects.select_for_update(skip_locked=True)
+            .filter(refcount__lte=0, unreferenced_since__lt=now - settings.MEDIA_BLOB_GC_GRACE)
+            .values_list('pk', 'name')[:batch_size]
+        )
+        purge = getattr(default_storage, 'purge', default_storage.delete)
+        for _pk, name in orphans:
+            purge(name)
+        MediaBlob.objects.filter(pk__in=[pk for pk, _name in orphans]).delete()
+    return len(orphans)
@@ -0,0 +1,137 @@
+"""
+Streaming exports of a patient's history as CSV or NDJSON.
+
+Rows are read with ``QuerySet.iterator(chunk_size=EXPORT_CHUNK_SIZE)`` as
+plain tuples, encoded into a buffer that is handed out every
+``EXPORT_FLUSH_BYTES`` and optionally gzipped on the fly, so memory stays
+flat however long the history is. Raw fixes older than
+``LOCATION_RAW_RETENTION_DAYS`` only survive as rollups, hence the separate
+``location_rollups`` export; archived notifications are merged into the
+``notifications`` export by time.
+
+Served by ``PatientExportView`` and ``python manage.py export_history``.
+"""
+import csv
+import heapq
+import io
+import json
+import zlib
+from datetime import date, datetime
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Location, LocationRollup, Notification, NotificationArchive, Reminder, Task
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def _rows(queryset, time_field, fields, start, end):
+    if start is not None:
+        queryset = queryset.filter(**{f'{time_field}__gte': start})
+    if end is not None:
+        queryset = queryset.filter(**{f'{time_field}__lt': end})
+    return (
+        queryset.order_by(time_field, 'id').values_list(*fields)
+        .iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+    )
+
+
+def _locations(patient, start, end):
+    fields = ('id', 'time_coordinates', 'gps_coordinates', 'latitude', 'longitude')
+    return fields, _rows(Location.objects.filter(patient_id=patient.pk), 'time_coordinates', fields, start, end)
+
+
+def _location_rollups(patient, start, end):
+    fields = ('resolution', 'bucket_start', 'fix_count', 'latitude', 'longitude',
+              'min_latitude', 'max_latitude', 'min_longitude', 'max_longitude')
+    queryset = LocationRollup.objects.filter(patient_id=patient.pk)
+    return fields, _rows(queryset, 'bucket_start', fields, start, end)
+
+
+def _tasks(patient, start, end):
+    fields = ('id', 'reminder_time', 'task_name', 'task_description', 'companion_id', 'is_sent')
+    return fields, _rows(Task.objects.filter(patient_id=patient.pk), 'reminder_time', fields, start, end)
+
+
+def _reminders(patient, start, end):
+    fields = ('id', 'transmission_time', 'reminder_message', 'is_sent')
+    return fields, _rows(Reminder.objects.filter(user_id=patient.user_id), 'transmission_time', fields, start, end)
+
+
+def _notifications(patient, start, end):
+    fields = ('id', 'transmission_time', 'notification_type', 'message', 'is_read', 'read_at')
+    live = _rows(Notification.objects.filter(user_id=patient.user_id), 'transmission_time', fields, start, end)
+    archived = _rows(NotificationArchive.objects.filter(user_id=patient.user_id), 'transmission_time',
+                     ('original_id',) + fields[1:], start, end)
+    rows = heapq.merge(
+        (row + (True,) for row in archived), (row + (False,) for row in live),
+        key=lambda row: (row[1], row[0]),
+    )
+    return fields + ('archived',), rows
+
+
+KINDS = {
+    'locations': _locations,
+    'location_rollups': _location_rollups,
+    'tasks': _tasks,
+    'reminders': _reminders,
+    'notifications': _notifications,
+}
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _encode(fields, rows, output):
+    """Yield the export as text pieces of about ``EXPORT_FLUSH_BYTES``."""
+    buffer = io.StringIO()
+    if output == 'csv':
+        writer = csv.writer(buffer)
+        # The BOM lets spreadsheet apps pick UTF-8 for the Arabic messages
+        buffer.write('\ufeff')
+        writer.writerow(fields)
+
+        def write(row):
+            writer.writerow([_csv_value(value) for value in row])
+    else:
+        def write(row):
+            buffer.write(json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder, ensure_ascii=False))
+            buffer.write('\n')
+
+    flush_at = settings.EXPORT_FLUSH_BYTES
+    for row in rows:
+        write(row)
+        if buffer.tell() >= flush_at:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def stream(kind, patient, output='csv', compress=False, start=None, end=None):
+    """Bytes of the ``kind`` export for ``patient``, gzipped when ``compress``."""
+    fields, rows = KINDS[kind](patient, start, end)
+    chunks = (piece.encode('utf-8') for piece in _encode(fields, rows, output))
+    if not compress:
+        yield from chunks
+        return
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip framing
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def filename(kind, patient, output, compress):
+    return f"patient-{patient.pk}-{kind}.{output}{'.gz' if compress else ''}"
@@ -0,0 +1,45 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+
+class QueryParamFilterBackend(BaseFilterBackend):
+    """
+    Filters declared on the view:
+
+    * ``filter_fields`` maps a query param to an ORM lookup, e.g.
+      ``{'user': 'user_id'}`` handles ``?user=3``.
+    * ``range_filter_fields`` lists datetime fields that accept
+      ``?<field>_after=`` (inclusive) and ``?<field>_before=`` (exclusive).
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        params = request.query_params
+        filters = {}
+
+        for param, lookup in getattr(view, 'filter_fields', {}).items():
+            value = params.get(param)
+            if value not in (None, ''):
+                filters[lookup] = value
+
+        for field in getattr(view, 'range_filter_fields', ()):
+            for suffix, lookup in (('after', 'gte'), ('before', 'lt')):
+                param = f'{field}_{suffix}'
+                value = params.get(param)
+                if value in (None, ''):
+                    continue
+                parsed = parse_datetime(value)
+                if parsed is None:
+                    raise ValidationError({param: "Must be an ISO 8601 datetime."})
+                if timezone.is_naive(parsed):
+                    parsed = timezone.make_aware(parsed)
+                filters[f'{field}__{lookup}'] = parsed
+
+        if not filters:
+            return queryset
+        try:
+            return queryset.filter(**filters)
+        except (ValueError, DjangoValidationError) as exc:
+            raise ValidationError({"filters": str(exc)})
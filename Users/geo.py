@@ -0,0 +1,48 @@
+import math
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def parse_coordinates(value):
+    """
+    Parse a ``"lat,lng"`` string as sent by the glasses into a float pair.
+
+    Returns ``(None, None)`` when the value is empty, malformed or out of range.
+    """
+    if not value:
+        return None, None
+    parts = value.replace(';', ',').split(',')
+    if len(parts) != 2:
+        parts = value.split()
+    if len(parts) != 2:
+        return None, None
+    try:
+        lat, lng = float(parts[0]), float(parts[1])
+    except ValueError:
+        return None, None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None, None
+    return lat, lng
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """Great-circle distance in metres between two points."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def bounding_box(lat, lng, radius_m):
+    """Return ``(min_lat, max_lat, min_lng, max_lng)`` enclosing a circle."""
+    dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+    cos_lat = math.cos(math.radians(lat))
+    if cos_lat < 1e-9:
+        dlng = 180.0
+    else:
+        dlng = min(180.0, math.degrees(radius_m / (EARTH_RADIUS_M * cos_lat)))
+    return (
+        max(-90.0, lat - dlat), min(90.0, lat + dlat),
+        max(-180.0, lng - dlng), min(180.0, lng + dlng),
+    )
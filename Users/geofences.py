@@ -0,0 +1,234 @@
+"""
+Wandering alerts: safe zones checked against every incoming location.
+
+A patient's active fences are cached (``GEOFENCE_CACHE_TIMEOUT``, dropped by
+a receiver in ``Users/models.py`` whenever a fence changes) and indexed in
+each process on a grid of ``GEOFENCE_GRID_DEGREES`` cells, so a fix only
+gets the exact circle/polygon test against fences whose bounding box covers
+its cell. ``record_locations`` passes every new fix to
+``evaluate_locations``, which walks each patient's fixes in time order, so
+a patient who leaves and returns within one upload still raises both
+alerts. The stored ``patient_inside`` state is moved by a conditional
+UPDATE, so each crossing is reported once even when workers race or fixes
+arrive out of order, and the patient's companions get a ``security``
+notification. The first fix after a fence is created or moved
+only records the state.
+"""
+import math
+import threading
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .geo import bounding_box, haversine_m
+from .inbox import deliver
+from .models import Geofence, Notification, Patient
+from .realtime import publish_event
+from .relations import companions_of_patient
+
+KEY = 'geofences:{}'
+
+# Process-local indexes, rebuilt when the cached definitions change
+MAX_INDEXES = 10000
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def definition(fence):
+    """The plain, cacheable description of a ``Geofence``."""
+    if fence.shape == 'circle':
+        bbox = bounding_box(fence.center_latitude, fence.center_longitude, fence.radius_m)
+    else:
+        lats = [lat for lat, _lng in fence.vertices]
+        lngs = [lng for _lat, lng in fence.vertices]
+        bbox = (min(lats), max(lats), min(lngs), max(lngs))
+    return {
+        'id': fence.pk, 'name': fence.name, 'shape': fence.shape, 'bbox': bbox,
+        'center': (fence.center_latitude, fence.center_longitude), 'radius_m': fence.radius_m,
+        'vertices': [tuple(vertex) for vertex in fence.vertices],
+    }
+
+
+def contains(fence, lat, lng):
+    min_lat, max_lat, min_lng, max_lng = fence['bbox']
+    if not (min_lat <= lat <= max_lat and min_lng <= lng <= max_lng):
+        return False
+    if fence['shape'] == 'circle':
+        return haversine_m(lat, lng, *fence['center']) <= fence['radius_m']
+    # Ray casting on the lat/lng plane; safe zones are small enough for that
+    inside = False
+    vertices = fence['vertices']
+    for (lat1, lng1), (lat2, lng2) in zip(vertices, vertices[1:] + vertices[:1]):
+        if (lat1 > lat) != (lat2 > lat) and lng < lng1 + (lat - lat1) * (lng2 - lng1) / (lat2 - lat1):
+            inside = not inside
+    return inside
+
+
+class GridIndex:
+    """Fences bucketed by the grid cells their bounding boxes overlap."""
+
+    def __init__(self, fences, cell_degrees=None, max_cells=None):
+        self.cell = cell_degrees or settings.GEOFENCE_GRID_DEGREES
+        max_cells = max_cells or settings.GEOFENCE_GRID_MAX_CELLS
+        self.cells = defaultdict(list)
+        self.everywhere = []  # fences too large to bucket, always tested
+        for fence in fences:
+            min_lat, max_lat, min_lng, max_lng = fence['bbox']
+            rows = range(self._cell(min_lat), self._cell(max_lat) + 1)
+            cols = range(self._cell(min_lng), self._cell(max_lng) + 1)
+            if len(rows) * len(cols) > max_cells:
+                self.everywhere.append(fence)
+                continue
+            for row in rows:
+                for col in cols:
+                    self.cells[(row, col)].append(fence)
+
+    def _cell(self, degrees):
+        return math.floor(degrees / self.cell)
+
+    def containing(self, lat, lng):
+        """Ids of the fences containing the point."""
+        candidates = self.cells.get((self._cell(lat), self._cell(lng)), [])
+        return {fence['id'] for fence in (*candidates, *self.everywhere) if contains(fence, lat, lng)}
+
+
+def fences_for(patient_ids):
+    """``{patient_id: [definition, ...]}`` of active fences, read through the cache."""
+    keys = {patient_id: KEY.format(patient_id) for patient_id in patient_ids}
+    cached = cache.get_many(keys.values())
+    found = {patient_id: cached[key] for patient_id, key in keys.items() if key in cached}
+    missing = [patient_id for patient_id in keys if patient_id not in found]
+    if missing:
+        built = {patient_id: [] for patient_id in missing}
+        rows = (
+            Geofence.objects.filter(patient_id__in=missing, is_active=True).order_by('id')
+            .only('patient_id', 'name', 'shape', 'center_latitude', 'center_longitude', 'radius_m', 'vertices')
+        )
+        for fence in rows:
+            built[fence.patient_id].append(definition(fence))
+        cache.set_many({keys[patient_id]: fences for patient_id, fences in built.items()},
+                       settings.GEOFENCE_CACHE_TIMEOUT)
+        found.update(built)
+    return found
+
+
+def index_for(patient_id, fences):
+    with _indexes_lock:
+        entry = _indexes.get(patient_id)
+        if entry is not None and entry[0] == fences:
+            _indexes.move_to_end(patient_id)
+            return entry[1]
+    index = GridIndex(fences)
+    with _indexes_lock:
+        _indexes[patient_id] = (fences, index)
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def invalidate_fences(*patient_ids):
+    keys = [KEY.format(patient_id) for patient_id in patient_ids]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def evaluate_locations(locations):
+    """
+    Walk each patient's fixes in time order through their fences and notify
+    companions of every crossing, including a patient who leaves and comes
+    back within one upload. Returns the crossings as ``(fence definition,
+    patient_id, entered, location)`` tuples in time order.
+    """
+    tracks = defaultdict(list)
+    for location in locations:
+        if location.latitude is not None and location.longitude is not None:
+            tracks[location.patient_id].append(location)
+    if not tracks:
+        return []
+    fences = {patient_id: found for patient_id, found in fences_for(tracks).items() if found}
+    if not fences:
+        return []
+
+    stored = {
+        pk: (inside, changed_at) for pk, inside, changed_at in
+        Geofence.objects.filter(pk__in=[fence['id'] for found in fences.values() for fence in found])
+        .values_list('pk', 'patient_inside', 'state_changed_at')
+    }
+    changes = []
+    for patient_id, patient_fences in fences.items():
+        track = sorted(tracks[patient_id], key=lambda location: location.time_coordinates)
+        index = index_for(patient_id, patient_fences)
+        containing = [index.containing(location.latitude, location.longitude) for location in track]
+        for fence in patient_fences:
+            if fence['id'] not in stored:
+                continue
+            prior, changed_at = stored[fence['id']]
+            state, first, last, transitions = prior, None, None, []
+            for location, inside_ids in zip(track, containing):
+                # Fixes older than the recorded state arrived late and cannot change it
+                if changed_at is not None and location.time_coordinates <= changed_at:
+                    continue
+                inside = fence['id'] in inside_ids
+                if inside == state:
+                    continue
+                if state is not None:  # the first fix after a fence is created or moved only records the state
+                    transitions.append((fence, patient_id, inside, location))
+                state = inside
+                first = first or location.time_coordinates
+                last = location.time_coordinates
+            if first is not None:
+                changes.append((fence['id'], prior, state, first, last, transitions))
+
+    crossings = []
+    if not changes:
+        return crossings
+    now = timezone.now()
+    with transaction.atomic():
+        for fence_id, prior, state, first, last, transitions in changes:
+            # Matches only if no other worker recorded a crossing since ``stored`` was read; a patient who
+            # left and came back ends in the prior state, so the timestamp is what claims the crossings
+            claimed = (
+                Geofence.objects
+                .filter(pk=fence_id, patient_inside=prior)
+                .filter(Q(state_changed_at__isnull=True) | Q(state_changed_at__lt=first))
+                .update(patient_inside=state, state_changed_at=last, updated_at=now)
+            )
+            if claimed:
+                crossings.extend(transitions)
+        crossings.sort(key=lambda crossing: crossing[3].time_coordinates)
+        if crossings:
+            _notify(crossings)
+    return crossings
+
+
+def _notify(crossings):
+    patients = {
+        patient_id: (user_id, name) for patient_id, user_id, name in
+        Patient.objects.filter(pk__in={crossing[1] for crossing in crossings})
+        .values_list('id', 'user_id', 'name')
+    }
+    notifications = []
+    for fence, patient_id, entered, location in crossings:
+        user_id, name = patients[patient_id]
+        if entered:
+            message = f"{name} عاد إلى المنطقة الآمنة «{fence['name']}»"
+        else:
+            message = f"تنبيه: {name} خرج من المنطقة الآمنة «{fence['name']}»"
+        notifications.extend(
+            Notification(user_id=companion['user_id'], transmission_time=location.time_coordinates,
+                         notification_type='security', message=message)
+            for companion in companions_of_patient(user_id)
+        )
+        publish_event(patient_id, 'geofence', {
+            'geofence': fence['id'],
+            'name': fence['name'],
+            'entered': entered,
+            'latitude': location.latitude,
+            'longitude': location.longitude,
+            'time': location.time_coordinates,
+        })
+    deliver(notifications)
@@ -0,0 +1,278 @@
+"""
+Location history retention and rollups.
+
+Raw fixes are kept for ``LOCATION_RAW_RETENTION_DAYS``, then compacted into
+per-minute ``LocationRollup`` rows; per-minute rollups are in turn compacted
+into per-hour rollups after ``LOCATION_MINUTE_RETENTION_DAYS``. Aggregation
+runs in the database (Trunc + Avg/Min/Max/Count), one day at a time.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Count, F, Max, Min, Q, Sum
+from django.db.models.functions import TruncHour, TruncMinute
+from django.utils import timezone
+
+from .models import Location, LocationRollup
+
+DELETE_BATCH_SIZE = 5000
+
+TRUNC_FUNCTIONS = {
+    'minute': TruncMinute,
+    'hour': TruncHour,
+}
+
+SUMMARY_FIELDS = [
+    'fix_count', 'latitude', 'longitude',
+    'min_latitude', 'max_latitude', 'min_longitude', 'max_longitude',
+]
+
+
+def raw_cutoff(now=None):
+    now = now or timezone.now()
+    return _floor_hour(now - timedelta(days=settings.LOCATION_RAW_RETENTION_DAYS))
+
+
+def minute_cutoff(now=None):
+    now = now or timezone.now()
+    return _floor_hour(now - timedelta(days=settings.LOCATION_MINUTE_RETENTION_DAYS))
+
+
+def _floor_hour(value):
+    # Cutoffs sit on an hour boundary so no bucket is ever split between runs
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _rows(queryset):
+    # Aggregates are annotated as agg_<field> so they don't clash with model fields
+    return [
+        {key[4:] if key.startswith('agg_') else key: value for key, value in row.items()}
+        for row in queryset
+    ]
+
+
+def _aggregate_raw(queryset, resolution):
+    return _rows(
+        queryset.filter(latitude__isnull=False, longitude__isnull=False)
+        .annotate(bucket=TRUNC_FUNCTIONS[resolution]('time_coordinates'))
+        .values('patient_id', 'bucket')
+        .annotate(
+            agg_fix_count=Count('id'),
+            agg_latitude=Avg('latitude'),
+            agg_longitude=Avg('longitude'),
+            agg_min_latitude=Min('latitude'),
+            agg_max_latitude=Max('latitude'),
+            agg_min_longitude=Min('longitude'),
+            agg_max_longitude=Max('longitude'),
+        )
+        .order_by()
+    )
+
+
+def _aggregate_rollups(queryset, resolution):
+    rows = _rows(
+        queryset.annotate(bucket=TRUNC_FUNCTIONS[resolution]('bucket_start'))
+        .values('patient_id', 'bucket')
+        .annotate(
+            agg_fix_count=Sum('fix_count'),
+            agg_weighted_latitude=Sum(F('latitude') * F('fix_count')),
+            agg_weighted_longitude=Sum(F('longitude') * F('fix_count')),
+            agg_min_latitude=Min('min_latitude'),
+            agg_max_latitude=Max('max_latitude'),
+            agg_min_longitude=Min('min_longitude'),
+            agg_max_longitude=Max('max_longitude'),
+        )
+        .order_by()
+    )
+    for row in rows:
+        row['latitude'] = row.pop('weighted_latitude') / row['fix_count']
+        row['longitude'] = row.pop('weighted_longitude') / row['fix_count']
+    return rows
+
+
+def _merge(a, b):
+    """Combine two summaries of the same bucket."""
+    count = a['fix_count'] + b['fix_count']
+    return {
+        'fix_count': count,
+        'latitude': (a['latitude'] * a['fix_count'] + b['latitude'] * b['fix_count']) / count,
+        'longitude': (a['longitude'] * a['fix_count'] + b['longitude'] * b['fix_count']) / count,
+        'min_latitude': min(a['min_latitude'], b['min_latitude']),
+        'max_latitude': max(a['max_latitude'], b['max_latitude']),
+        'min_longitude': min(a['min_longitude'], b['min_longitude']),
+        'max_longitude': max(a['max_longitude'], b['max_longitude']),
+    }
+
+
+def _store_rollups(resolution, rows):
+    """
+    Upsert aggregated rows into ``LocationRollup``. Existing buckets (e.g. from
+    fixes the glasses uploaded late) are merged rather than overwritten.
+    """
+    if not rows:
+        return 0
+    buckets = {row['bucket'] for row in rows}
+    existing = {
+        (rollup.patient_id, rollup.bucket_start): rollup
+        for rollup in LocationRollup.objects.filter(
+            resolution=resolution,
+            bucket_start__gte=min(buckets),
+            bucket_start__lte=max(buckets),
+            patient_id__in={row['patient_id'] for row in rows},
+        )
+    }
+    to_create, to_update = [], []
+    for row in rows:
+        summary = {field: row[field] for field in SUMMARY_FIELDS}
+        rollup = existing.get((row['patient_id'], row['bucket']))
+        if rollup is None:
+            to_create.append(LocationRollup(
+                patient_id=row['patient_id'], resolution=resolution,
+                bucket_start=row['bucket'], **summary
+            ))
+            continue
+        current = {field: getattr(rollup, field) for field in SUMMARY_FIELDS}
+        for field, value in _merge(current, summary).items():
+            setattr(rollup, field, value)
+        to_update.append(rollup)
+    LocationRollup.objects.bulk_create(to_create, batch_size=1000)
+    LocationRollup.objects.bulk_update(to_update, SUMMARY_FIELDS, batch_size=1000)
+    return len(rows)
+
+
+def _day_windows(start, end):
+    window_start = start
+    while window_start < end:
+        window_end = min(window_start + timedelta(days=1), end)
+        yield window_start, window_end
+        window_start = window_end
+
+
+def _delete_in_batches(queryset, batch_size=None):
+    """
+    Delete ``queryset`` a pk range at a time. ``LastKnownPosition.location``
+    is SET_NULL, so Django loads the rows it deletes; batching keeps that bounded.
+    """
+    batch_size = batch_size or DELETE_BATCH_SIZE
+    deleted = 0
+    while True:
+        bound = list(queryset.order_by('pk').values_list('pk', flat=True)[batch_size - 1:batch_size])
+        if not bound:
+            return deleted + queryset.delete()[0]
+        deleted += queryset.filter(pk__lte=bound[0]).delete()[0]
+
+
+def compact_raw_locations(cutoff=None):
+    """
+    Roll raw fixes older than ``cutoff`` into minute buckets and delete them.
+    Fixes without parsed coordinates cannot be rolled up; they are deleted
+    past the cutoff all the same and reported apart as ``unparsed``.
+    """
+    cutoff = cutoff or raw_cutoff()
+    old = Location.objects.filter(time_coordinates__lt=cutoff)
+    parsed = old.filter(latitude__isnull=False, longitude__isnull=False)
+    with transaction.atomic():
+        unparsed = _delete_in_batches(old.filter(Q(latitude__isnull=True) | Q(longitude__isnull=True)))
+    oldest = parsed.aggregate(t=Min('time_coordinates'))['t']
+    if oldest is None:
+        return {'fixes': 0, 'rollups': 0, 'unparsed': unparsed}
+
+    fixes = rollups = 0
+    for start, end in _day_windows(_floor_hour(oldest), cutoff):
+        window = parsed.filter(time_coordinates__gte=start, time_coordinates__lt=end)
+        with transaction.atomic():
+            rollups += _store_rollups('minute', _aggregate_raw(window, 'minute'))
+            fixes += _delete_in_batches(window)
+    return {'fixes': fixes, 'rollups': rollups, 'unparsed': unparsed}
+
+
+def compact_minute_rollups(cutoff=None):
+    """Roll minute buckets older than ``cutoff`` into hour buckets and delete them."""
+    cutoff = cutoff or minute_cutoff()
+    minutes = LocationRollup.objects.filter(resolution='minute', bucket_start__lt=cutoff)
+    oldest = minutes.aggregate(t=Min('bucket_start'))['t']
+    if oldest is None:
+        return {'minutes': 0, 'rollups': 0}
+
+    compacted = rollups = 0
+    for start, end in _day_windows(_floor_hour(oldest), cutoff):
+        window = minutes.filter(bucket_start__gte=start, bucket_start__lt=end)
+        with transaction.atomic():
+            rollups += _store_rollups('hour', _aggregate_rollups(window, 'hour'))
+            deleted, _ = window.delete()
+            compacted += deleted
+    return {'minutes': compacted, 'rollups': rollups}
+
+
+def compact_location_history(now=None):
+    return {
+        'raw': compact_raw_locations(raw_cutoff(now)),
+        'minute': compact_minute_rollups(minute_cutoff(now)),
+    }
+
+
+def choose_resolution(start, end, now=None):
+    """
+    Pick the finest resolution that still covers the whole range: raw data
+    only exists after the raw cutoff, minute rollups only after the minute
+    cutoff, and long spans are served coarser to keep responses bounded.
+    """
+    span = end - start
+    if start >= raw_cutoff(now) and span <= settings.LOCATION_HISTORY_RAW_MAX_SPAN:
+        return 'raw'
+    if start >= minute_cutoff(now) and span <= settings.LOCATION_HISTORY_MINUTE_MAX_SPAN:
+        return 'minute'
+    return 'hour'
+
+
+def location_history(patient_id, start, end, now=None):
+    """
+    Return ``(resolution, points)`` for a patient's history in ``[start, end)``.
+
+    For rollup resolutions, rows not compacted yet (recent raw fixes, recent
+    minute rollups) are aggregated on the fly and merged with stored rollups.
+    """
+    resolution = choose_resolution(start, end, now)
+    fixes = Location.objects.filter(
+        patient_id=patient_id, time_coordinates__gte=start, time_coordinates__lt=end
+    )
+
+    if resolution == 'raw':
+        points = [
+            {'time': t, 'latitude': lat, 'longitude': lng, 'count': 1}
+            for t, lat, lng in fixes.filter(latitude__isnull=False)
+            .order_by('time_coordinates')
+            .values_list('time_coordinates', 'latitude', 'longitude')
+        ]
+        return resolution, points
+
+    rollups = LocationRollup.objects.filter(
+        patient_id=patient_id, bucket_start__gte=start, bucket_start__lt=end
+    )
+    rows = _aggregate_raw(fixes, resolution)
+    if resolution == 'hour':
+        rows += _aggregate_rollups(rollups.filter(resolution='minute'), 'hour')
+    rows += [
+        {'bucket': rollup.bucket_start, **{field: getattr(rollup, field) for field in SUMMARY_FIELDS}}
+        for rollup in rollups.filter(resolution=resolution)
+    ]
+
+    merged = {}
+    for row in rows:
+        summary = {field: row[field] for field in SUMMARY_FIELDS}
+        bucket = row['bucket']
+        merged[bucket] = _merge(merged[bucket], summary) if bucket in merged else summary
+
+    points = [
+        {
+            'time': bucket,
+            'latitude': summary['latitude'],
+            'longitude': summary['longitude'],
+            'count': summary['fix_count'],
+            'bbox': [summary['min_latitude'], summary['min_longitude'],
+                     summary['max_latitude'], summary['max_longitude']],
+        }
+        for bucket, summary in sorted(merged.items())
+    ]
+    return resolution, points
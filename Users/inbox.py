@@ -0,0 +1,102 @@
+"""
+Per-user notification inbox.
+
+``User.unread_notifications`` is a denormalized counter, so polling the
+unread badge never counts rows. It is kept in step by the code that changes
+read state: ``deliver`` (bulk inserts), ``mark_read`` and
+``archive_notifications`` adjust it with ``F()`` updates in the same
+transaction; single creates go through a receiver in ``Users/models.py``
+and deletes through ``discard``. Clients sync with ``since=<last id seen>``,
+served from the ``(user, id)`` index.
+"""
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import Notification, NotificationArchive, User
+
+
+def adjust_unread(counts):
+    """Apply ``{user_id: delta}`` to the unread counters, one UPDATE per distinct delta."""
+    by_delta = defaultdict(list)
+    for user_id, delta in counts.items():
+        if delta:
+            by_delta[delta].append(user_id)
+    for delta, user_ids in sorted(by_delta.items()):
+        User.objects.filter(pk__in=sorted(user_ids)).update(
+            unread_notifications=Greatest(F('unread_notifications') + delta, Value(0))
+        )
+
+
+def deliver(notifications):
+    """``bulk_create`` notifications and bump their recipients' unread counters."""
+    with transaction.atomic():
+        created = Notification.objects.bulk_create(notifications)
+        adjust_unread(Counter(n.user_id for n in created if not n.is_read))
+    return created
+
+
+def sync(user_id, since=0, limit=None):
+    """Notifications newer than ``since`` (an id), oldest first, and whether more remain."""
+    limit = min(limit or settings.NOTIFICATION_SYNC_PAGE_SIZE, settings.NOTIFICATION_SYNC_PAGE_SIZE)
+    rows = list(Notification.objects.filter(user_id=user_id, id__gt=since).order_by('id')[:limit + 1])
+    return rows[:limit], len(rows) > limit
+
+
+def unread_count(user_id):
+    return User.objects.filter(pk=user_id).values_list('unread_notifications', flat=True).first() or 0
+
+
+def mark_read(user_id, ids=None, up_to=None, now=None):
+    """Mark the given ids, or everything up to id ``up_to``, as read. Returns how many changed."""
+    rows = Notification.objects.filter(user_id=user_id, is_read=False)
+    if ids is not None:
+        rows = rows.filter(id__in=ids)
+    if up_to is not None:
+        rows = rows.filter(id__lte=up_to)
+    with transaction.atomic():
+        now = now or timezone.now()
+        marked = rows.update(is_read=True, read_at=now, updated_at=now)
+        adjust_unread({user_id: -marked})
+    return marked
+
+
+def discard(queryset):
+    """Delete notifications, keeping the unread counters right."""
+    with transaction.atomic():
+        unread = Counter(queryset.filter(is_read=False).values_list('user_id', flat=True))
+        deleted, _ = queryset.delete()
+        adjust_unread({user_id: -count for user_id, count in unread.items()})
+    return deleted
+
+
+def archive_notifications(now=None, batch_size=None):
+    """Move one batch of notifications past ``NOTIFICATION_RETENTION_DAYS`` to the archive."""
+    now = now or timezone.now()
+    batch_size = batch_size or settings.NOTIFICATION_ARCHIVE_BATCH_SIZE
+    cutoff = now - timedelta(days=settings.NOTIFICATION_RETENTION_DAYS)
+    with transaction.atomic():
+        batch = list(
+            Notification.objects.select_for_update(skip_locked=True)
+            .filter(transmission_time__lt=cutoff)
+            .order_by('transmission_time')[:batch_size]
+        )
+        if not batch:
+            return 0
+        NotificationArchive.objects.bulk_create([
+            NotificationArchive(
+                original_id=n.id, user_id=n.user_id, transmission_time=n.transmission_time,
+                notification_type=n.notification_type, message=n.message,
+                is_read=n.is_read, read_at=n.read_at, archived_at=now,
+            )
+            for n in batch
+        ])
+        # Archived notifications no longer count as unread
+        adjust_unread({user_id: -count for user_id, count in Counter(n.user_id for n in batch if not n.is_read).items()})
+        Notification.objects.filter(pk__in=[n.pk for n in batch]).delete()
+    return len(batch)
@@ -0,0 +1,86 @@
+from django.db import transaction
+from django.utils import timezone
+
+from .geofences import evaluate_locations
+from .models import LastKnownPosition, Location
+from .realtime import publish_event
+
+
+def record_locations(locations):
+    """
+    Write a batch of unsaved ``Location`` instances with a single INSERT.
+
+    Every location write (single or batch) should go through here so that
+    follow-up work on new fixes has one place to hook into.
+    """
+    for location in locations:
+        # bulk_create skips Model.save(), so derive the numeric columns here
+        location.sync_coordinates()
+    with transaction.atomic():
+        created = Location.objects.bulk_create(locations)
+
+        # Push only the newest fix per patient, not the whole buffered batch
+        latest = {}
+        for location in created:
+            current = latest.get(location.patient_id)
+            if current is None or location.time_coordinates > current.time_coordinates:
+                latest[location.patient_id] = location
+        for patient_id, location in latest.items():
+            publish_event(patient_id, 'location', {
+                'id': location.pk,
+                'gps_coordinates': location.gps_coordinates,
+                'latitude': location.latitude,
+                'longitude': location.longitude,
+                'time_coordinates': location.time_coordinates,
+            })
+        update_last_positions(latest.values())
+        evaluate_locations(created)
+    return created
+
+
+def update_last_positions(locations):
+    """
+    Point each patient's ``LastKnownPosition`` at the given fix unless it
+    already holds a newer one; one UPDATE per patient once the row exists.
+    """
+    now = timezone.now()
+    for location in locations:
+        fields = _position_fields(location)
+        newer = LastKnownPosition.objects.filter(patient_id=location.patient_id,
+                                                 recorded_at__lt=location.time_coordinates)
+        if newer.update(**fields, updated_at=now):
+            continue
+        # No row yet, or it already holds a newer fix; a concurrent insert wins the conflict and is retried
+        LastKnownPosition.objects.bulk_create([LastKnownPosition(patient_id=location.patient_id, **fields)],
+                                              ignore_conflicts=True)
+        newer.update(**fields, updated_at=now)
+
+
+def _position_fields(location):
+    return {
+        'location_id': location.pk,
+        'gps_coordinates': location.gps_coordinates,
+        'latitude': location.latitude,
+        'longitude': location.longitude,
+        'recorded_at': location.time_coordinates,
+    }
+
+
+def last_position_holders(location_id):
+    """Patients whose ``LastKnownPosition`` points at this fix; read before editing or deleting it."""
+    return list(LastKnownPosition.objects.filter(location_id=location_id).values_list('patient_id', flat=True))
+
+
+def recompute_last_positions(patient_ids):
+    """
+    Point each patient's ``LastKnownPosition`` at their newest remaining fix,
+    or drop it when none is left. For fixes edited or deleted outside
+    ``record_locations``, which only ever moves the position forward.
+    """
+    now = timezone.now()
+    for patient_id in patient_ids:
+        newest = Location.objects.filter(patient_id=patient_id).order_by('-time_coordinates', '-id').first()
+        if newest is None:
+            LastKnownPosition.objects.filter(patient_id=patient_id).delete()
+        else:
+            LastKnownPosition.objects.filter(patient_id=patient_id).update(**_position_fields(newest), updated_at=now)
@@ -0,0 +1,127 @@
+"""
+Outbound mail pipeline.
+
+Request handlers and tasks call ``enqueue_email``/``enqueue_emails``, which
+only insert ``OutboundEmail`` rows. ``drain_outbox`` (run by Celery) sends
+due rows in batches over a single backend connection, deletes what was
+delivered, reschedules failures with exponential backoff and moves rows
+that keep failing to ``DeadLetterEmail``.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.utils import timezone
+
+from .models import DeadLetterEmail, OutboundEmail
+
+logger = logging.getLogger(__name__)
+
+
+def _kick():
+    # Wake a worker right away; the beat schedule drains the outbox anyway
+    from .tasks import drain_email_outbox
+
+    try:
+        drain_email_outbox.apply_async(retry=False)
+    except Exception:
+        logger.warning("Could not reach the Celery broker; outbox will be drained by the next beat run")
+
+
+def enqueue_emails(messages):
+    """Queue ``(subject, body, from_email, recipients)`` tuples for delivery."""
+    rows = OutboundEmail.objects.bulk_create([
+        OutboundEmail(
+            subject=subject,
+            body=body,
+            from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+            recipients=list(recipients),
+        )
+        for subject, body, from_email, recipients in messages
+    ])
+    if rows:
+        transaction.on_commit(_kick)
+    return rows
+
+
+def enqueue_email(subject, body, recipients, from_email=None):
+    return enqueue_emails([(subject, body, from_email, recipients)])[0]
+
+
+def retry_delay(attempts):
+    delay = settings.EMAIL_OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.EMAIL_OUTBOX_RETRY_MAX_SECONDS))
+
+
+def drain_outbox(batch_size=None, now=None):
+    """
+    Send one batch of due messages. Returns ``{'sent', 'retried', 'dead'}``.
+
+    Rows are locked with ``skip_locked`` so concurrent workers take disjoint
+    batches.
+    """
+    now = now or timezone.now()
+    batch_size = batch_size or settings.EMAIL_OUTBOX_BATCH_SIZE
+    result = {'sent': 0, 'retried': 0, 'dead': 0}
+
+    with transaction.atomic():
+        batch = list(
+            OutboundEmail.objects.select_for_update(skip_locked=True)
+            .filter(next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        if not batch:
+            return result
+
+        sent, failed = [], []
+        connection = get_connection(fail_silently=False)
+        try:
+            connection.open()
+        except Exception as exc:
+            failed = [(message, exc) for message in batch]
+        else:
+            try:
+                for message in batch:
+                    email = EmailMessage(
+                        message.subject, message.body, message.from_email,
+                        message.recipients, connection=connection
+                    )
+                    try:
+                        email.send()
+                    except Exception as exc:
+                        failed.append((message, exc))
+                    else:
+                        sent.append(message.pk)
+            finally:
+                connection.close()
+
+        OutboundEmail.objects.filter(pk__in=sent).delete()
+        result['sent'] = len(sent)
+
+        retry, dead = [], []
+        for message, exc in failed:
+            message.attempts += 1
+            message.last_error = repr(exc)
+            if message.attempts >= settings.EMAIL_OUTBOX_MAX_ATTEMPTS:
+                dead.append(message)
+            else:
+                message.next_attempt_at = now + retry_delay(message.attempts)
+                retry.append(message)
+
+        OutboundEmail.objects.bulk_update(retry, ['attempts', 'last_error', 'next_attempt_at'])
+        if dead:
+            DeadLetterEmail.objects.bulk_create([
+                DeadLetterEmail(
+                    subject=message.subject, body=message.body, from_email=message.from_email,
+                    recipients=message.recipients, attempts=message.attempts,
+                    last_error=message.last_error, created_at=message.created_at,
+                )
+                for message in dead
+            ])
+            OutboundEmail.objects.filter(pk__in=[message.pk for message in dead]).delete()
+            logger.error("Moved %d undeliverable emails to the dead-letter table", len(dead))
+        result['retried'] = len(retry)
+        result['dead'] = len(dead)
+    return result
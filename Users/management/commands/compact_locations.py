@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from Users.history import compact_raw_locations, compact_minute_rollups, raw_cutoff, minute_cutoff
+
+
+class Command(BaseCommand):
+    help = "Compact old raw location fixes into per-minute rollups and old minute rollups into per-hour rollups."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skip-minutes', action='store_true',
+                            help="Only compact raw fixes, leave minute rollups alone.")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        raw = compact_raw_locations(raw_cutoff(now))
+        self.stdout.write(f"Compacted {raw['fixes']} raw fixes into {raw['rollups']} minute buckets.")
+        if raw['unparsed']:
+            self.stdout.write(self.style.WARNING(
+                f"Deleted {raw['unparsed']} old fixes whose coordinates could not be parsed, without rollups."
+            ))
+        if not options['skip_minutes']:
+            minute = compact_minute_rollups(minute_cutoff(now))
+            self.stdout.write(f"Compacted {minute['minutes']} minute buckets into {minute['rollups']} hour buckets.")
+        self.stdout.write(self.style.SUCCESS("Location history compaction finished."))
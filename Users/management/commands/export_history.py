@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from Users import exports
+from Users.models import Patient
+
+
+def _datetime(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise CommandError(f"Not an ISO 8601 datetime: {value}")
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+class Command(BaseCommand):
+    help = "Stream one kind of a patient's history to a file (or stdout) as CSV or NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('patient', type=int, help="Patient id.")
+        parser.add_argument('kind', help=f"One of {', '.join(exports.KINDS)}.")
+        parser.add_argument('--output-format', default='csv', help=f"One of {', '.join(exports.FORMATS)}.")
+        parser.add_argument('--gzip', action='store_true', help="Compress on the fly; requires --output.")
+        parser.add_argument('--output', help="Write to this file instead of stdout.")
+        parser.add_argument('--start', type=_datetime)
+        parser.add_argument('--end', type=_datetime)
+
+    def handle(self, *args, **options):
+        kind, output = options['kind'], options['output_format']
+        if kind not in exports.KINDS:
+            raise CommandError(f"Unknown export {kind}, expected one of {', '.join(exports.KINDS)}")
+        if output not in exports.FORMATS:
+            raise CommandError(f"Unknown format {output}, expected one of {', '.join(exports.FORMATS)}")
+        if options['gzip'] and not options['output']:
+            raise CommandError("--gzip needs --output")
+        patient = Patient.objects.only('id', 'user_id').filter(pk=options['patient']).first()
+        if patient is None:
+            raise CommandError(f"No patient {options['patient']}")
+
+        chunks = exports.stream(kind, patient, output, options['gzip'], options['start'], options['end'])
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk.decode('utf-8'), ending='')
+            return
+        size = 0
+        with open(options['output'], 'wb') as handle:
+            for chunk in chunks:
+                handle.write(chunk)
+                size += len(chunk)
+        self.stderr.write(f"Wrote {size} bytes to {options['output']}.")
@@ -0,0 +1,42 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Users.provisioning import ProvisioningError, parse, provision
+
+
+class Command(BaseCommand):
+    help = "Create patients, companions and their links from a CSV or JSON file in one transaction."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV with a header line, or a JSON list of objects.")
+        parser.add_argument('--format', dest='content_format', choices=('csv', 'json'),
+                            help="Taken from the file extension by default.")
+        parser.add_argument('--dry-run', action='store_true', help="Only validate and print the report.")
+        parser.add_argument('--workers', type=int, help="Password hashing processes (PROVISION_HASH_WORKERS).")
+        parser.add_argument('--batch-size', type=int)
+
+    def handle(self, *args, **options):
+        content_format = options['content_format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        try:
+            with open(options['path'], 'rb') as handle:
+                rows = parse(handle.read(), content_format)
+            report = provision(rows, dry_run=options['dry_run'], workers=options['workers'],
+                               batch_size=options['batch_size'])
+        except (OSError, ProvisioningError) as exc:
+            raise CommandError(str(exc))
+
+        self.stdout.write(f"{report['rows']} rows: {report['valid']} valid, {report['invalid']} invalid.")
+        for entry in report['errors']:
+            for field, messages in entry['errors'].items():
+                self.stdout.write(f"  row {entry['row']}: {field}: {' '.join(str(message) for message in messages)}")
+        if report['invalid']:
+            raise CommandError("Nothing was created; fix the rows above.")
+        if report['dry_run']:
+            self.stdout.write("Dry run, nothing was created.")
+            return
+        created = report['created']
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {created['patients']} patients and {created['companions']} companions "
+            f"({created['links']} linked to a patient)."
+        ))
@@ -0,0 +1,37 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Users.benchmark import SCENARIOS, regressions, run
+
+
+class Command(BaseCommand):
+    help = "Drive the API hot paths in-process and print p50/p99 latency and query counts as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                            help=f"Any of {', '.join(SCENARIOS)}; all by default.")
+        parser.add_argument('--requests', type=int, default=200, help="Measured requests per scenario.")
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--output', help="Also write the report to this file.")
+        parser.add_argument('--baseline', help="A previous report; fail if a scenario regressed against it.")
+        parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed p99 growth over the baseline.")
+
+    def handle(self, *args, **options):
+        unknown = set(options['scenarios']) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        try:
+            report = run(options['scenarios'] or SCENARIOS, options['requests'], options['warmup'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        output = json.dumps(report, indent=2)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output + '\n')
+        if options['baseline']:
+            with open(options['baseline']) as handle:
+                found = regressions(report, json.load(handle), options['tolerance'])
+            if found:
+                raise CommandError("Performance regressions:\n" + "\n".join(found))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from Users.benchmark import VOLUMES, seed
+
+
+class Command(BaseCommand):
+    help = "Bulk-insert benchmark patients, companions, locations, notifications and tasks. Use a dedicated database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0,
+                            help="Multiply every volume, e.g. 0.01 for a quick local dataset.")
+        for name, default in VOLUMES.items():
+            parser.add_argument(f'--{name}', type=int, default=default, help=f"Default {default}.")
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        volumes = {name: max(1, int(options[name] * options['scale'])) for name in VOLUMES}
+        counts = seed(**volumes, batch_size=options['batch_size'], log=self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(
+            "Seeded " + ", ".join(f"{count} {name}" for name, count in counts.items()) + "."
+        ))
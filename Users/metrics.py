@@ -0,0 +1,219 @@
+"""
+Per-route request metrics, served in the Prometheus text format.
+
+``RequestMetricsMiddleware`` (first in ``MIDDLEWARE``) times every request and
+wraps the database connections to count queries and their time; serializers
+using ``TimedSerializerMixin`` add the time spent validating and rendering.
+Everything is aggregated in-process by route pattern (``locations/``, not
+``locations/12/``), so each worker exposes its own series on ``/metrics/``
+and Prometheus sums them.
+
+Requests slower than ``METRICS_SLOW_REQUEST_MS`` are logged with their SQL.
+"""
+import hmac
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.http import Http404, HttpResponse
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('request_metrics', default=None)
+
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# Any other method token a client sends is recorded as "other", so it cannot add series
+METHODS = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'TRACE', 'CONNECT'})
+
+
+class RequestStats:
+    __slots__ = ('queries', 'db_seconds', 'serializer_seconds', 'serializer_depth', 'statements')
+
+    def __init__(self, keep_sql):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serializer_seconds = 0.0
+        self.serializer_depth = 0
+        self.statements = [] if keep_sql else None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries += 1
+            self.db_seconds += elapsed
+            if self.statements is not None and len(self.statements) < settings.METRICS_SLOW_SQL_LIMIT:
+                self.statements.append((elapsed, sql))
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            yield bound, total
+
+
+class RouteMetrics:
+    __slots__ = ('latency', 'queries', 'db_seconds', 'serializer_seconds', 'response_bytes', 'statuses')
+
+    def __init__(self):
+        self.latency = Histogram(settings.METRICS_LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.db_seconds = 0.0
+        self.serializer_seconds = 0.0
+        self.response_bytes = 0
+        self.statuses = {}
+
+
+class Registry:
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, method, status, seconds, stats, size):
+        with self._lock:
+            metrics = self._routes.get((route, method))
+            if metrics is None:
+                metrics = self._routes[(route, method)] = RouteMetrics()
+            metrics.latency.observe(seconds)
+            metrics.queries.observe(stats.queries)
+            metrics.db_seconds += stats.db_seconds
+            metrics.serializer_seconds += stats.serializer_seconds
+            metrics.response_bytes += size
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+    def render(self):
+        with self._lock:
+            routes = sorted(self._routes.items())
+            lines = []
+
+            def histogram(name, help_text, attr):
+                lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} histogram'])
+                for (route, method), metrics in routes:
+                    labels = f'route="{_escape(route)}",method="{method}"'
+                    values = getattr(metrics, attr)
+                    for bound, total in values.cumulative():
+                        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+                    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {values.count}')
+                    lines.append(f'{name}_sum{{{labels}}} {values.sum}')
+                    lines.append(f'{name}_count{{{labels}}} {values.count}')
+
+            def counter(name, help_text, attr):
+                lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} counter'])
+                for (route, method), metrics in routes:
+                    lines.append(f'{name}{{route="{_escape(route)}",method="{method}"}} {getattr(metrics, attr)}')
+
+            histogram('http_request_duration_seconds', 'Time from the first middleware to the response.', 'latency')
+            histogram('http_request_db_queries', 'Database queries per request.', 'queries')
+            counter('http_request_db_seconds_total', 'Time spent in database queries.', 'db_seconds')
+            counter('http_request_serializer_seconds_total', 'Time spent validating and rendering serializers.',
+                    'serializer_seconds')
+            counter('http_response_bytes_total', 'Response body bytes, streaming responses excluded.', 'response_bytes')
+            lines.extend(['# HELP http_responses_total Responses by status code.', '# TYPE http_responses_total counter'])
+            for (route, method), metrics in routes:
+                for status, count in sorted(metrics.statuses.items()):
+                    lines.append(f'http_responses_total{{route="{_escape(route)}",method="{method}",status="{status}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+registry = Registry()
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        slow_ms = settings.METRICS_SLOW_REQUEST_MS
+        stats = RequestStats(keep_sql=slow_ms is not None)
+        token = _current.set(stats)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        seconds = time.perf_counter() - start
+
+        match = request.resolver_match
+        route = match.route if match is not None else '<unmatched>'
+        method = request.method if request.method in METHODS else 'other'
+        if match is None or match.url_name != 'metrics':
+            size = 0 if response.streaming else len(response.content)
+            registry.record(route, method, response.status_code, seconds, stats, size)
+        if slow_ms is not None and seconds * 1000 >= slow_ms:
+            logger.warning(
+                "Slow request %s %s: %.0f ms, %d queries in %.0f ms, serializers %.0f ms\n%s",
+                request.method, request.path, seconds * 1000, stats.queries, stats.db_seconds * 1000,
+                stats.serializer_seconds * 1000,
+                '\n'.join(f'  {elapsed * 1000:.1f} ms  {sql}' for elapsed, sql in stats.statements),
+            )
+        return response
+
+
+class TimedSerializerMixin:
+    """Adds the time spent in ``run_validation`` and ``to_representation`` to the request's metrics."""
+
+    def _timed(self, method, *args, **kwargs):
+        stats = _current.get()
+        # Nested serializers run inside their parent's timing
+        if stats is None or stats.serializer_depth:
+            return method(*args, **kwargs)
+        stats.serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            stats.serializer_depth -= 1
+            stats.serializer_seconds += time.perf_counter() - start
+
+    def run_validation(self, *args, **kwargs):
+        return self._timed(super().run_validation, *args, **kwargs)
+
+    def to_representation(self, instance):
+        return self._timed(super().to_representation, instance)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; requires ``Authorization: Bearer <METRICS_TOKEN>``."""
+    token = settings.METRICS_TOKEN
+    if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        raise Http404
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,70 @@
+# Generated by Django 5.0.1 on 2026-10-18 00:41
+
+from django.db import migrations, models
+
+from Users.geo import parse_coordinates
+
+
+def backfill_coordinates(apps, schema_editor):
+    Location = apps.get_model('Users', 'Location')
+    Patient = apps.get_model('Users', 'Patient')
+
+    batch = []
+    for location in Location.objects.only('id', 'gps_coordinates').iterator(chunk_size=2000):
+        location.latitude, location.longitude = parse_coordinates(location.gps_coordinates)
+        batch.append(location)
+        if len(batch) >= 2000:
+            Location.objects.bulk_update(batch, ['latitude', 'longitude'])
+            batch = []
+    if batch:
+        Location.objects.bulk_update(batch, ['latitude', 'longitude'])
+
+    patients = []
+    for patient in Patient.objects.exclude(current_gps_location__isnull=True).only('id', 'current_gps_location'):
+        patient.current_latitude, patient.current_longitude = parse_coordinates(patient.current_gps_location)
+        patients.append(patient)
+    Patient.objects.bulk_update(patients, ['current_latitude', 'current_longitude'], batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Users', '0008_companion_last_sos_time_companion_sos_alert_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='location',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='location',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='current_latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='current_longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='profile_photo',
+            field=models.ImageField(blank=True, max_length=255, null=True, upload_to='profile_photos/'),
+        ),
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['patient', 'time_coordinates'], name='location_patient_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='location',
+            index=models.Index(fields=['latitude', 'longitude'], name='location_lat_lng_idx'),
+        ),
+        migrations.RunPython(backfill_coordinates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.1 on 2026-10-18 00:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Users', '0009_location_coordinates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('minute', 'Minute'), ('hour', 'Hour')], max_length=10)),
+                ('bucket_start', models.DateTimeField()),
+                ('fix_count', models.PositiveIntegerField()),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('min_latitude', models.FloatField()),
+                ('max_latitude', models.FloatField()),
+                ('min_longitude', models.FloatField()),
+                ('max_longitude', models.FloatField()),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='location_rollups', to='Users.patient')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='locationrollup',
+            constraint=models.UniqueConstraint(fields=('patient', 'resolution', 'bucket_start'), name='location_rollup_bucket_unique'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.1 on 2026-10-18 00:45
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def skip_past_due(apps, schema_editor):
+    # Nothing ever scheduled these; don't let the new sweeper send a backlog of stale reminders
+    now = timezone.now()
+    apps.get_model('Users', 'Reminder').objects.filter(transmission_time__lt=now).update(is_sent=True)
+    apps.get_model('Users', 'Task').objects.filter(reminder_time__lt=now, is_sent=False).update(is_sent=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Users', '0010_location_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reminder',
+            name='is_sent',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='reminder',
+            index=models.Index(condition=models.Q(('is_sent', False)), fields=['transmission_time'], name='reminder_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('is_sent', False)), fields=['reminder_time'], name='task_due_idx'),
+        ),
+        migrations.RunPython(skip_past_due, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.1 on 2026-10-18 00:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Users', '0013_list_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='companion',
+            name='profile_photo_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='account_photo_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='profile_photo_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.0.1 on 2026-10-18 00:57
+
+from collections import Counter
+
+import django.utils.timezone
+from django.db import migrations, models
+
+PHOTO_FIELDS = [
+    ('User', 'profile_photo', 'profile_photo_variants'),
+    ('Companion', 'profile_photo', 'profile_photo_variants'),
+    ('Patient', 'account_photo', 'account_photo_variants'),
+]
+
+
+def count_existing_references(apps, schema_editor):
+    # Files uploaded before this migration keep their old names; they are counted like blobs
+    refs = Counter()
+    for model_name, photo_field, variants_field in PHOTO_FIELDS:
+        model = apps.get_model('Users', model_name)
+        for photo, variants in model.objects.exclude(**{photo_field: ''}).values_list(photo_field, variants_field):
+            names = [photo] + [name for formats in (variants or {}).values() for name in formats.values()]
+            refs.update(name for name in names if name)
+    MediaBlob = apps.get_model('Users', 'MediaBlob')
+    MediaBlob.objects.bulk_create([MediaBlob(name=name, refcount=count) for name, count in refs.items()], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Users', '0014_photo_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('refcount', models.IntegerField(default=0)),
+                ('unreferenced_since', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('refcount__lte', 0)), fields=['unreferenced_since'], name='media_blob_orphan_idx')],
+            },
+        ),
+        migrations.RunPython(count_existing_references, migrations.RunPython.noop),
+    ]
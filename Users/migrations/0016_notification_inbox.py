@@ -0,0 +1,73 @@
+# Generated by Django 5.0.1 on 2026-10-18 01:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_unread(apps, schema_editor):
+    # Nothing was ever marked read, so every existing notification starts out unread
+    Notification = apps.get_model('Users', 'Notification')
+    per_user = (
+        Notification.objects.filter(user=OuterRef('pk')).order_by()
+        .values('user').annotate(total=Count('id')).values('total')
+    )
+    apps.get_model('Users', 'User').objects.update(unread_notifications=Coalesce(Subquery(per_user), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Users', '0015_media_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('original_id', models.BigIntegerField()),
+                ('transmission_time', models.DateTimeField()),
+                ('notification_type', models.CharField(choices=[('security', 'Security Alert'), ('update', 'Update'), ('reminder', 'Reminder')], max_length=20)),
+                ('message', models.TextField()),
+                ('is_read', models.BooleanField()),
+                ('read_at', models.DateTimeField(blank=True, null=True)),
+                ('archived_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='is_read',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='unread_notifications',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'id'], name='notification_user_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['transmission_time'], name='notification_time_idx'),
+        ),
+        migrations.AddField(
+            model_name='notificationarchive',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_notifications', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='notificationarchive',
+            index=models.Index(fields=['user', 'transmission_time'], name='notification_archive_user_idx'),
+        ),
+        migrations.RunPython(count_unread, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.0.1 on 2026-10-18 01:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+
+def backfill_positions(apps, schema_editor):
+    # The newest fix of every patient that has any
+    Location = apps.get_model('Users', 'Location')
+    LastKnownPosition = apps.get_model('Users', 'LastKnownPosition')
+    newest = Location.objects.filter(patient=OuterRef('pk')).order_by('-time_coordinates', '-id').values('pk')[:1]
+    location_ids = (
+        apps.get_model('Users', 'Patient').objects.annotate(newest=Subquery(newest))
+        .filter(newest__isnull=False).values_list('newest', flat=True)
+    )
+    now = timezone.now()
+    positions = (
+        LastKnownPosition(
+            patient_id=location.patient_id, location_id=location.pk, gps_coordinates=location.gps_coordinates,
+            latitude=location.latitude, longitude=location.longitude, recorded_at=location.time_coordinates,
+            updated_at=now,
+        )
+        for location in Location.objects.filter(pk__in=location_ids).iterator()
+    )
+    LastKnownPosition.objects.bulk_create(positions, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Users', '0018_geofence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LastKnownPosition',
+            fields=[
+                ('patient', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='last_position', serialize=False, to='Users.patient')),
+                ('gps_coordinates', models.CharField(max_length=255)),
+                ('latitude', models.FloatField(blank=True, null=True)),
+                ('longitude', models.FloatField(blank=True, null=True)),
+                ('recorded_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('location', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='Users.location')),
+            ],
+        ),
+        migrations.RunPython(backfill_positions, migrations.RunPython.noop),
+    ]
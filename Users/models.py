@@ -1,12 +1,35 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 from django.conf import settings
+from .geo import parse_coordinates
 
 
-class User(AbstractUser):
+class PhotoRefsMixin:
+    """Remembers the media files a row pointed at when it was loaded (see blobs.py)."""
+    photo_fields = None  # (photo field, variants field)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_photo_refs = instance.photo_refs()
+        return instance
+
+    def photo_refs(self):
+        """Names of the stored files this row uses, or None if those fields are deferred."""
+        photo_field, variants_field = self.photo_fields
+        if photo_field not in self.__dict__ or variants_field not in self.__dict__:
+            return None
+        names = {getattr(self, photo_field).name}
+        for formats in (getattr(self, variants_field) or {}).values():
+            names.update(formats.values())
+        return names - {None, ''}
+
+
+class User(PhotoRefsMixin, AbstractUser):
     ACCOUNT_TYPES = [
         ('patients', 'Patients'),
         ('companions', 'Companions'),
@@ -18,7 +41,10 @@ class User(AbstractUser):
     name = models.CharField(max_length=100)
     location = models.CharField(max_length=255, blank=True, null=True)
     creation_date = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)  # ETag/Last-Modified; set it in queryset.update() too
     profile_photo = models.ImageField(upload_to='profile_photos/', blank=True, null=True, max_length=255)
+    profile_photo_variants = models.JSONField(default=dict, blank=True)  # filled by photos.process_photo
+    unread_notifications = models.PositiveIntegerField(default=0)  # maintained by inbox.py
     
 
     USERNAME_FIELD = 'email'  # 🔥 اجعل تسجيل الدخول بالبريد الإلكتروني
@@ -27,11 +53,13 @@ class User(AbstractUser):
     groups = None
     user_permissions = None
 
+    photo_fields = ('profile_photo', 'profile_photo_variants')
+
     def __str__(self):
         return f"{self.name} ({self.account_type})"
 
 
-class Companion(models.Model):
+class Companion(PhotoRefsMixin, models.Model):
     RELATIONSHIP_CHOICES = [
         ('parent', 'Parent'),        
         ('sibling', 'Sibling'),      
@@ -51,14 +79,25 @@ class Companion(models.Model):
     relationship = models.CharField(max_length=20, choices=RELATIONSHIP_CHOICES)
     alert_settings = models.TextField(blank=True, null=True)
     profile_photo = models.ImageField(upload_to='companion_photos/', blank=True, null=True)
+    profile_photo_variants = models.JSONField(default=dict, blank=True)
     sos_alert = models.BooleanField(default=False)
     last_sos_time = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    photo_fields = ('profile_photo', 'profile_photo_variants')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # نحتفظ بالمريض الأصلي لمعرفة تغيّر الربط عند الحفظ
+        instance._loaded_patient_id = instance.__dict__.get('patient_id')
+        return instance
 
     def __str__(self):
         return f"Companions: {self.name}"
 
 
-class Patient(models.Model):
+class Patient(PhotoRefsMixin, models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='patients')  
     name = models.CharField(max_length=100)
     email = models.EmailField()
@@ -66,65 +105,192 @@ class Patient(models.Model):
     location = models.CharField(max_length=255, blank=True, null=True)
     medical_condition = models.TextField()
     account_photo = models.ImageField(upload_to='patients_photos/', blank=True, null=True)
+    account_photo_variants = models.JSONField(default=dict, blank=True)
     current_gps_location = models.CharField(max_length=255, blank=True, null=True)
+    current_latitude = models.FloatField(blank=True, null=True)
+    current_longitude = models.FloatField(blank=True, null=True)
     additional_notes = models.TextField(blank=True, null=True)
     sos_alert = models.BooleanField(default=False)
     last_sos_time = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    photo_fields = ('account_photo', 'account_photo_variants')
 
     @property
     def username(self):
         return self.user.username
 
+    def save(self, *args, **kwargs):
+        self.current_latitude, self.current_longitude = parse_coordinates(self.current_gps_location)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'current_gps_location' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'current_latitude', 'current_longitude'}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"Patients: {self.name}"
 
 
-#  إنشاء حساب مريض أو مرافق تلقائيًا عند إنشاء المستخدم
+PROFILE_SYNC_FIELDS = ('name', 'email', 'phone_number', 'location')
+
+
+#  إنشاء حساب مريض أو مرافق تلقائيًا عند إنشاء المستخدم، ثم مزامنة الحقول المشتركة عند تغيّرها فقط
 @receiver(post_save, sender=User)
-def create_profile(sender, instance, created, **kwargs):
+def sync_profile(sender, instance, created, update_fields=None, **kwargs):
+    if instance.account_type == 'patients':
+        model, accessor = Patient, 'patients'
+    elif instance.account_type == 'companions':
+        model, accessor = Companion, 'companions'
+    else:
+        return
+
+    if created:
+        # Registration may pass extra profile columns (e.g. the companion's patient) so they go in the same INSERT
+        model.objects.create(
+            user=instance,
+            **{field: getattr(instance, field) for field in PROFILE_SYNC_FIELDS},
+            **getattr(instance, '_profile_defaults', {})
+        )
+        return
+
+    # e.g. update_last_login() saves only last_login
+    if update_fields is not None and not set(update_fields) & set(PROFILE_SYNC_FIELDS):
+        return
+    profile = getattr(instance, accessor, None)
+    if profile is None:
+        return
+    changed = [field for field in PROFILE_SYNC_FIELDS if getattr(profile, field) != getattr(instance, field)]
+    if changed:
+        for field in changed:
+            setattr(profile, field, getattr(instance, field))
+        profile.save(update_fields=changed + ['updated_at'])
+
+
+# Login profile and relationship caches (see profile_cache.py and relations.py)
+def _invalidate_login_profiles(*user_ids):
+    from .profile_cache import invalidate_login_profiles
+    invalidate_login_profiles(*user_ids)
+
+
+def _linked_user_ids(user_id):
+    from .relations import links
+
+    graph = links(user_id)
+    linked = [companion['user_id'] for companion in graph['companions']]
+    if graph['patient'] is not None:
+        linked.append(graph['patient']['user_id'])
+    return linked
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_login_profile(sender, instance, **kwargs):
+    _invalidate_login_profiles(instance.pk, *_linked_user_ids(instance.pk))
+
+
+@receiver(post_save, sender=Patient)
+def invalidate_patient_login_profile(sender, instance, created, **kwargs):
     if created:
-        if instance.account_type == 'patients':
-            Patient.objects.create(
-                user=instance,
-                name=instance.name,
-                email=instance.email,
-                phone_number=instance.phone_number,
-                location=instance.location
-            )
-        elif instance.account_type == 'companions':
-            Companion.objects.create(
-                user=instance,
-                name=instance.name,
-                email=instance.email,
-                phone_number=instance.phone_number,
-                location=instance.location
-            )
+        from .relations import invalidate_links
+        invalidate_links(instance.user_id)
+    _invalidate_login_profiles(instance.user_id, *_linked_user_ids(instance.user_id))
+
+
+@receiver(pre_delete, sender=Patient)
+def invalidate_deleted_patient_links(sender, instance, **kwargs):
+    # Companions are unlinked by SET_NULL, which sends no signals of its own
+    from .relations import invalidate_links
+
+    companions = list(instance.companions.values_list('user_id', flat=True))
+    invalidate_links(instance.user_id, *companions)
+    _invalidate_login_profiles(instance.user_id, *companions)
+    if companions:
+        from .authentication import mark_claims_stale
+        mark_claims_stale(*companions)
+
+
+@receiver(post_save, sender=Companion)
+@receiver(post_delete, sender=Companion)
+def invalidate_companion_login_profile(sender, instance, created=False, **kwargs):
+    relinked = instance.patient_id != getattr(instance, '_loaded_patient_id', instance.patient_id)
+    if created or relinked or kwargs['signal'] is post_delete:
+        from .relations import invalidate_links
+
+        patient_ids = {instance.patient_id, getattr(instance, '_loaded_patient_id', None)} - {None}
+        patients = list(Patient.objects.filter(pk__in=patient_ids).values_list('user_id', flat=True))
+        invalidate_links(instance.user_id, *patients)
+    else:
+        # Same link as before, so the cached graph still names the patient
+        patients = _linked_user_ids(instance.user_id)
+    _invalidate_login_profiles(instance.user_id, *patients)
+    if relinked:
+        # patient_id in this companion's JWT claims is now wrong
+        from .authentication import mark_claims_stale
+        mark_claims_stale(instance.user_id)
+    instance._loaded_patient_id = instance.patient_id
+
+
+# Photo variants and media reference counts (see photos.py and blobs.py)
+@receiver(pre_save, sender=User)
+@receiver(pre_save, sender=Companion)
+@receiver(pre_save, sender=Patient)
+def track_photo_change(sender, instance, **kwargs):
+    photo_field, variants_field = instance.photo_fields
+    refs = getattr(instance, '_loaded_photo_refs', None)
+    photo = getattr(instance, photo_field)
+    # A new upload is still uncommitted here; the field writes it to storage after this signal
+    changed = not photo._committed or (refs is not None and (photo.name or None) not in refs | {None})
+    if instance.pk is not None and (refs is None or changed):
+        # The variants may have been filled in by the worker since this instance was loaded
+        stored = sender.objects.filter(pk=instance.pk).only(photo_field, variants_field).first()
+        refs = stored.photo_refs() if stored is not None else set()
+        changed = not photo._committed or (photo.name or None) not in refs | {None}
+    instance._loaded_photo_refs = refs or set()
+
+    if changed:
+        setattr(instance, variants_field, {})
+        instance._photo_changed = True
+    elif not photo and getattr(instance, variants_field):
+        setattr(instance, variants_field, {})
 
 
 @receiver(post_save, sender=User)
-def save_profile(sender, instance, **kwargs):
-    patient = getattr(instance, 'patients', None)
-    companion = getattr(instance, 'companions', None)
+@receiver(post_save, sender=Companion)
+@receiver(post_save, sender=Patient)
+def update_photo_refs(sender, instance, **kwargs):
+    from .blobs import release, retain
 
-    if patient:
-        patient.name = instance.name
-        patient.email = instance.email
-        patient.phone_number = instance.phone_number
-        patient.location = instance.location
-        patient.save()
+    old, new = instance._loaded_photo_refs, instance.photo_refs() or set()
+    if new != old:
+        retain(new - old)
+        release(old - new)
+    instance._loaded_photo_refs = new
+    if instance.__dict__.pop('_photo_changed', False) and getattr(instance, instance.photo_fields[0]):
+        from .photos import schedule_variants
+        schedule_variants(instance)
 
-    if companion:
-        companion.name = instance.name
-        companion.email = instance.email
-        companion.phone_number = instance.phone_number
-        companion.location = instance.location
-        companion.save()
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Companion)
+@receiver(post_delete, sender=Patient)
+def release_photo_refs(sender, instance, **kwargs):
+    from .blobs import release
+
+    refs = getattr(instance, '_loaded_photo_refs', None)
+    release(refs if refs is not None else instance.photo_refs() or ())
 
 
 class Reminder(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reminders')
     transmission_time = models.DateTimeField()
     reminder_message = models.TextField()
+    is_sent = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Due-queue: only unsent rows are indexed, so the sweeper never scans history
+            models.Index(fields=['transmission_time'], condition=models.Q(is_sent=False), name='reminder_due_idx'),
+            models.Index(fields=['user', 'transmission_time'], name='reminder_user_time_idx'),
+        ]
 
     def __str__(self):
         return f"Reminder for {self.user.username} at {self.transmission_time}"
@@ -132,13 +298,108 @@ class Reminder(models.Model):
 
 class Location(models.Model):
     gps_coordinates = models.CharField(max_length=255)
+    latitude = models.FloatField(blank=True, null=True)
+    longitude = models.FloatField(blank=True, null=True)
     time_coordinates = models.DateTimeField()
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='locations')
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', 'time_coordinates'], name='location_patient_time_idx'),
+            models.Index(fields=['time_coordinates'], name='location_time_idx'),
+            models.Index(fields=['latitude', 'longitude'], name='location_lat_lng_idx'),
+        ]
+
+    def sync_coordinates(self):
+        # latitude/longitude تُشتق دائمًا من gps_coordinates
+        self.latitude, self.longitude = parse_coordinates(self.gps_coordinates)
+
+    def save(self, *args, **kwargs):
+        self.sync_coordinates()
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"Location for {self.patient.user.username} at {self.time_coordinates}"
 
 
+class LastKnownPosition(models.Model):
+    """The newest fix per patient, kept by Users/locations.py (new, edited and deleted fixes) so reads never scan Location."""
+    patient = models.OneToOneField(Patient, on_delete=models.CASCADE, primary_key=True, related_name='last_position')
+    location = models.ForeignKey(Location, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    gps_coordinates = models.CharField(max_length=255)
+    latitude = models.FloatField(blank=True, null=True)
+    longitude = models.FloatField(blank=True, null=True)
+    recorded_at = models.DateTimeField()  # time_coordinates of the fix
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Last position of patient {self.patient_id} at {self.recorded_at}"
+
+
+class LocationRollup(models.Model):
+    RESOLUTIONS = [
+        ('minute', 'Minute'),
+        ('hour', 'Hour'),
+    ]
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='location_rollups')
+    resolution = models.CharField(max_length=10, choices=RESOLUTIONS)
+    bucket_start = models.DateTimeField()
+    fix_count = models.PositiveIntegerField()
+    latitude = models.FloatField()  # centroid
+    longitude = models.FloatField()
+    min_latitude = models.FloatField()
+    max_latitude = models.FloatField()
+    min_longitude = models.FloatField()
+    max_longitude = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['patient', 'resolution', 'bucket_start'],
+                name='location_rollup_bucket_unique'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.resolution} rollup for patient {self.patient_id} at {self.bucket_start}"
+
+
+class Geofence(models.Model):
+    """A safe zone; leaving or re-entering it notifies the patient's companions (see Users/geofences.py)."""
+    SHAPES = [
+        ('circle', 'Circle'),
+        ('polygon', 'Polygon'),
+    ]
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='geofences')
+    name = models.CharField(max_length=100)
+    shape = models.CharField(max_length=10, choices=SHAPES)
+    center_latitude = models.FloatField(blank=True, null=True)  # circle
+    center_longitude = models.FloatField(blank=True, null=True)
+    radius_m = models.FloatField(blank=True, null=True)
+    vertices = models.JSONField(default=list, blank=True)  # polygon, [[lat, lng], ...]
+    is_active = models.BooleanField(default=True)
+    # آخر حالة معروفة للمريض بالنسبة للمنطقة؛ None قبل أول موقع
+    patient_inside = models.BooleanField(blank=True, null=True)
+    state_changed_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', 'is_active'], name='geofence_patient_active_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # A fence handed to another patient must leave the old patient's cached fences too
+        instance._loaded_patient_id = instance.__dict__.get('patient_id')
+        return instance
+
+    def __str__(self):
+        return f"{self.shape} geofence {self.name} for patient {self.patient_id}"
+
+
 class Task(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='tasks')
     companion = models.ForeignKey(Companion, on_delete=models.CASCADE, related_name='tasks')  # المرافق الذي أنشأ المهمة
@@ -146,6 +407,14 @@ class Task(models.Model):
     task_description = models.TextField()
     reminder_time = models.DateTimeField()
     is_sent = models.BooleanField(default=False)  # هل تم إرسال التذكير؟ لتجنب الإرسال المتكرر
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['reminder_time'], condition=models.Q(is_sent=False), name='task_due_idx'),
+            models.Index(fields=['patient', 'reminder_time'], name='task_patient_time_idx'),
+            models.Index(fields=['companion', 'reminder_time'], name='task_companion_time_idx'),
+        ]
 
     def __str__(self):
         return f"Task: {self.task_name} for {self.patient.user.username} by {self.companion.name}"
@@ -161,10 +430,103 @@ class Notification(models.Model):
     transmission_time = models.DateTimeField()
     notification_type = models.CharField(max_length=20, choices=NOTIFICATION_TYPES)
     message = models.TextField()
+    # تغيير حالة القراءة يتم فقط عبر inbox.mark_read حتى يبقى العداد صحيحًا
+    is_read = models.BooleanField(default=False)
+    read_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'transmission_time'], name='notification_user_time_idx'),
+            models.Index(fields=['notification_type', 'transmission_time'], name='notification_type_time_idx'),
+            models.Index(fields=['user', 'id'], name='notification_user_id_idx'),  # since-cursor sync
+            models.Index(fields=['transmission_time'], name='notification_time_idx'),  # retention
+        ]
 
     def __str__(self):
         return f"{self.notification_type} for {self.user.username} at {self.transmission_time}"
-    
-    
-   
-    
+
+
+@receiver(post_save, sender=Geofence)
+@receiver(post_delete, sender=Geofence)
+def invalidate_geofence_index(sender, instance, **kwargs):
+    from .geofences import invalidate_fences
+
+    invalidate_fences(*{instance.patient_id, getattr(instance, '_loaded_patient_id', None)} - {None})
+    instance._loaded_patient_id = instance.patient_id
+
+
+@receiver(post_save, sender=Notification)
+def count_unread_notification(sender, instance, created, **kwargs):
+    # bulk inserts go through inbox.deliver, which counts them itself
+    if created and not instance.is_read:
+        User.objects.filter(pk=instance.user_id).update(unread_notifications=models.F('unread_notifications') + 1)
+
+
+class NotificationArchive(models.Model):
+    original_id = models.BigIntegerField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_notifications')
+    transmission_time = models.DateTimeField()
+    notification_type = models.CharField(max_length=20, choices=Notification.NOTIFICATION_TYPES)
+    message = models.TextField()
+    is_read = models.BooleanField()
+    read_at = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'transmission_time'], name='notification_archive_user_idx'),
+        ]
+
+    def __str__(self):
+        return f"Archived {self.notification_type} for user {self.user_id} at {self.transmission_time}"
+
+
+class OutboundEmail(models.Model):
+    # طابور البريد الصادر: الصف يُحذف بعد الإرسال بنجاح
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    recipients = models.JSONField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at'], name='outbound_email_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"Email '{self.subject}' to {', '.join(self.recipients)}"
+
+
+class MediaBlob(models.Model):
+    # ملف مخزَّن حسب محتواه (storage.py)؛ يُحذف بعد أن يبقى بلا مراجع لفترة
+    name = models.CharField(max_length=255, unique=True)
+    refcount = models.IntegerField(default=0)
+    unreferenced_since = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['unreferenced_since'], condition=models.Q(refcount__lte=0), name='media_blob_orphan_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} refs)"
+
+
+class DeadLetterEmail(models.Model):
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    recipients = models.JSONField()
+    attempts = models.PositiveSmallIntegerField()
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField()
+    failed_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Undeliverable email '{self.subject}' to {', '.join(self.recipients)}"
+
@@ -0,0 +1,21 @@
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor (keyset) pagination for every list endpoint.
+
+    Views set ``cursor_ordering`` to a field (or tuple of fields) that is
+    backed by an index, so each page is an index range scan rather than an
+    OFFSET over the whole table.
+    """
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = '-id'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, 'cursor_ordering', self.ordering)
+        if isinstance(ordering, str):
+            return (ordering,)
+        return tuple(ordering)
@@ -0,0 +1,147 @@
+"""
+Resized variants of profile and account photos.
+
+Uploads bigger than ``FILE_UPLOAD_MAX_MEMORY_SIZE`` are spooled to a
+temporary file by Django and moved into ``MEDIA_ROOT`` on save, so a request
+never holds or decodes a whole photo. When a photo field changes, the
+receivers in ``Users/models.py`` queue ``process_photo`` once the transaction
+commits; the worker renders every size in ``PHOTO_VARIANT_SIZES`` as WebP and
+JPEG and records their names in the model's ``*_variants`` field. Replaced
+files are released through ``Users/blobs.py``, not deleted here.
+"""
+import logging
+import posixpath
+from io import BytesIO
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .blobs import register, retain
+from .models import Companion, Patient, User
+
+logger = logging.getLogger(__name__)
+
+# model label -> (photo field, variants field)
+PHOTO_FIELDS = {model._meta.label: model.photo_fields for model in (User, Companion, Patient)}
+
+FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+
+
+def variant_name(name, size_label, ext):
+    directory, base = posixpath.split(posixpath.splitext(name)[0])
+    return posixpath.join(directory, 'variants', f'{base}_{size_label}.{ext}')
+
+
+def variant_files(variants):
+    return [name for formats in variants.values() for name in formats.values()]
+
+
+def variant_urls(variants, request=None):
+    """``{size: {format: name}}`` -> the same mapping with URLs."""
+    def url(name):
+        location = default_storage.url(name)
+        return request.build_absolute_uri(location) if request is not None else location
+
+    return {size: {ext: url(name) for ext, name in formats.items()} for size, formats in variants.items()}
+
+
+def render_variants(source):
+    """Return ``{size: {format: bytes}}`` for an image file object."""
+    sizes = sorted(settings.PHOTO_VARIANT_SIZES.items(), key=lambda item: item[1], reverse=True)
+    rendered = {}
+    with Image.open(source) as image:
+        # JPEG sources are decoded at a reduced scale when they are much larger than needed
+        image.draft('RGB', (sizes[0][1], sizes[0][1]))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        # Largest first, each size is scaled down from the previous one
+        for size_label, edge in sizes:
+            image.thumbnail((edge, edge), Image.LANCZOS)
+            rendered[size_label] = {}
+            for ext, pil_format in FORMATS.items():
+                buffer = BytesIO()
+                image.save(buffer, pil_format, quality=settings.PHOTO_VARIANT_QUALITY, optimize=True)
+                rendered[size_label][ext] = buffer.getvalue()
+    return rendered
+
+
+def _owner_user_id(label, pk):
+    if label == 'Users.User':
+        return pk
+    return apps.get_model(label).objects.filter(pk=pk).values_list('user_id', flat=True).first()
+
+
+def generate_variants(label, pk, name):
+    """
+    Build the variants of ``name`` for row ``pk`` of ``label``. Returns the
+    stored variants, or None if the row has moved on to another photo, already
+    has variants or the file is not a readable image.
+    """
+    from .profile_cache import invalidate_login_profiles
+
+    model = apps.get_model(label)
+    photo_field, variants_field = PHOTO_FIELDS[label]
+    try:
+        with default_storage.open(name) as source:
+            rendered = render_variants(source)
+    except OSError:
+        logger.warning("Could not build variants of %s for %s %s", name, label, pk, exc_info=True)
+        return None
+
+    variants = {
+        size_label: {
+            ext: default_storage.save(variant_name(name, size_label, ext), ContentFile(data))
+            for ext, data in formats.items()
+        }
+        for size_label, formats in rendered.items()
+    }
+    # Only attach them if the photo was not replaced (or processed by a sweep) while we were rendering
+    with transaction.atomic():
+        updated = (
+            model.objects.filter(pk=pk, **{photo_field: name, variants_field: {}})
+            .update(**{variants_field: variants, 'updated_at': timezone.now()})
+        )
+        if updated:
+            retain(variant_files(variants))
+        else:
+            # Unreferenced; left for the garbage collector
+            register(variant_files(variants))
+            return None
+    invalidate_login_profiles(_owner_user_id(label, pk))
+    return variants
+
+
+def _dispatch(label, pk, name):
+    from .tasks import process_photo
+
+    try:
+        process_photo.apply_async((label, pk, name), retry=False)
+    except Exception:
+        logger.warning("Could not reach the Celery broker; variants of %s will be built by the next sweep", name)
+
+
+def schedule_variants(instance):
+    """Queue variant generation for ``instance``'s current photo after commit."""
+    label = instance._meta.label
+    args = (label, instance.pk, getattr(instance, instance.photo_fields[0]).name)
+    transaction.on_commit(lambda: _dispatch(*args))
+
+
+def build_missing_variants(limit=100):
+    """Safety net for uploads whose task never ran; returns how many were built."""
+    built = 0
+    for label, (photo_field, variants_field) in PHOTO_FIELDS.items():
+        rows = (
+            apps.get_model(label).objects
+            .exclude(**{photo_field: ''}).exclude(**{f'{photo_field}__isnull': True})
+            .filter(**{variants_field: {}})
+            .values_list('pk', photo_field)[:limit]
+        )
+        for pk, name in rows:
+            if generate_variants(label, pk, name) is not None:
+                built += 1
+    return built
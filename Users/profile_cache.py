@@ -0,0 +1,87 @@
+"""
+Cached user payload returned by ``/auth/login/``.
+
+The snapshot is rebuilt on a cache miss and dropped by the post_save /
+post_delete receivers in ``Users/models.py`` whenever the user, their
+profile or the companion-patient link changes.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Companion, Patient
+from .photos import variant_urls
+from .relations import links
+
+KEY = 'login-profile:{}'
+
+
+def _photo_url(field):
+    return field.url if field else None
+
+
+def build_login_profile(user):
+    user_data = {
+        "id": user.id,
+        "name": user.name,
+        "email": user.email,
+        "account_type": user.account_type,
+        "phone_number": user.phone_number,
+        "location": user.location,
+        "username": user.username,
+        "profile_photo": _photo_url(user.profile_photo),
+        "profile_photo_variants": variant_urls(user.profile_photo_variants),
+    }
+
+    graph = links(user.pk)
+    companion = None
+    if 'companion_id' in graph:
+        companion = Companion.objects.select_related('patient__user').filter(pk=graph['companion_id']).first()
+    if companion is not None:
+        patient = companion.patient
+        user_data["companion_id"] = companion.pk
+        user_data["patient_id"] = companion.patient_id
+        user_data["relationship"] = companion.relationship
+        user_data["patient_username"] = patient.user.username if patient else None
+        user_data["linked_patient_type"] = patient.name if patient else None
+        return user_data
+
+    patient = Patient.objects.filter(pk=graph['patient_id']).first() if graph.get('patient_id') else None
+    if patient is not None:
+        user_data["patient_id"] = patient.pk
+        user_data["companion_id"] = None
+        user_data["medical_condition"] = patient.medical_condition
+        user_data["account_photo"] = _photo_url(patient.account_photo)
+        user_data["account_photo_variants"] = variant_urls(patient.account_photo_variants)
+        user_data["current_gps_location"] = patient.current_gps_location
+        user_data["additional_notes"] = patient.additional_notes
+
+        linked = graph['companions']
+        first_companion = (
+            Companion.objects.select_related('user').filter(pk=linked[0]['companion_id']).first() if linked else None
+        )
+        if first_companion:
+            user_data["linked_companion_name"] = first_companion.user.username
+            user_data["relationship"] = first_companion.relationship
+        else:
+            user_data["linked_companion_name"] = None
+            user_data["relationship"] = None
+
+    return user_data
+
+
+def get_login_profile(user):
+    key = KEY.format(user.pk)
+    user_data = cache.get(key)
+    if user_data is None:
+        user_data = build_login_profile(user)
+        cache.set(key, user_data, settings.LOGIN_PROFILE_CACHE_TIMEOUT)
+    return user_data
+
+
+def invalidate_login_profiles(*user_ids):
+    keys = [KEY.format(user_id) for user_id in user_ids if user_id is not None]
+    if keys:
+        cache.delete_many(keys)
+        # Again after commit, in case a concurrent login cached the pre-commit profile meanwhile
+        transaction.on_commit(lambda: cache.delete_many(keys))
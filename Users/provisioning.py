@@ -0,0 +1,191 @@
+"""
+Bulk provisioning of patients, companions and their links.
+
+Registering a facility one account at a time costs a PBKDF2 hash, two
+post_save receivers and a patient lookup per user. ``provision`` instead
+validates the whole batch up front (per-row checks, then uniqueness against
+the batch and the database in one query per column), hashes the passwords
+(in a process pool of ``PROVISION_HASH_WORKERS`` for the management
+command, in-process for the capped API) and inserts users, profiles and
+links with ``bulk_create`` in a single transaction. Nothing is written
+when any row is invalid or on a dry run; the report says why.
+
+Companions name their patient by ``patient_username``, which may be an
+existing patient or one created by the same batch. ``bulk_create`` sends no
+signals, so the profile rows ``sync_profile`` would create are inserted
+here, and the cached links of existing patients that gained companions are
+dropped by hand. Provisioned accounts have no photos, so there are no media
+references to count.
+"""
+import csv
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import IntegrityError, transaction
+
+from .models import PROFILE_SYNC_FIELDS, Companion, Patient, User
+from .profile_cache import invalidate_login_profiles
+from .relations import invalidate_links
+from .serializers import ProvisionRowSerializer
+
+UNIQUE_FIELDS = ('username', 'email', 'phone_number')
+
+
+class ProvisioningError(ValueError):
+    pass
+
+
+def parse(content, content_format):
+    """Rows of a ``csv`` (with a header line) or ``json`` (a list of objects) document."""
+    if isinstance(content, bytes):
+        content = content.decode('utf-8-sig')
+    if content_format == 'csv':
+        return list(csv.DictReader(io.StringIO(content), restval=''))
+    if content_format == 'json':
+        try:
+            rows = json.loads(content)
+        except ValueError as exc:
+            raise ProvisioningError(f"Invalid JSON: {exc}")
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ProvisioningError("Expected a JSON list of objects.")
+        return rows
+    raise ProvisioningError(f"Unknown format {content_format}, expected csv or json.")
+
+
+def validate(rows):
+    """
+    ``(valid, errors, existing)``: ``(row number, cleaned row)`` pairs,
+    ``{row number: errors}`` for the rejected rows, and the ids of the
+    already registered patients the companions name.
+    """
+    errors = {}
+    accounts = {}
+    for number, row in enumerate(rows, start=1):
+        serializer = ProvisionRowSerializer(data=row)
+        if not serializer.is_valid():
+            errors[number] = serializer.errors
+            continue
+        account = serializer.validated_data
+        account['username'] = User.normalize_username(account['username'])
+        account['email'] = User.objects.normalize_email(account['email'])
+        accounts[number] = account
+
+    # Uniqueness within the batch, then against the database with one query per column
+    for field in UNIQUE_FIELDS:
+        seen = {}
+        for number, account in accounts.items():
+            value = account[field]
+            if value in seen:
+                errors.setdefault(number, {})[field] = [f"Duplicate of row {seen[value]}."]
+            else:
+                seen[value] = number
+        taken = set(User.objects.filter(**{f'{field}__in': seen}).values_list(field, flat=True))
+        for value in taken:
+            errors.setdefault(seen[value], {})[field] = ["Already registered."]
+
+    batch_patients = {
+        account['username'] for account in accounts.values() if account['account_type'] == 'patients'
+    }
+    wanted = {
+        account['patient_username'] for account in accounts.values() if account['patient_username']
+    } - batch_patients
+    existing = dict(
+        Patient.objects.filter(user__username__in=wanted).values_list('user__username', 'id')
+    ) if wanted else {}
+    for number, account in accounts.items():
+        patient_username = account['patient_username']
+        if patient_username and patient_username not in batch_patients and patient_username not in existing:
+            errors.setdefault(number, {})['patient_username'] = ["Patient not found."]
+
+    valid = [(number, account) for number, account in accounts.items() if number not in errors]
+    return valid, dict(sorted(errors.items())), existing
+
+
+def _hash(password):
+    return make_password(password)
+
+
+def _init_worker():
+    # Spawned (not forked) workers start without Django configured
+    import django
+    django.setup()
+
+
+def hash_passwords(passwords, workers=None):
+    """``make_password`` for each password, across ``workers`` processes (in-process for 0 or 1)."""
+    workers = workers if workers is not None else settings.PROVISION_HASH_WORKERS or os.cpu_count()
+    if workers <= 1 or len(passwords) < 2:
+        return [make_password(password) for password in passwords]
+    with ProcessPoolExecutor(max_workers=min(workers, len(passwords)), initializer=_init_worker) as pool:
+        return list(pool.map(_hash, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def provision(rows, dry_run=False, workers=None, batch_size=None):
+    """Validate ``rows`` and, unless invalid or ``dry_run``, create every account. Returns the report."""
+    batch_size = batch_size or settings.PROVISION_BATCH_SIZE
+    valid, errors, existing = validate(rows)
+    report = {
+        'rows': len(rows),
+        'valid': len(valid),
+        'invalid': len(errors),
+        'errors': [{'row': number, 'errors': row_errors} for number, row_errors in errors.items()],
+        'dry_run': dry_run,
+        'created': {'patients': 0, 'companions': 0, 'links': 0},
+    }
+    if errors or dry_run or not valid:
+        return report
+
+    accounts = [account for _number, account in valid]
+    passwords = hash_passwords([account['password'] for account in accounts], workers)
+    users = [
+        User(username=account['username'], email=account['email'], password=password,
+             account_type=account['account_type'], phone_number=account['phone_number'],
+             name=account['name'], location=account['location'])
+        for account, password in zip(accounts, passwords)
+    ]
+
+    try:
+        with transaction.atomic():
+            patients, companions = _insert(users, accounts, existing, batch_size)
+    except IntegrityError as exc:
+        # An account registered since validation took one of the usernames, emails or phone numbers
+        raise ProvisioningError(f"Nothing was created, an account conflicts: {exc}")
+
+    report['created'] = {
+        'patients': len(patients),
+        'companions': len(companions),
+        'links': sum(companion.patient_id is not None for companion in companions),
+    }
+    return report
+
+
+def _insert(users, accounts, existing, batch_size):
+    User.objects.bulk_create(users, batch_size=batch_size)
+    patients = Patient.objects.bulk_create([
+        Patient(user_id=user.pk, medical_condition=account['medical_condition'],
+                **{field: getattr(user, field) for field in PROFILE_SYNC_FIELDS})
+        for user, account in zip(users, accounts) if account['account_type'] == 'patients'
+    ], batch_size=batch_size)
+    patient_ids = {**existing, **{
+        user.username: patient.pk for user, patient in
+        zip((user for user in users if user.account_type == 'patients'), patients)
+    }}
+    companions = Companion.objects.bulk_create([
+        Companion(user_id=user.pk, patient_id=patient_ids.get(account['patient_username']),
+                  relationship=account['relationship'],
+                  **{field: getattr(user, field) for field in PROFILE_SYNC_FIELDS})
+        for user, account in zip(users, accounts) if account['account_type'] == 'companions'
+    ], batch_size=batch_size)
+
+    # The links cached for existing patients no longer list all their companions
+    linked = {companion.patient_id for companion in companions} & set(existing.values())
+    if linked:
+        patient_users = list(Patient.objects.filter(pk__in=linked).values_list('user_id', flat=True))
+        invalidate_links(*patient_users)
+        invalidate_login_profiles(*patient_users)
+
+    return patients, companions
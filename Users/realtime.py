@@ -0,0 +1,251 @@
+"""
+Push channel for companion apps.
+
+Views publish SOS, reminder and location events to a per-patient group; the
+ASGI websocket handler (mounted in ``MY_Sight/asgi.py`` at ``/ws/events/``)
+forwards them to every connected subscriber of that patient.
+
+The broker is chosen with ``REALTIME_BROKER``. ``InMemoryBroker`` only reaches
+sockets served by the same process, so deployments with several ASGI workers
+or publishing from Celery should use ``RedisBroker``.
+"""
+import asyncio
+import json
+import logging
+import threading
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_PATH = '/ws/events/'
+
+
+def group_for_patient(patient_id):
+    return f'patient.{patient_id}'
+
+
+class InMemorySubscription:
+    def __init__(self, broker, group, maxsize):
+        self.broker = broker
+        self.group = group
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def offer(self, message):
+        # Runs on the subscriber's loop; a slow client loses its oldest events
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+    async def close(self):
+        self.broker._unsubscribe(self)
+
+
+class InMemoryBroker:
+    """Process-local pub/sub, safe to publish to from any thread."""
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._groups = defaultdict(set)
+        self._lock = threading.Lock()
+
+    async def subscribe(self, group):
+        subscription = InMemorySubscription(self, group, self.maxsize)
+        with self._lock:
+            self._groups[group].add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            members = self._groups.get(subscription.group)
+            if members is not None:
+                members.discard(subscription)
+                if not members:
+                    del self._groups[subscription.group]
+
+    def publish(self, group, message):
+        with self._lock:
+            subscribers = list(self._groups.get(group, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, message)
+            except RuntimeError:
+                # Loop already closed; the socket is going away
+                self._unsubscribe(subscription)
+
+
+class RedisSubscription:
+    def __init__(self, client, pubsub):
+        self.client = client
+        self.pubsub = pubsub
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            item = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+            if item is not None:
+                data = item['data']
+                return data.decode() if isinstance(data, bytes) else data
+
+    async def close(self):
+        await self.pubsub.aclose()
+        await self.client.aclose()
+
+
+class RedisBroker:
+    """Pub/sub over Redis channels, shared by every web and Celery process."""
+
+    def __init__(self, url=None):
+        self.url = url or settings.REALTIME_REDIS_URL
+        self._client = None
+
+    async def subscribe(self, group):
+        import redis.asyncio as aioredis
+
+        client = aioredis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(group)
+        return RedisSubscription(client, pubsub)
+
+    def publish(self, group, message):
+        import redis
+
+        if self._client is None:
+            self._client = redis.Redis.from_url(self.url)
+        self._client.publish(group, message)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(settings.REALTIME_BROKER)()
+    return _broker
+
+
+def publish_event(patient_id, event, data):
+    """
+    Publish ``event`` to everyone subscribed to ``patient_id`` once the
+    current transaction commits. Delivery is best effort.
+    """
+    message = json.dumps({
+        'type': event,
+        'patient': patient_id,
+        'data': data,
+        'sent_at': timezone.now(),
+    }, cls=DjangoJSONEncoder)
+    group = group_for_patient(patient_id)
+
+    def send():
+        try:
+            get_broker().publish(group, message)
+        except Exception:
+            logger.exception("Failed to publish %s event for patient %s", event, patient_id)
+
+    transaction.on_commit(send)
+
+
+@sync_to_async
+def _authorize(token, requested_patient):
+    """Return the patient id the token holder may follow, or None."""
+    from rest_framework_simplejwt.exceptions import TokenError
+    from rest_framework_simplejwt.settings import api_settings
+    from rest_framework_simplejwt.tokens import AccessToken
+    from .authentication import token_state
+    from .models import User
+
+    if not token:
+        return None
+    try:
+        token = AccessToken(token)
+        user_id = token[api_settings.USER_ID_CLAIM]
+    except (TokenError, KeyError):
+        return None
+
+    revoked, stale = token_state(token)
+    if revoked:
+        return None
+    if not stale and 'patient_id' in token:
+        patient_id = token['patient_id']
+        if patient_id is None or (requested_patient and str(requested_patient) != str(patient_id)):
+            return None
+        return patient_id
+
+    user = User.objects.select_related('patients', 'companions').filter(pk=user_id, is_active=True).first()
+    if user is None:
+        return None
+    if user.account_type == 'companions' and hasattr(user, 'companions'):
+        patient_id = user.companions.patient_id
+    elif user.account_type == 'patients' and hasattr(user, 'patients'):
+        patient_id = user.patients.pk
+    else:
+        return None
+
+    if patient_id is None or (requested_patient and str(requested_patient) != str(patient_id)):
+        return None
+    return patient_id
+
+
+async def websocket_application(scope, receive, send):
+    """
+    ASGI handler for ``/ws/events/?token=<access token>[&patient=<id>]``.
+
+    Sends every event published for the caller's patient as a JSON text
+    frame; replies ``pong`` to ``ping``.
+    """
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    if scope.get('path') != WEBSOCKET_PATH:
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+
+    params = parse_qs(scope.get('query_string', b'').decode())
+    patient_id = await _authorize(params.get('token', [None])[0], params.get('patient', [None])[0])
+    if patient_id is None:
+        await send({'type': 'websocket.close', 'code': 4403})
+        return
+
+    subscription = await get_broker().subscribe(group_for_patient(patient_id))
+    await send({'type': 'websocket.accept'})
+
+    async def forward():
+        async for message in subscription:
+            await send({'type': 'websocket.send', 'text': message})
+
+    forwarder = asyncio.ensure_future(forward())
+    try:
+        while True:
+            event = await receive()
+            if event['type'] == 'websocket.disconnect':
+                break
+            if event['type'] == 'websocket.receive' and event.get('text') == 'ping':
+                await send({'type': 'websocket.send', 'text': 'pong'})
+    finally:
+        forwarder.cancel()
+        try:
+            await forwarder
+        except asyncio.CancelledError:
+            pass
+        await subscription.close()
@@ -0,0 +1,65 @@
+"""
+Read-through cache of the companion <-> patient links, keyed by user id.
+
+A patient's entry lists their companions, a companion's entry names their
+patient; both hold ids only, so they change only when a link does. The
+receivers in ``Users/models.py`` call ``invalidate_links`` whenever a
+companion is created, re-linked or deleted and when a patient is created or
+deleted.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Companion, Patient
+
+KEY = 'relations:{}'
+
+
+def build_links(user_id):
+    companion = (
+        Companion.objects.filter(user_id=user_id)
+        .values('id', 'patient_id', 'patient__user_id').first()
+    )
+    if companion is not None:
+        patient = None
+        if companion['patient_id'] is not None:
+            patient = {'patient_id': companion['patient_id'], 'user_id': companion['patient__user_id']}
+        return {'companion_id': companion['id'], 'patient': patient, 'companions': []}
+
+    patient_id = Patient.objects.filter(user_id=user_id).values_list('id', flat=True).first()
+    companions = []
+    if patient_id is not None:
+        companions = [
+            {'companion_id': companion_id, 'user_id': companion_user_id}
+            for companion_id, companion_user_id in
+            Companion.objects.filter(patient_id=patient_id).order_by('id').values_list('id', 'user_id')
+        ]
+    return {'patient_id': patient_id, 'patient': None, 'companions': companions}
+
+
+def links(user_id):
+    key = KEY.format(user_id)
+    graph = cache.get(key)
+    if graph is None:
+        graph = build_links(user_id)
+        cache.set(key, graph, settings.RELATION_CACHE_TIMEOUT)
+    return graph
+
+
+def companions_of_patient(user_id):
+    """``[{'companion_id', 'user_id'}, ...]`` linked to the patient with this user id, oldest first."""
+    return links(user_id)['companions']
+
+
+def patient_of_companion(user_id):
+    """``{'patient_id', 'user_id'}`` of the companion's patient, or None."""
+    return links(user_id)['patient']
+
+
+def invalidate_links(*user_ids):
+    keys = [KEY.format(user_id) for user_id in user_ids if user_id is not None]
+    if keys:
+        cache.delete_many(keys)
+        # Again after commit, in case a concurrent request cached the old links meanwhile
+        transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,135 @@
+"""
+Route summaries for a patient's location history.
+
+A route is built from the same points ``/locations/history/`` serves (raw
+fixes for short recent ranges, minute or hour rollups for longer ones, see
+``history.choose_resolution``), so a week costs at most ~10^4 points. All
+distances are computed on NumPy arrays: the total distance is one vectorized
+haversine over consecutive points, dwells are runs of short steps found with
+array ops, and the polyline is simplified with Douglas-Peucker on a local
+metric projection, one vectorized distance pass per kept vertex.
+"""
+import numpy as np
+
+from .geo import EARTH_RADIUS_M
+from .history import choose_resolution, location_history
+from .models import Location
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    """Element-wise great-circle distance in metres between arrays of points."""
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = np.radians(np.asarray(lng2) - np.asarray(lng1))
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def project(lat, lng):
+    """Equirectangular projection to metres around the track's mean latitude."""
+    cos_lat = np.cos(np.radians(lat.mean()))
+    return np.radians(lng) * EARTH_RADIUS_M * cos_lat, np.radians(lat) * EARTH_RADIUS_M
+
+
+def simplify(x, y, tolerance_m):
+    """Indices kept by Douglas-Peucker at ``tolerance_m`` (always the first and last point)."""
+    n = len(x)
+    if n <= 2 or tolerance_m <= 0:
+        return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(dx * py - dy * px) / length
+        index = int(distances.argmax())
+        if distances[index] > tolerance_m:
+            split = first + 1 + index
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return np.flatnonzero(keep)
+
+
+def find_dwells(seconds, lat, lng, steps, radius_m, min_seconds):
+    """
+    ``(start, end)`` index pairs where every step is shorter than ``radius_m``
+    for at least ``min_seconds`` and no point strays more than ``radius_m``
+    from the run's centroid (which rules out a slow walk).
+    """
+    still = np.concatenate([[False], steps < radius_m, [False]]).astype(np.int8)
+    edges = np.diff(still)
+    # Run of short steps k..m-1 covers points k..m
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    long_enough = seconds[ends] - seconds[starts] >= min_seconds
+    dwells = []
+    for start, end in zip(starts[long_enough], ends[long_enough]):
+        run = slice(start, end + 1)
+        spread = haversine_m(lat[run], lng[run], lat[run].mean(), lng[run].mean())
+        if spread.max() <= radius_m:
+            dwells.append((int(start), int(end)))
+    return dwells
+
+
+def _track(patient_id, start, end, now=None):
+    """``(resolution, times, lat, lng, counts)`` for the range, ordered by time."""
+    resolution = choose_resolution(start, end, now)
+    if resolution == 'raw':
+        rows = list(
+            Location.objects.filter(
+                patient_id=patient_id, time_coordinates__gte=start, time_coordinates__lt=end,
+                latitude__isnull=False, longitude__isnull=False,
+            ).order_by('time_coordinates').values_list('time_coordinates', 'latitude', 'longitude')
+        )
+        times = [row[0] for row in rows]
+        coords = np.array([row[1:] for row in rows], dtype=float).reshape(-1, 2)
+        counts = np.ones(len(rows), dtype=int)
+    else:
+        resolution, points = location_history(patient_id, start, end, now)
+        times = [point['time'] for point in points]
+        coords = np.array([(point['latitude'], point['longitude']) for point in points], dtype=float).reshape(-1, 2)
+        counts = np.array([point['count'] for point in points], dtype=int)
+    return resolution, times, coords[:, 0], coords[:, 1], counts
+
+
+def build_route(patient_id, start, end, tolerance_m, dwell_radius_m, dwell_minutes, now=None):
+    resolution, times, lat, lng, counts = _track(patient_id, start, end, now)
+    route = {
+        'resolution': resolution,
+        'fix_count': int(counts.sum()),
+        'point_count': len(times),
+        'distance_m': 0.0,
+        'polyline': [],
+        'dwells': [],
+    }
+    if not times:
+        return route
+
+    seconds = np.fromiter((t.timestamp() for t in times), dtype=float, count=len(times))
+    steps = haversine_m(lat[:-1], lng[:-1], lat[1:], lng[1:])
+    route['distance_m'] = round(float(steps.sum()), 1)
+
+    kept = simplify(*project(lat, lng), tolerance_m)
+    route['polyline'] = [
+        {'time': times[i], 'latitude': round(float(lat[i]), 6), 'longitude': round(float(lng[i]), 6)}
+        for i in kept
+    ]
+    for first, last in find_dwells(seconds, lat, lng, steps, dwell_radius_m, dwell_minutes * 60):
+        run = slice(first, last + 1)
+        route['dwells'].append({
+            'latitude': round(float(lat[run].mean()), 6),
+            'longitude': round(float(lng[run].mean()), 6),
+            'start': times[first],
+            'end': times[last],
+            'duration_s': round(float(seconds[last] - seconds[first]), 1),
+            'fix_count': int(counts[run].sum()),
+        })
+    return route
@@ -0,0 +1,140 @@
+"""
+Due-queue sweeper for ``Task`` and ``Reminder`` rows.
+
+Instead of one Celery ETA message per task, a periodic sweep claims due,
+unsent rows in batches with ``select_for_update(skip_locked=True)``, marks
+them sent, creates their notifications in bulk and queues their emails in
+the outbox (``Users/mail.py``), which delivers them over one connection. Rows claimed by one worker are skipped by the others, and
+a row is only ever marked sent once, so running several sweepers is safe.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .inbox import deliver
+from .mail import enqueue_emails
+from .models import Notification, Reminder, Task
+from .realtime import publish_event
+
+
+def _claim(model, time_field, now, batch_size):
+    """Lock and mark up to ``batch_size`` due rows; must run inside a transaction."""
+    ids = list(
+        model.objects.select_for_update(skip_locked=True)
+        .filter(is_sent=False, **{f'{time_field}__lte': now})
+        .order_by(time_field)
+        .values_list('id', flat=True)[:batch_size]
+    )
+    if ids:
+        changes = {'is_sent': True}
+        if model is Task:
+            changes['updated_at'] = now
+        model.objects.filter(id__in=ids, is_sent=False).update(**changes)
+    return ids
+
+
+def _task_messages(tasks, now):
+    notifications, emails = [], []
+    for task in tasks:
+        notifications.append(Notification(
+            user_id=task.patient.user_id,
+            transmission_time=now,
+            notification_type='reminder',
+            message=f"Task Reminder: {task.task_name}"
+        ))
+        emails.append((
+            f'Task Reminder: {task.task_name}',
+            f'This is a reminder for your task: {task.task_description}',
+            settings.EMAIL_HOST_USER,
+            [task.companion.user.email],
+        ))
+    return notifications, emails
+
+
+def _reminder_messages(reminders, now):
+    notifications, emails = [], []
+    for reminder in reminders:
+        notifications.append(Notification(
+            user_id=reminder.user_id,
+            transmission_time=now,
+            notification_type='reminder',
+            message=reminder.reminder_message
+        ))
+        emails.append((
+            'Reminder',
+            reminder.reminder_message,
+            settings.EMAIL_HOST_USER,
+            [reminder.user.email],
+        ))
+    return notifications, emails
+
+
+def _deliver_tasks(ids, now):
+    tasks = list(Task.objects.filter(id__in=ids).select_related('patient', 'companion__user'))
+    notifications, emails = _task_messages(tasks, now)
+    deliver(notifications)
+    # Queued in the same transaction as the claim, so each email is queued exactly once
+    enqueue_emails(emails)
+    for task in tasks:
+        publish_event(task.patient_id, 'reminder', {
+            'task_id': task.id,
+            'task_name': task.task_name,
+            'reminder_time': task.reminder_time,
+        })
+
+
+def sweep_due_tasks(now=None, batch_size=None):
+    """Send one batch of due task reminders; returns how many were claimed."""
+    now = now or timezone.now()
+    batch_size = batch_size or settings.REMINDER_SWEEP_BATCH_SIZE
+    with transaction.atomic():
+        ids = _claim(Task, 'reminder_time', now, batch_size)
+        if ids:
+            _deliver_tasks(ids, now)
+    return len(ids)
+
+
+def send_task_now(task_id):
+    """Send a single task's reminder unless a sweep already has; returns True if sent."""
+    with transaction.atomic():
+        claimed = Task.objects.filter(id=task_id, is_sent=False).update(is_sent=True, updated_at=timezone.now())
+        if claimed:
+            _deliver_tasks([task_id], timezone.now())
+    return bool(claimed)
+
+
+def sweep_due_reminders(now=None, batch_size=None):
+    """Send one batch of due ``Reminder`` rows; returns how many were claimed."""
+    now = now or timezone.now()
+    batch_size = batch_size or settings.REMINDER_SWEEP_BATCH_SIZE
+    with transaction.atomic():
+        ids = _claim(Reminder, 'transmission_time', now, batch_size)
+        if not ids:
+            return 0
+        reminders = list(Reminder.objects.filter(id__in=ids).select_related('user__patients'))
+        notifications, emails = _reminder_messages(reminders, now)
+        deliver(notifications)
+        enqueue_emails(emails)
+        for reminder in reminders:
+            patient = getattr(reminder.user, 'patients', None)
+            if patient is not None:
+                publish_event(patient.pk, 'reminder', {
+                    'reminder_id': reminder.id,
+                    'message': reminder.reminder_message,
+                    'transmission_time': reminder.transmission_time,
+                })
+    return len(ids)
+
+
+def sweep(now=None, batch_size=None, max_batches=None):
+    """Drain due tasks and reminders, at most ``max_batches`` batches of each."""
+    now = now or timezone.now()
+    max_batches = max_batches or settings.REMINDER_SWEEP_MAX_BATCHES
+    totals = {'tasks': 0, 'reminders': 0}
+    for key, sweeper in (('tasks', sweep_due_tasks), ('reminders', sweep_due_reminders)):
+        for _ in range(max_batches):
+            claimed = sweeper(now, batch_size)
+            totals[key] += claimed
+            if not claimed:
+                break
+    return totals
@@ -1,10 +1,70 @@
+from django.db import transaction
+from django.utils import timezone
 from rest_framework import serializers
-from .models import User, Companion, Patient, Reminder, Location, Task, Notification
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from .models import User, Companion, Patient, Reminder, Location, Task, Notification, Geofence, LastKnownPosition
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from .authentication import add_profile_claims, token_state
+from .metrics import TimedSerializerMixin
+from .photos import variant_urls
+from .profile_cache import get_login_profile
+
+
+class EagerLoadingMixin:
+    """
+    Lets a serializer build the queryset it needs to render without N+1 queries.
+
+    Nested serializers are detected automatically: a single nested object is
+    joined with ``select_related`` and a ``many=True`` one is prefetched, with
+    the nested serializer's own needs added under its prefix. Relations used
+    outside nested serializers (method fields, ``__str__``) are declared in
+    ``Meta.select_related`` / ``Meta.prefetch_related``.
+    """
+
+    @classmethod
+    def eager_relations(cls, prefix=''):
+        meta = getattr(cls, 'Meta', None)
+        select = [prefix + name for name in getattr(meta, 'select_related', ())]
+        prefetch = [prefix + name for name in getattr(meta, 'prefetch_related', ())]
+
+        for name, field in cls._declared_fields.items():
+            if not isinstance(field, serializers.BaseSerializer) or field.source == '*':
+                continue
+            path = prefix + (field.source or name).replace('.', '__')
+            child = field.child if isinstance(field, serializers.ListSerializer) else field
+            if isinstance(field, serializers.ListSerializer):
+                prefetch.append(path)
+                target = prefetch
+            else:
+                select.append(path)
+                target = select
+            if isinstance(child, EagerLoadingMixin):
+                child_select, child_prefetch = type(child).eager_relations(path + '__')
+                target.extend(child_select)
+                prefetch.extend(child_prefetch)
+        return select, prefetch
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        select, prefetch = cls.eager_relations()
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+
+class PhotoVariantsField(serializers.ReadOnlyField):
+    """Resized copies of a photo as ``{size: {format: url}}``; empty until the worker has built them."""
 
+    def to_representation(self, value):
+        return variant_urls(value or {}, self.context.get('request'))
 
-class UserSerializer(serializers.ModelSerializer):
+
+class UserSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
+    profile_photo_variants = PhotoVariantsField()
     patient_username = serializers.CharField(write_only=True, required=False)
     relationship = serializers.ChoiceField(
         choices=Companion.RELATIONSHIP_CHOICES,
@@ -16,7 +76,7 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         fields = (
             'id', 'username', 'email', 'password', 'account_type',
-            'phone_number', 'name', 'location', 'profile_photo',
+            'phone_number', 'name', 'location', 'profile_photo', 'profile_photo_variants',
             'patient_username', 'relationship'
         )
 
@@ -24,37 +84,72 @@ class UserSerializer(serializers.ModelSerializer):
         patient_username = validated_data.pop('patient_username', None)
         relationship = validated_data.pop('relationship', None)
 
-        user = User.objects.create_user(
-            username=validated_data['username'],
-            email=validated_data['email'],
-            password=validated_data['password'],
+        # Written with the profile INSERT by the sync_profile receiver, instead of a second save
+        profile_defaults = {}
+        if validated_data['account_type'] == 'companions':
+            if patient_username:
+                patient_id = Patient.objects.filter(user__username=patient_username).values_list('id', flat=True).first()
+                if patient_id is None:
+                    raise serializers.ValidationError({"patient_username": "Patient not found."})
+                profile_defaults['patient_id'] = patient_id
+            if relationship:
+                profile_defaults['relationship'] = relationship
+
+        user = User(
+            username=User.normalize_username(validated_data['username']),
+            email=User.objects.normalize_email(validated_data['email']),
             account_type=validated_data['account_type'],
             phone_number=validated_data.get('phone_number', ''),
             name=validated_data.get('name', ''),
             location=validated_data.get('location', ''),
         )
+        user.set_password(validated_data['password'])
+        user._profile_defaults = profile_defaults
+        with transaction.atomic():
+            user.save()
+        return user
 
-        if user.account_type == 'companions':
-            companion = user.companions
-            if patient_username:
-                try:
-                    patient = Patient.objects.select_related('user').get(user__username=patient_username)
-                    companion.patient = patient
-                except Patient.DoesNotExist:
-                    raise serializers.ValidationError({"patient_username": "Patient not found."})
-            if relationship:
-                companion.relationship = relationship
-            companion.save()
 
-        return user
+class ProvisionRowSerializer(TimedSerializerMixin, serializers.Serializer):
+    """One account of a bulk provisioning file; uniqueness is checked for the whole batch in provisioning.py."""
+    username = serializers.RegexField(r'^[\w.@+-]+$', max_length=150)
+    email = serializers.EmailField(max_length=254)
+    password = serializers.CharField(write_only=True)
+    account_type = serializers.ChoiceField(choices=User.ACCOUNT_TYPES)
+    phone_number = serializers.CharField(max_length=15)
+    name = serializers.CharField(max_length=100, required=False, allow_blank=True, default='')
+    location = serializers.CharField(max_length=255, required=False, allow_blank=True, default='')
+    medical_condition = serializers.CharField(required=False, allow_blank=True, default='')
+    patient_username = serializers.CharField(required=False, allow_blank=True, default='')
+    relationship = serializers.ChoiceField(
+        choices=Companion.RELATIONSHIP_CHOICES, required=False, allow_blank=True, default=''
+    )
 
+    def validate(self, attrs):
+        if attrs['account_type'] == 'patients' and (attrs['patient_username'] or attrs['relationship']):
+            raise serializers.ValidationError("patient_username and relationship are for companions only.")
+        return attrs
 
-class ProfileSerializer(serializers.ModelSerializer):
+
+class ProfileSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     profile_photo = serializers.ImageField(required=False, allow_null=True)
+    profile_photo_variants = PhotoVariantsField()
 
     class Meta:
         model = User
-        fields = ('username', 'phone_number', 'profile_photo')
+        fields = ('username', 'phone_number', 'profile_photo', 'profile_photo_variants')
+
+    def update(self, instance, validated_data):
+        # Only the submitted columns are written; sync_profile skips the profile when none of its fields changed
+        if not validated_data:
+            return instance
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        update_fields = {*validated_data, 'updated_at'}
+        if 'profile_photo' in validated_data:
+            update_fields.add('profile_photo_variants')
+        instance.save(update_fields=update_fields)
+        return instance
 
     def validate_phone_number(self, value):
         user = self.instance
@@ -69,46 +164,54 @@ class ProfileSerializer(serializers.ModelSerializer):
         return value
 
 
-class CompanionProfileSerializer(serializers.ModelSerializer):
+class CompanionProfileSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     patient_username = serializers.SlugRelatedField(
         slug_field='user__username',
         queryset=Patient.objects.select_related('user').all(),
         source='patient',
         required=False
     )
+    profile_photo_variants = PhotoVariantsField()
 
     class Meta:
         model = Companion
         fields = (
             'id', 'name', 'email', 'phone_number', 'location',
-            'relationship', 'patient_username', 'alert_settings', 'profile_photo'
+            'relationship', 'patient_username', 'alert_settings', 'profile_photo',
+            'profile_photo_variants'
         )
         read_only_fields = ('email',)
 
 
-class PatientProfileSerializer(serializers.ModelSerializer):
+class PatientProfileSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    account_photo_variants = PhotoVariantsField()
+
     class Meta:
         model = Patient
         fields = (
             'id', 'name', 'email', 'phone_number', 'location',
-            'medical_condition', 'account_photo', 'current_gps_location',
+            'medical_condition', 'account_photo', 'account_photo_variants', 'current_gps_location',
+            'current_latitude', 'current_longitude',
             'additional_notes', 'companions_username'
         )
-        read_only_fields = ('email',)
+        read_only_fields = ('email', 'current_latitude', 'current_longitude')
 
 
-class PatientSerializer(serializers.ModelSerializer):
+class PatientSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     user = UserSerializer()
+    account_photo_variants = PhotoVariantsField()
 
     class Meta:
         model = Patient
         fields = [
             'id', 'user', 'medical_condition',
-            'account_photo', 'current_gps_location', 'additional_notes'
+            'account_photo', 'account_photo_variants', 'current_gps_location', 'current_latitude', 'current_longitude',
+            'additional_notes'
         ]
+        read_only_fields = ('current_latitude', 'current_longitude')
 
 
-class CompanionSerializer(serializers.ModelSerializer):
+class CompanionSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     user = UserSerializer()
     patient_info = serializers.SerializerMethodField()
 
@@ -117,14 +220,11 @@ class CompanionSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'patient_info', 'relationship', 'alert_settings']
 
     def get_patient_info(self, obj):
-        if hasattr(obj, 'patient'):
-            return obj.patient.id
-        elif hasattr(obj.user, 'patient'):
-            return obj.user.patient.id
-        return None
+        # The FK column already holds the id; following obj.patient would cost a query per row
+        return obj.patient_id
 
 
-class ReminderSerializer(serializers.ModelSerializer):
+class ReminderSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
 
     class Meta:
@@ -132,79 +232,152 @@ class ReminderSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'transmission_time', 'reminder_message']
 
 
-class LocationSerializer(serializers.ModelSerializer):
+class LocationSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     patient = serializers.PrimaryKeyRelatedField(queryset=Patient.objects.all())
 
     class Meta:
         model = Location
-        fields = ['id', 'gps_coordinates', 'time_coordinates', 'patient']
+        fields = ['id', 'gps_coordinates', 'latitude', 'longitude', 'time_coordinates', 'patient']
+        read_only_fields = ('latitude', 'longitude')
+
+
+class LastKnownPositionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    age_seconds = serializers.SerializerMethodField()
+
+    class Meta:
+        model = LastKnownPosition
+        fields = ['patient', 'location', 'gps_coordinates', 'latitude', 'longitude', 'recorded_at', 'age_seconds']
+
+    def get_age_seconds(self, obj):
+        now = self.context.get('now') or timezone.now()
+        return max(0.0, round((now - obj.recorded_at).total_seconds(), 1))
+
+
+class LocationIngestSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    # Patient ids are checked in one query for the whole batch by the view
+    patient = serializers.IntegerField(source='patient_id')
+
+    class Meta:
+        model = Location
+        fields = ['gps_coordinates', 'time_coordinates', 'patient']
 
 
-class TaskSerializer(serializers.ModelSerializer):
+class TaskSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     patient = serializers.PrimaryKeyRelatedField(queryset=Patient.objects.all())
 
     class Meta:
         model = Task
         fields = ['id', 'task_name', 'task_description', 'reminder_time', 'patient']
 
+    def update(self, instance, validated_data):
+        # Moving the reminder puts the task back on the due-queue
+        if 'reminder_time' in validated_data and validated_data['reminder_time'] != instance.reminder_time:
+            instance.is_sent = False
+        return super().update(instance, validated_data)
+
 
-class NotificationSerializer(serializers.ModelSerializer):
+class GeofenceSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    GEOMETRY_FIELDS = ('shape', 'center_latitude', 'center_longitude', 'radius_m', 'vertices')
+
+    class Meta:
+        model = Geofence
+        fields = [
+            'id', 'patient', 'name', 'shape', 'center_latitude', 'center_longitude', 'radius_m', 'vertices',
+            'is_active', 'patient_inside', 'state_changed_at', 'created_at', 'updated_at'
+        ]
+        read_only_fields = ['patient_inside', 'state_changed_at', 'created_at', 'updated_at']
+
+    def validate(self, attrs):
+        def current(name):
+            return attrs.get(name, getattr(self.instance, name, None))
+
+        if current('shape') == 'circle':
+            lat, lng, radius = current('center_latitude'), current('center_longitude'), current('radius_m')
+            if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                raise serializers.ValidationError({"center_latitude": "A circle needs a valid center."})
+            if radius is None or radius <= 0:
+                raise serializers.ValidationError({"radius_m": "A circle needs a positive radius."})
+        else:
+            vertices = current('vertices') or []
+            valid = len(vertices) >= 3 and all(
+                isinstance(vertex, (list, tuple)) and len(vertex) == 2
+                and all(isinstance(value, (int, float)) for value in vertex)
+                and -90 <= vertex[0] <= 90 and -180 <= vertex[1] <= 180
+                for vertex in vertices
+            )
+            if not valid:
+                raise serializers.ValidationError({"vertices": "A polygon needs at least 3 [lat, lng] points."})
+        return attrs
+
+    def update(self, instance, validated_data):
+        # A moved or reassigned fence starts over: the next fix records the state without alerting
+        reassigned = 'patient' in validated_data and validated_data['patient'].pk != instance.patient_id
+        if reassigned or any(field in validated_data and validated_data[field] != getattr(instance, field)
+                             for field in self.GEOMETRY_FIELDS):
+            instance.patient_inside = None
+            instance.state_changed_at = None
+        return super().update(instance, validated_data)
+
+
+class NotificationSerializer(TimedSerializerMixin, EagerLoadingMixin, serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
 
     class Meta:
         model = Notification
-        fields = ['id', 'user', 'transmission_time', 'notification_type', 'message']
+        fields = ['id', 'user', 'transmission_time', 'notification_type', 'message', 'is_read', 'read_at']
+        # Read state only changes through /notifications/inbox/read/, which keeps the unread counter
+        read_only_fields = ('is_read', 'read_at')
+
+
+class InboxNotificationSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    class Meta:
+        model = Notification
+        fields = ['id', 'transmission_time', 'notification_type', 'message', 'is_read', 'read_at']
+
+
+class NotificationReadSerializer(TimedSerializerMixin, serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, max_length=1000)
+    up_to = serializers.IntegerField(required=False)
+
+    def validate(self, attrs):
+        if 'ids' not in attrs and 'up_to' not in attrs:
+            raise serializers.ValidationError("Provide ids or up_to.")
+        return attrs
 
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
     username_field = 'email'
 
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        # Claims let hot endpoints skip the user lookup (see authentication.py)
+        add_profile_claims(token, user, get_login_profile(user))
+        token['sid'] = token[jwt_settings.JTI_CLAIM]
+        return token
+
     def validate(self, attrs):
         data = super().validate(attrs)
-
-        user = self.user
-
-        user_data = {
-            "id": user.id,
-            "name": user.name,
-            "email": user.email,
-            "account_type": user.account_type,
-            "phone_number": user.phone_number,
-            "location": user.location,
-            "username": user.username,
-            "profile_photo": user.profile_photo.url if user.profile_photo else None,
-        }
-
-        if hasattr(user, 'companions'):
-            companion = user.companions
-            user_data["relationship"] = companion.relationship
-            user_data["patient_username"] = companion.patient.user.username if companion.patient else None
-
-            if companion.patient:
-                user_data["linked_patient_type"] = companion.patient.name
-            else:
-                user_data["linked_patient_type"] = None
-
-        elif hasattr(user, 'patients'):
-            patient = user.patients
-            user_data["medical_condition"] = patient.medical_condition
-            user_data["account_photo"] = patient.account_photo.url if patient.account_photo else None
-            user_data["current_gps_location"] = patient.current_gps_location
-            user_data["additional_notes"] = patient.additional_notes
-
-            first_companion = patient.companions.first()
-            if first_companion:
-                user_data["linked_companion_name"] = first_companion.user.username
-                user_data["relationship"] = first_companion.relationship
-            else:
-                user_data["linked_companion_name"] = None
-                user_data["relationship"] = None
-
-        data["user"] = user_data
+        # Password check above; the profile comes from the cache (see profile_cache.py)
+        data["user"] = get_login_profile(self.user)
         return data
 
 
-class SOSSerializer(serializers.Serializer):
+class CustomTokenRefreshSerializer(TokenRefreshSerializer):
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        revoked, stale = token_state(refresh)
+        if revoked:
+            raise InvalidToken("Token has been revoked")
+        if not stale:
+            return super().validate(attrs)
+        # The companion was re-linked since login: mint the access token with fresh claims
+        user = User.objects.get(pk=refresh[jwt_settings.USER_ID_CLAIM])
+        add_profile_claims(refresh, user, get_login_profile(user))
+        return {"access": str(refresh.access_token)}
+
+
+class SOSSerializer(TimedSerializerMixin, serializers.Serializer):
     is_active = serializers.BooleanField()
     target_id = serializers.IntegerField(read_only=True)  # سيتم تعبئته تلقائياً
 
@@ -0,0 +1,55 @@
+"""
+Content-addressed storage for uploaded media.
+
+Every file is stored as ``blobs/<aa>/<sha256><ext>``, named after the SHA-256
+of its bytes: uploading bytes that are already stored writes nothing, and a
+name never changes content, so its URL can be cached forever
+(``MEDIA_BLOB_CACHE_CONTROL``). Because rows share files, ``delete`` is a
+no-op; ``Users/blobs.py`` counts references and a periodic job ``purge``s the
+files nothing points at any more.
+"""
+import hashlib
+import posixpath
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.views.static import serve
+
+BLOB_PREFIX = 'blobs'
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def hashed_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        hexdigest = digest.hexdigest()
+        ext = posixpath.splitext(name)[1].lower()
+        return posixpath.join(BLOB_PREFIX, hexdigest[:2], hexdigest + ext)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.hashed_name(name, content)
+        if self.exists(name):
+            return name
+        return self._save(name, content)
+
+    def delete(self, name):
+        # Shared between rows; unreferenced files are removed by blobs.collect_garbage
+        pass
+
+    def purge(self, name):
+        super().delete(name)
+
+
+def serve_media(request, path, document_root=None):
+    """Development media server that marks content-addressed files immutable."""
+    response = serve(request, path, document_root=document_root)
+    if path.startswith(BLOB_PREFIX + '/'):
+        response['Cache-Control'] = settings.MEDIA_BLOB_CACHE_CONTROL
+    return response
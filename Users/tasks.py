@@ -1,23 +1,70 @@
 # tasks.py
 from celery import shared_task
-from .models import Task
-from django.core.mail import send_mail
 from django.conf import settings
+from .scheduler import sweep, send_task_now
+from .history import compact_location_history as _compact_location_history
+from .mail import drain_outbox
+from .photos import build_missing_variants, generate_variants
+from .blobs import collect_garbage
+from .inbox import archive_notifications as _archive_notifications
+
+
+@shared_task
+def sweep_due_reminders():
+    return sweep()
+
 
 @shared_task
 def send_task_reminder(task_id):
-    try:
-        task = Task.objects.get(id=task_id)
-        if not task.is_sent:
-            # Send email notification
-            send_mail(
-                f'Task Reminder: {task.title}',
-                f'This is a reminder for your task: {task.description}',
-                settings.EMAIL_HOST_USER,
-                [task.companion.user.email],
-                fail_silently=False,
-            )
-            task.is_sent = True
-            task.save()
-    except Task.DoesNotExist:
-        pass
+    # Kept for callers that schedule a single task; claiming is shared with
+    # the periodic sweep, so a task is never sent twice.
+    return send_task_now(task_id)
+
+
+@shared_task
+def compact_location_history():
+    return _compact_location_history()
+
+
+@shared_task
+def drain_email_outbox():
+    totals = {'sent': 0, 'retried': 0, 'dead': 0}
+    for _ in range(settings.EMAIL_OUTBOX_MAX_BATCHES):
+        result = drain_outbox()
+        for key, value in result.items():
+            totals[key] += value
+        if not any(result.values()):
+            break
+    return totals
+
+
+@shared_task
+def process_photo(label, pk, name):
+    return generate_variants(label, pk, name) is not None
+
+
+@shared_task
+def build_missing_photo_variants():
+    return build_missing_variants()
+
+
+@shared_task
+def collect_media_garbage():
+    removed = 0
+    for _ in range(settings.MEDIA_BLOB_GC_MAX_BATCHES):
+        batch = collect_garbage()
+        removed += batch
+        if not batch:
+            break
+    return removed
+
+
+@shared_task
+def archive_notifications():
+    archived = 0
+    for _ in range(settings.NOTIFICATION_ARCHIVE_MAX_BATCHES):
+        batch = _archive_notifications()
+        archived += batch
+        if not batch:
+            break
+    return archived
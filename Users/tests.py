@@ -1,3 +1,1529 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+from datetime import datetime, timedelta, timezone as dt_timezone
 
-# Create your tests here.
+from django.contrib.auth.models import update_last_login
+from django.core import mail
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from .geo import bounding_box, haversine_m, parse_coordinates
+from .geofences import GridIndex
+from .history import compact_location_history, location_history
+from .models import User, Patient, Companion, Location, LocationRollup, Notification, Reminder, Task
+from .scheduler import send_task_now, sweep
+from .mail import drain_outbox, enqueue_email
+from .models import DeadLetterEmail, OutboundEmail
+from . import benchmark, exports, metrics, provisioning, realtime, throttling
+from .photos import generate_variants
+from . import routes
+from .authentication import add_profile_claims, token_state
+from .profile_cache import get_login_profile
+from .blobs import collect_garbage
+from .inbox import archive_notifications, deliver
+from .relations import companions_of_patient, patient_of_companion
+from .models import Geofence, LastKnownPosition, MediaBlob, NotificationArchive
+from PIL import Image
+import numpy as np
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+def make_user(username, account_type='patients', password=None, **extra):
+    # No password by default: hashing dominates test time and most tests never log in
+    return User.objects.create_user(
+        username=username,
+        email=f'{username}@example.com',
+        password=password,
+        account_type=account_type,
+        phone_number=extra.pop('phone_number', str(abs(hash(username)) % 10**12)),
+        name=extra.pop('name', username.title()),
+        **extra
+    )
+
+
+class LocationBulkCreateTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.patient = make_user('patient1').patients
+        self.url = reverse('location-bulk')
+
+    def test_json_batch_is_inserted(self):
+        fixes = [
+            {'gps_coordinates': f'30.0{i},31.2{i}', 'time_coordinates': f'2025-06-01T10:0{i}:00Z'}
+            for i in range(5)
+        ]
+        response = self.client.post(f'{self.url}?patient={self.patient.pk}', fixes, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 5)
+        self.assertEqual(Location.objects.filter(patient=self.patient).count(), 5)
+        self.assertEqual([r['index'] for r in response.data['results']], list(range(5)))
+
+    def test_ndjson_stream_with_invalid_items(self):
+        lines = [
+            {'gps_coordinates': '30.1,31.1', 'time_coordinates': '2025-06-01T10:00:00Z', 'patient': self.patient.pk},
+            {'gps_coordinates': '30.2,31.2', 'time_coordinates': 'not-a-date', 'patient': self.patient.pk},
+            {'gps_coordinates': '30.3,31.3', 'time_coordinates': '2025-06-01T10:02:00Z', 'patient': 999999},
+        ]
+        body = '\n'.join(json.dumps(line) for line in lines)
+        response = self.client.post(self.url, body, content_type='application/x-ndjson')
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.data['created'], 1)
+        results = response.data['results']
+        self.assertIn('id', results[0])
+        self.assertIn('time_coordinates', results[1]['errors'])
+        self.assertIn('patient', results[2]['errors'])
+        self.assertEqual(Location.objects.count(), 1)
+
+    def test_batch_is_validated_with_constant_queries(self):
+        fixes = [
+            {'gps_coordinates': '30.0,31.0', 'time_coordinates': '2025-06-01T10:00:00Z'}
+            for _ in range(50)
+        ]
+        # patient lookup + savepoint/insert/release + geofences (then cached)
+        # + last position: update, insert and retry for a patient's first fix, one update afterwards
+        with self.assertNumQueries(8):
+            self.client.post(f'{self.url}?patient={self.patient.pk}', fixes, format='json')
+
+
+class LocationGeoQueryTests(APITestCase):
+    def setUp(self):
+        self.patient = make_user('patient1').patients
+        self.url = reverse('location-list')
+        for coords in ('30.0444,31.2357', '30.0500,31.2400', '29.9792,31.1342', 'garbage'):
+            Location.objects.create(patient=self.patient, gps_coordinates=coords,
+                                    time_coordinates='2025-06-01T10:00:00Z')
+
+    def test_parse_coordinates(self):
+        self.assertEqual(parse_coordinates('30.1, 31.2'), (30.1, 31.2))
+        self.assertEqual(parse_coordinates('30.1 31.2'), (30.1, 31.2))
+        self.assertEqual(parse_coordinates('95,31'), (None, None))
+        self.assertEqual(parse_coordinates(''), (None, None))
+
+    def test_save_populates_numeric_columns(self):
+        location = Location.objects.get(gps_coordinates='30.0444,31.2357')
+        self.assertEqual((location.latitude, location.longitude), (30.0444, 31.2357))
+
+    def test_bounding_box_filter(self):
+        response = self.client.get(self.url, {
+            'min_lat': 30.0, 'max_lat': 30.1, 'min_lng': 31.2, 'max_lng': 31.3,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_radius_filter(self):
+        # the two downtown fixes are ~700 m apart, Giza is ~11 km away
+        response = self.client.get(self.url, {'lat': 30.0444, 'lng': 31.2357, 'radius': 1000})
+        self.assertEqual(len(response.data['results']), 2)
+        response = self.client.get(self.url, {'lat': 30.0444, 'lng': 31.2357, 'radius': 100})
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_incomplete_radius_query_is_rejected(self):
+        response = self.client.get(self.url, {'lat': 30.0444})
+        self.assertEqual(response.status_code, 400)
+
+
+class LocationHistoryTests(APITestCase):
+    def setUp(self):
+        self.patient = make_user('patient1').patients
+        self.now = datetime(2025, 6, 30, 12, 0, tzinfo=dt_timezone.utc)
+        self.old = datetime(2025, 6, 1, 10, 0, tzinfo=dt_timezone.utc)
+        # three fixes in one minute, one in the next, 29 days ago
+        for offset, coords in ((0, '30.0,31.0'), (10, '30.2,31.2'), (20, '30.4,31.4'), (70, '31.0,32.0')):
+            Location.objects.create(patient=self.patient, gps_coordinates=coords,
+                                    time_coordinates=self.old + timedelta(seconds=offset))
+        Location.objects.create(patient=self.patient, gps_coordinates='30.0,31.0',
+                                time_coordinates=self.now - timedelta(hours=1))
+
+    def test_compaction_rolls_old_fixes_into_minute_buckets(self):
+        result = compact_location_history(now=self.now)
+
+        self.assertEqual(result['raw']['fixes'], 4)
+        self.assertEqual(Location.objects.count(), 1)
+        first, second = LocationRollup.objects.filter(resolution='minute').order_by('bucket_start')
+        self.assertEqual(first.fix_count, 3)
+        self.assertAlmostEqual(first.latitude, 30.2)
+        self.assertEqual((first.min_latitude, first.max_longitude), (30.0, 31.4))
+        self.assertEqual(second.fix_count, 1)
+
+    @mock.patch('Users.history.DELETE_BATCH_SIZE', 2)
+    def test_compaction_deletes_old_unparsed_fixes_and_clears_last_position(self):
+        for offset in (5, 15, 25):
+            Location.objects.create(patient=self.patient, gps_coordinates='no fix',
+                                    time_coordinates=self.old + timedelta(seconds=offset))
+        recent_bad = Location.objects.create(patient=self.patient, gps_coordinates='no fix',
+                                             time_coordinates=self.now - timedelta(hours=2))
+        newest = Location.objects.filter(time_coordinates__lt=self.now - timedelta(days=2)).latest('time_coordinates')
+        LastKnownPosition.objects.update_or_create(patient=self.patient, defaults={
+            'location': newest, 'gps_coordinates': newest.gps_coordinates, 'recorded_at': newest.time_coordinates,
+        })
+
+        result = compact_location_history(now=self.now)['raw']
+        self.assertEqual((result['fixes'], result['unparsed']), (4, 3))
+        self.assertEqual(Location.objects.filter(latitude__isnull=True).get(), recent_bad)
+        self.assertEqual(sum(LocationRollup.objects.values_list('fix_count', flat=True)), 4)
+        self.assertIsNone(LastKnownPosition.objects.get(pk=self.patient.pk).location_id)
+
+        # with nothing left to roll up, old unparsed fixes still go
+        Location.objects.create(patient=self.patient, gps_coordinates='no fix', time_coordinates=self.old)
+        result = compact_location_history(now=self.now)['raw']
+        self.assertEqual((result['fixes'], result['unparsed']), (0, 1))
+        self.assertEqual(Location.objects.filter(latitude__isnull=True).get(), recent_bad)
+
+    def test_late_fixes_merge_into_existing_bucket(self):
+        compact_location_history(now=self.now)
+        Location.objects.create(patient=self.patient, gps_coordinates='30.8,31.8',
+                                time_coordinates=self.old + timedelta(seconds=30))
+        compact_location_history(now=self.now)
+
+        bucket = LocationRollup.objects.get(resolution='minute', bucket_start=self.old)
+        self.assertEqual(bucket.fix_count, 4)
+        self.assertAlmostEqual(bucket.latitude, 30.35)
+
+    def test_minute_rollups_compact_into_hours(self):
+        compact_location_history(now=self.now)
+        compact_location_history(now=self.now + timedelta(days=120))
+
+        self.assertFalse(LocationRollup.objects.filter(resolution='minute').exists())
+        old_hour, recent_hour = LocationRollup.objects.filter(resolution='hour').order_by('bucket_start')
+        self.assertEqual((old_hour.bucket_start, old_hour.fix_count), (self.old, 4))
+        self.assertEqual(recent_hour.fix_count, 1)
+
+    def test_history_picks_resolution_from_range(self):
+        compact_location_history(now=self.now)
+
+        resolution, points = location_history(self.patient.pk, self.now - timedelta(hours=2), self.now, now=self.now)
+        self.assertEqual((resolution, len(points)), ('raw', 1))
+
+        resolution, points = location_history(self.patient.pk, self.old, self.old + timedelta(hours=1), now=self.now)
+        self.assertEqual(resolution, 'minute')
+        self.assertEqual([p['count'] for p in points], [3, 1])
+
+        resolution, points = location_history(self.patient.pk, self.old, self.now, now=self.now)
+        self.assertEqual(resolution, 'hour')
+        self.assertEqual(sum(p['count'] for p in points), 5)
+
+    def test_history_endpoint(self):
+        response = self.client.get(reverse('location-history'), {'patient': self.patient.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['resolution'], 'raw')
+        self.assertEqual(self.client.get(reverse('location-history')).status_code, 400)
+
+
+class WebsocketHarness:
+    """Drives ``realtime.websocket_application`` like an ASGI server would."""
+
+    def __init__(self, query_string):
+        self.incoming = asyncio.Queue()
+        self.outgoing = asyncio.Queue()
+        scope = {'type': 'websocket', 'path': realtime.WEBSOCKET_PATH, 'query_string': query_string.encode()}
+        self.task = asyncio.ensure_future(
+            realtime.websocket_application(scope, self.incoming.get, self.outgoing.put)
+        )
+
+    async def connect(self):
+        await self.incoming.put({'type': 'websocket.connect'})
+        return await asyncio.wait_for(self.outgoing.get(), 2)
+
+    async def receive(self):
+        return await asyncio.wait_for(self.outgoing.get(), 2)
+
+    async def disconnect(self):
+        await self.incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(self.task, 2)
+
+
+@override_settings(REALTIME_BROKER='Users.realtime.InMemoryBroker')
+class RealtimeEventTests(TestCase):
+    def setUp(self):
+        realtime._broker = None
+        self.patient = make_user('patient1').patients
+        self.companion_user = make_user('companion1', account_type='companions')
+        self.companion_user.companions.patient = self.patient
+        self.companion_user.companions.save()
+        self.stranger = make_user('companion2', account_type='companions')
+
+    def tearDown(self):
+        realtime._broker = None
+
+    async def test_companion_receives_events_for_linked_patient(self):
+        socket = WebsocketHarness(f'token={AccessToken.for_user(self.companion_user)}')
+        self.assertEqual((await socket.connect())['type'], 'websocket.accept')
+
+        realtime.get_broker().publish(realtime.group_for_patient(self.patient.pk), '{"type": "sos"}')
+        realtime.get_broker().publish(realtime.group_for_patient(self.patient.pk + 1), '{"type": "other"}')
+        message = await socket.receive()
+        self.assertEqual(json.loads(message['text'])['type'], 'sos')
+
+        await socket.incoming.put({'type': 'websocket.receive', 'text': 'ping'})
+        self.assertEqual((await socket.receive())['text'], 'pong')
+        await socket.disconnect()
+        self.assertFalse(realtime.get_broker()._groups)
+
+    async def test_unlinked_or_anonymous_sockets_are_refused(self):
+        for query in (f'token={AccessToken.for_user(self.stranger)}', 'token=garbage', ''):
+            socket = WebsocketHarness(query)
+            self.assertEqual(await socket.connect(), {'type': 'websocket.close', 'code': 4403})
+
+    def test_location_write_publishes_after_commit(self):
+        received = []
+        broker = realtime.get_broker()
+        broker.publish = lambda group, message: received.append((group, json.loads(message)))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"{reverse('location-bulk')}?patient={self.patient.pk}", [
+                {'gps_coordinates': '30.0,31.0', 'time_coordinates': '2025-06-01T10:00:00Z'},
+                {'gps_coordinates': '30.1,31.1', 'time_coordinates': '2025-06-01T10:05:00Z'},
+            ], content_type='application/json')
+
+        self.assertEqual(len(received), 1)
+        group, message = received[0]
+        self.assertEqual(group, realtime.group_for_patient(self.patient.pk))
+        self.assertEqual((message['type'], message['data']['gps_coordinates']), ('location', '30.1,31.1'))
+
+
+class ReminderSchedulerTests(TestCase):
+    def setUp(self):
+        self.now = datetime(2025, 6, 1, 9, 0, tzinfo=dt_timezone.utc)
+        self.patient = make_user('patient1').patients
+        self.companion = make_user('companion1', account_type='companions').companions
+        for minutes in (-30, -1, 0, 5):
+            Task.objects.create(patient=self.patient, companion=self.companion, task_name=f'Pill {minutes}',
+                                task_description='Blue pill', reminder_time=self.now + timedelta(minutes=minutes))
+        Reminder.objects.create(user=self.patient.user, transmission_time=self.now - timedelta(minutes=2),
+                                reminder_message='Drink water')
+
+    def test_sweep_sends_due_rows_once(self):
+        totals = sweep(now=self.now, batch_size=2)
+
+        self.assertEqual(totals, {'tasks': 3, 'reminders': 1})
+        self.assertEqual(OutboundEmail.objects.count(), 4)
+        self.assertEqual(Task.objects.filter(is_sent=False).count(), 1)
+        self.assertEqual(Notification.objects.filter(user=self.patient.user, notification_type='reminder').count(), 4)
+
+        self.assertEqual(sweep(now=self.now), {'tasks': 0, 'reminders': 0})
+        self.assertEqual(OutboundEmail.objects.count(), 4)
+
+    def test_single_task_send_is_idempotent(self):
+        task = Task.objects.get(task_name='Pill 5')
+        self.assertTrue(send_task_now(task.pk))
+        self.assertFalse(send_task_now(task.pk))
+        self.assertEqual(OutboundEmail.objects.get().subject, 'Task Reminder: Pill 5')
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class EmailOutboxTests(TestCase):
+    def setUp(self):
+        self.now = datetime(2025, 6, 1, 9, 0, tzinfo=dt_timezone.utc)
+        for i in range(3):
+            enqueue_email(f'Subject {i}', 'Body', [f'user{i}@example.com'])
+        OutboundEmail.objects.update(next_attempt_at=self.now)
+
+    def test_drain_sends_batch_over_one_connection(self):
+        with mock.patch('Users.mail.get_connection', wraps=mail.get_connection) as get_connection:
+            result = drain_outbox(now=self.now)
+
+        self.assertEqual(result, {'sent': 3, 'retried': 0, 'dead': 0})
+        self.assertEqual(get_connection.call_count, 1)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(OutboundEmail.objects.exists())
+
+    def test_failures_back_off_then_dead_letter(self):
+        with self.settings(EMAIL_BACKEND='Users.tests.FailingEmailBackend', EMAIL_OUTBOX_MAX_ATTEMPTS=2):
+            self.assertEqual(drain_outbox(now=self.now)['retried'], 3)
+            message = OutboundEmail.objects.first()
+            self.assertEqual(message.attempts, 1)
+            self.assertEqual(message.next_attempt_at, self.now + timedelta(seconds=30))
+            self.assertEqual(drain_outbox(now=self.now)['retried'], 0)  # not due yet
+
+            with self.assertLogs('Users.mail', 'ERROR'):
+                result = drain_outbox(now=self.now + timedelta(minutes=1))
+        self.assertEqual(result['dead'], 3)
+        self.assertFalse(OutboundEmail.objects.exists())
+        self.assertIn('SMTP unavailable', DeadLetterEmail.objects.first().last_error)
+
+    def test_password_reset_only_queues_mail(self):
+        make_user('patient1')
+        response = self.client.post(reverse('password_reset_request'), {'email': 'patient1@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertTrue(OutboundEmail.objects.filter(recipients=['patient1@example.com']).exists())
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, messages):
+        raise ConnectionError("SMTP unavailable")
+
+
+class ListPaginationFilterTests(APITestCase):
+    def setUp(self):
+        self.patient = make_user('patient1').patients
+        self.other = make_user('patient2').patients
+        start = datetime(2025, 6, 1, tzinfo=dt_timezone.utc)
+        Notification.objects.bulk_create([
+            Notification(user=self.patient.user, transmission_time=start + timedelta(minutes=i),
+                         notification_type='reminder' if i % 2 else 'security', message=str(i))
+            for i in range(7)
+        ] + [Notification(user=self.other.user, transmission_time=start, notification_type='update', message='x')])
+
+    def test_cursor_pages_walk_the_whole_list_newest_first(self):
+        url = f"{reverse('notification-list')}?user={self.patient.user_id}&page_size=3"
+        messages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            messages += [item['message'] for item in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(messages, ['6', '5', '4', '3', '2', '1', '0'])
+
+    def test_type_and_time_range_filters(self):
+        response = self.client.get(reverse('notification-list'), {
+            'user': self.patient.user_id,
+            'notification_type': 'reminder',
+            'transmission_time_after': '2025-06-01T00:02:00Z',
+            'transmission_time_before': '2025-06-01T00:05:00Z',
+        })
+        self.assertEqual([item['message'] for item in response.data['results']], ['3'])
+
+    def test_invalid_filters_are_rejected(self):
+        url = reverse('notification-list')
+        self.assertEqual(self.client.get(url, {'user': 'abc'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'transmission_time_after': 'yesterday'}).status_code, 400)
+
+
+class QueryCountTests(APITestCase):
+    """Each list endpoint must cost the same number of queries for 1 row or 20."""
+
+    endpoints = [
+        'user-list', 'patient-list', 'companion-list', 'reminder-list',
+        'location-list', 'task-list', 'notification-list',
+    ]
+    counter = 0
+
+    def add_rows(self, count):
+        for _ in range(count):
+            QueryCountTests.counter += 1
+            n = QueryCountTests.counter
+            patient = make_user(f'qpatient{n}').patients
+            companion = make_user(f'qcompanion{n}', account_type='companions').companions
+            companion.patient = patient
+            companion.save()
+            moment = datetime(2025, 6, 1, tzinfo=dt_timezone.utc) + timedelta(minutes=n)
+            Reminder.objects.create(user=patient.user, transmission_time=moment, reminder_message='x')
+            Location.objects.create(patient=patient, gps_coordinates='30.0,31.0', time_coordinates=moment)
+            Task.objects.create(patient=patient, companion=companion, task_name='t', task_description='d',
+                                reminder_time=moment)
+            Notification.objects.create(user=companion.user, transmission_time=moment,
+                                        notification_type='update', message='m')
+
+    def count_queries(self, name):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(name), {'page_size': 100})
+        self.assertEqual(response.status_code, 200)
+        return len(queries), len(response.data['results'])
+
+    def test_list_endpoints_do_not_issue_per_row_queries(self):
+        self.add_rows(1)
+        small = {name: self.count_queries(name) for name in self.endpoints}
+        self.add_rows(19)
+        for name in self.endpoints:
+            with self.subTest(endpoint=name):
+                queries, rows = self.count_queries(name)
+                self.assertGreater(rows, small[name][1])
+                self.assertEqual(queries, small[name][0])
+
+
+class LoginProfileCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        throttling._store = None
+        self.patient_user = make_user('patient1', password='pass12345')
+        self.companion_user = make_user('companion1', account_type='companions', password='pass12345')
+        companion = self.companion_user.companions
+        companion.patient = self.patient_user.patients
+        companion.relationship = 'child'
+        companion.save()
+
+    def login(self, user):
+        response = self.client.post(reverse('custom_token_obtain_pair'),
+                                    {'email': user.email, 'password': 'pass12345'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data['user']
+
+    def test_second_login_reads_profile_from_cache(self):
+        first = self.login(self.companion_user)
+        self.assertEqual((first['patient_username'], first['relationship']), ('patient1', 'child'))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.login(self.companion_user), first)
+        self.assertEqual(len(queries), 1)  # the user lookup for the password check
+
+    def test_profile_and_link_changes_invalidate(self):
+        self.assertEqual(self.login(self.patient_user)['linked_companion_name'], 'companion1')
+        self.assertEqual(self.login(self.companion_user)['linked_patient_type'], 'Patient1')
+
+        patient = self.patient_user.patients
+        patient.name = 'Renamed'
+        patient.save()
+        self.assertEqual(self.login(self.companion_user)['linked_patient_type'], 'Renamed')
+
+        companion = Companion.objects.get(pk=self.companion_user.companions.pk)
+        companion.patient = None
+        companion.save()
+        self.assertIsNone(self.login(self.patient_user)['linked_companion_name'])
+        self.assertIsNone(self.login(self.companion_user)['patient_username'])
+
+        self.companion_user.username = 'companion-renamed'
+        self.companion_user.save()
+        self.assertEqual(self.login(self.companion_user)['username'], 'companion-renamed')
+
+    def test_profile_cached_before_commit_is_dropped_after_it(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            companion = Companion.objects.get(pk=self.companion_user.companions.pk)
+            companion.patient = None
+            companion.save()
+            # A concurrent login still sees the committed link and caches it
+            cache.set(f'login-profile:{self.companion_user.pk}', {'patient_id': self.patient_user.patients.pk})
+        self.assertIsNone(cache.get(f'login-profile:{self.companion_user.pk}'))
+
+
+class StatelessAuthenticationTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        throttling._store = None
+        self.patient = make_user('patient1', password='pass12345').patients
+        self.companion_user = make_user('companion1', account_type='companions', password='pass12345')
+        self.companion = self.companion_user.companions
+        self.companion.patient = self.patient
+        self.companion.save()
+
+    def login(self, user):
+        response = self.client.post(reverse('custom_token_obtain_pair'),
+                                    {'email': user.email, 'password': 'pass12345'}, format='json')
+        return response.data
+
+    def user_table_queries(self, queries):
+        return [q['sql'] for q in queries if 'FROM "Users_user"' in q['sql']]
+
+    def test_sos_is_served_from_token_claims(self):
+        tokens = self.login(self.patient.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('sos'), {'is_active': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.user_table_queries(queries), [])
+        self.assertTrue(Notification.objects.filter(user=self.companion_user, notification_type='security').exists())
+
+    def test_logout_revokes_access_and_refresh_tokens(self):
+        tokens = self.login(self.companion_user)
+        response = self.client.post(reverse('logout'), {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, 205)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.assertEqual(self.client.post(reverse('sos'), {'is_active': True}, format='json').status_code, 401)
+        self.client.credentials()
+        response = self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(response.status_code, 401)
+
+        # a new login is a new session
+        tokens = self.login(self.companion_user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.assertEqual(self.client.post(reverse('sos'), {'is_active': False}, format='json').status_code, 200)
+
+    def test_relinking_a_companion_invalidates_link_claims(self):
+        tokens = self.login(self.companion_user)
+        other = make_user('patient2').patients
+        companion = Companion.objects.get(pk=self.companion.pk)
+        companion.patient = other
+        companion.save()
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {tokens['access']}")
+        self.client.post(reverse('sos'), {'is_active': True}, format='json')
+        self.assertTrue(Notification.objects.filter(user=other.user).exists())
+        self.assertFalse(Notification.objects.filter(user=self.patient.user).exists())
+
+        self.client.credentials()
+        response = self.client.post(reverse('token_refresh'), {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(AccessToken(response.data['access'])['patient_id'], other.pk)
+
+        # the refreshed token carries fresh claims, so it no longer takes the DB path
+        self.assertEqual(token_state(AccessToken(response.data['access'])), (False, False))
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.post(reverse('sos'), {'is_active': False}, format='json').status_code, 200)
+        self.assertEqual(self.user_table_queries(queries), [])
+
+
+def make_jpeg(name='photo.jpg', size=(1200, 800), color=(200, 30, 30)):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'JPEG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+
+class PhotoVariantTests(APITestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = make_user('patient1')
+        self.client.force_authenticate(self.user)
+
+    def upload(self, color=(200, 30, 30)):
+        with mock.patch('Users.tasks.process_photo.apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.patch(reverse('profile-update'), {'profile_photo': make_jpeg(color=color)},
+                                             format='multipart')
+        self.assertEqual(response.status_code, 200)
+        (args,), _ = apply_async.call_args
+        return response, args
+
+    def test_upload_returns_before_variants_are_built(self):
+        response, args = self.upload()
+        self.assertEqual(response.data['profile_photo_variants'], {})
+        self.assertEqual(args[:2], ('Users.User', self.user.pk))
+
+        variants = generate_variants(*args)
+        self.assertEqual(set(variants), {'thumb', 'medium'})
+        with default_storage.open(variants['thumb']['webp']) as thumb:
+            self.assertEqual(Image.open(thumb).size, (128, 85))
+
+        response = self.client.get(reverse('user-detail', args=[self.user.pk]))
+        self.assertTrue(response.data['profile_photo_variants']['medium']['jpeg'].startswith('http://testserver/media/'))
+
+    def test_identical_uploads_share_one_file(self):
+        _, args = self.upload()
+        generate_variants(*args)
+        other = make_user('companion1', account_type='companions')
+        self.client.force_authenticate(other)
+        _, other_args = self.upload()
+
+        self.assertEqual(other_args[2], args[2])
+        self.assertTrue(args[2].startswith('blobs/'))
+        self.assertEqual(MediaBlob.objects.get(name=args[2]).refcount, 2)
+
+    def test_replaced_files_are_collected_once_unreferenced(self):
+        _, args = self.upload()
+        old_files = [args[2]] + [name for formats in generate_variants(*args).values() for name in formats.values()]
+        shared = make_user('companion1', account_type='companions')
+        shared.profile_photo = args[2]
+        shared.save()
+
+        _, args = self.upload(color=(30, 30, 200))
+        generate_variants(*args)
+        self.assertEqual(MediaBlob.objects.get(name=old_files[0]).refcount, 1)
+        self.assertTrue(all(MediaBlob.objects.get(name=name).refcount == 0 for name in old_files[1:]))
+
+        self.assertEqual(collect_garbage(), 0)  # still within the grace period
+        removed = collect_garbage(now=timezone.now() + timedelta(days=1))
+        self.assertEqual(removed, len(old_files) - 1)
+        self.assertTrue(default_storage.exists(old_files[0]))
+        self.assertFalse(any(default_storage.exists(name) for name in old_files[1:]))
+        self.assertTrue(default_storage.exists(args[2]))
+
+
+def bearer(user):
+    token = add_profile_claims(AccessToken.for_user(user), user, get_login_profile(user))
+    return f'Bearer {token}'
+
+
+class SOSDispatchTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.patient = make_user('patient1').patients
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(self.patient.user))
+
+    def add_companions(self, count):
+        for i in range(count):
+            companion = make_user(f'companion{Companion.objects.count()}', account_type='companions').companions
+            companion.patient = self.patient
+            companion.save()
+
+    def press(self, is_active=True):
+        return self.client.post(reverse('sos'), {'is_active': is_active}, format='json')
+
+    def test_query_count_does_not_grow_with_companions(self):
+        self.add_companions(1)
+        with CaptureQueriesContext(connection) as one:
+            self.assertEqual(self.press().status_code, 200)
+        self.press(False)
+        self.add_companions(9)
+        with CaptureQueriesContext(connection) as ten:
+            self.assertEqual(self.press().status_code, 200)
+
+        self.assertEqual(len(one), len(ten))
+        self.assertEqual(Notification.objects.filter(notification_type='security').count(), 11)
+
+    def test_repeated_presses_inside_window_are_deduplicated(self):
+        self.add_companions(2)
+        self.assertFalse(self.press().data['duplicate'])
+        self.assertTrue(self.press().data['duplicate'])
+        self.assertEqual(Notification.objects.count(), 2)
+
+        self.press(False)
+        self.assertFalse(self.press().data['duplicate'])
+        self.assertEqual(Notification.objects.count(), 4)
+
+        Patient.objects.update(last_sos_time=timezone.now() - timedelta(minutes=5))
+        self.assertFalse(self.press().data['duplicate'])
+        self.assertEqual(Notification.objects.count(), 6)
+
+    def test_patient_without_companions(self):
+        response = self.press()
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(Patient.objects.get(pk=self.patient.pk).sos_alert)
+
+    def test_repeated_press_without_recipients_is_still_refused(self):
+        self.assertEqual(self.press().status_code, 400)
+        self.assertEqual(self.press().status_code, 400)
+
+        companion = make_user('companion1', account_type='companions')
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(companion))
+        self.assertEqual(self.press().status_code, 400)
+        self.assertEqual(self.press().status_code, 400)
+        self.assertEqual(Notification.objects.count(), 0)
+
+
+class NotificationInboxTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = make_user('companion1', account_type='companions')
+        self.other = make_user('companion2', account_type='companions')
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(self.user))
+
+    def notify(self, user, count, when=None):
+        return deliver([
+            Notification(user=user, transmission_time=when or timezone.now(), notification_type='update', message=str(i))
+            for i in range(count)
+        ])
+
+    def unread(self, user):
+        return User.objects.get(pk=user.pk).unread_notifications
+
+    def test_since_cursor_returns_only_new_items(self):
+        first = self.notify(self.user, 3)
+        self.notify(self.other, 2)
+        response = self.client.get(reverse('notification-inbox'), {'limit': 2})
+        self.assertEqual([n['id'] for n in response.data['results']], [n.id for n in first[:2]])
+        self.assertTrue(response.data['has_more'])
+        self.assertEqual(response.data['unread_count'], 3)
+
+        response = self.client.get(reverse('notification-inbox'), {'since': response.data['since']})
+        self.assertEqual([n['id'] for n in response.data['results']], [first[2].id])
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('notification-inbox'), {'since': response.data['since']})
+        self.assertEqual(response.data['results'], [])
+
+    def test_unread_counter_follows_creates_reads_and_deletes(self):
+        created = self.notify(self.user, 4)
+        Notification.objects.create(user=self.user, transmission_time=timezone.now(),
+                                    notification_type='update', message='single')
+        self.assertEqual(self.unread(self.user), 5)
+
+        response = self.client.post(reverse('notification-inbox-read'), {'ids': [created[0].id, created[1].id]}, format='json')
+        self.assertEqual((response.data['marked'], response.data['unread_count']), (2, 3))
+        # marking again changes nothing
+        response = self.client.post(reverse('notification-inbox-read'), {'ids': [created[0].id]}, format='json')
+        self.assertEqual((response.data['marked'], response.data['unread_count']), (0, 3))
+
+        self.client.delete(reverse('notification-detail', args=[created[2].id]))
+        self.assertEqual(self.client.get(reverse('notification-unread-count')).data['unread_count'], 2)
+        response = self.client.post(reverse('notification-inbox-read'), {'up_to': created[-1].id + 1}, format='json')
+        self.assertEqual(response.data['unread_count'], 0)
+
+    def test_old_notifications_are_archived(self):
+        old = timezone.now() - timedelta(days=120)
+        self.notify(self.user, 3, when=old)
+        self.notify(self.user, 1)
+        self.assertEqual(archive_notifications(), 3)
+        self.assertEqual(NotificationArchive.objects.filter(user=self.user).count(), 3)
+        self.assertEqual(Notification.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(self.unread(self.user), 1)
+
+
+class ConditionalGetTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.patient = make_user('patient1').patients
+
+    def test_detail_revalidates_with_one_query(self):
+        url = reverse('patient-detail', args=[self.patient.pk])
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # the nested user is part of the representation
+        user = User.objects.get(pk=self.patient.user_id)
+        user.name = 'Renamed'
+        user.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_list_etag_changes_when_a_row_is_deleted(self):
+        make_user('patient2')
+        url = reverse('patient-list')
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Patient.objects.filter(pk=self.patient.pk).delete()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_list_validators_come_from_the_page_query(self):
+        user = self.patient.user
+        deliver([Notification(user=user, transmission_time=timezone.now(), notification_type='reminder',
+                              message=f'n{i}') for i in range(5)])
+        url = reverse('notification-list')
+        first = self.client.get(url, {'page_size': 2})
+        etag = first['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'page_size': 2}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('LIMIT 3', queries[0]['sql'])
+        self.assertNotIn('COUNT(', queries[0]['sql'].upper())
+
+        # A change outside the page leaves it valid; one inside it does not
+        Notification.objects.filter(message='n0').update(is_read=True, updated_at=timezone.now())
+        self.assertEqual(self.client.get(url, {'page_size': 2}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Notification.objects.filter(message='n4').update(is_read=True, updated_at=timezone.now())
+        self.assertEqual(self.client.get(url, {'page_size': 2}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_profile_supports_conditional_get(self):
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(self.patient.user))
+        response = self.client.get(reverse('profile-update'))
+        self.assertEqual(response.data['username'], 'patient1')
+
+        response = self.client.get(reverse('profile-update'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class RelationshipCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.patient = make_user('patient1').patients
+        self.companion = make_user('companion1', account_type='companions').companions
+        self.companion.patient = self.patient
+        self.companion.save()
+
+    def test_lookups_are_served_from_cache(self):
+        companion_links = [{'companion_id': self.companion.pk, 'user_id': self.companion.user_id}]
+        self.assertEqual(companions_of_patient(self.patient.user_id), companion_links)
+        patient_of_companion(self.companion.user_id)
+        with self.assertNumQueries(0):
+            self.assertEqual(companions_of_patient(self.patient.user_id), companion_links)
+            self.assertEqual(patient_of_companion(self.companion.user_id),
+                             {'patient_id': self.patient.pk, 'user_id': self.patient.user_id})
+
+    def test_relinking_and_deleting_invalidate_both_sides(self):
+        other = make_user('patient2').patients
+        companions_of_patient(self.patient.user_id)
+        companions_of_patient(other.user_id)
+
+        companion = Companion.objects.get(pk=self.companion.pk)
+        companion.patient = other
+        companion.save()
+        self.assertEqual(companions_of_patient(self.patient.user_id), [])
+        self.assertEqual([c['user_id'] for c in companions_of_patient(other.user_id)], [companion.user_id])
+        self.assertEqual(patient_of_companion(companion.user_id)['patient_id'], other.pk)
+
+        other.delete()
+        self.assertIsNone(patient_of_companion(companion.user_id))
+
+
+def writes(queries):
+    return [q['sql'].split()[0] for q in queries.captured_queries if q['sql'].split()[0] in ('INSERT', 'UPDATE', 'DELETE')]
+
+
+class ProfileWritePathTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        throttling._store = None
+        self.user = make_user('patient1', password='pass12345', phone_number='0100')
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(self.user))
+
+    def login(self):
+        response = self.client.post(reverse('custom_token_obtain_pair'),
+                                    {'email': self.user.email, 'password': 'pass12345'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_login_writes_nothing(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.login()
+        self.assertEqual(writes(queries), [])
+
+    def test_last_login_update_skips_profile_sync(self):
+        # What simplejwt runs when UPDATE_LAST_LOGIN is turned on
+        with CaptureQueriesContext(connection) as queries:
+            update_last_login(None, self.user)
+        self.assertEqual(writes(queries), ['UPDATE'])
+
+    def test_profile_patch_updates_only_changed_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(reverse('profile-update'), {'phone_number': '0199'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        self.assertNotIn('"password"', updates[0])
+        self.assertEqual(Patient.objects.get(user=self.user).phone_number, '0199')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.patch(reverse('profile-update'), {'phone_number': '0199'}, format='json')
+        self.assertEqual(writes(queries), ['UPDATE'])  # the user row only; the patient is already in sync
+
+    def test_patient_relinking_writes_only_the_link(self):
+        old = make_user('companion1', account_type='companions').companions
+        old.patient = self.user.patients
+        old.save()
+        new = make_user('companion2', account_type='companions').companions
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(reverse('profile-update'), {'companion_username': 'companion2'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        updates = [q['sql'] for q in queries.captured_queries if 'UPDATE "Users_companion"' in q['sql']]
+        self.assertEqual(len(updates), 2)
+        for sql in updates:
+            self.assertIn('"patient_id"', sql)
+            self.assertNotIn('"phone_number"', sql)
+        self.assertEqual(Companion.objects.get(pk=new.pk).patient_id, self.user.patients.pk)
+        self.assertIsNone(Companion.objects.get(pk=old.pk).patient_id)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.patch(reverse('profile-update'), {'companion_username': 'companion2'}, format='json')
+        self.assertFalse([q for q in queries.captured_queries if 'UPDATE "Users_companion"' in q['sql']])
+
+    def test_registration_inserts_user_and_profile_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('register'), {
+                'username': 'companion1', 'email': 'companion1@example.com', 'password': 'pass12345',
+                'account_type': 'companions', 'phone_number': '0155', 'name': 'Companion',
+                'patient_username': 'patient1', 'relationship': 'child',
+            }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(writes(queries), ['INSERT', 'INSERT'])
+        companion = Companion.objects.get(user__username='companion1')
+        self.assertEqual((companion.patient.user_id, companion.relationship, companion.phone_number),
+                         (self.user.pk, 'child', '0155'))
+
+
+@override_settings(THROTTLE_BUCKETS={'login': (2, 60), 'password_reset': (10, 60), 'password_reset_email': (1, 1)})
+class ThrottlingTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        throttling._store = None
+        self.user = make_user('patient1', password='pass12345')
+
+    def test_bucket_refills_over_time(self):
+        store = throttling.InMemoryBucketStore()
+        self.assertEqual([store.consume('k', 2, 1, now=0)[0] for _ in range(3)], [True, True, False])
+        self.assertEqual(store.consume('k', 2, 1, now=0.5), (False, 0.5))
+        self.assertEqual(store.consume('k', 2, 1, now=1.5), (True, 0))
+        self.assertTrue(store.consume('other', 2, 1, now=1.5)[0])
+
+    def test_store_evicts_least_recently_used_bucket(self):
+        store = throttling.InMemoryBucketStore()
+        store.MAX_BUCKETS = 2
+        store.consume('login:a', 1, 1, now=0)
+        store.consume('password_reset_email:b', 1, 1000, now=0)
+        store.consume('login:a', 1, 1, now=0.1)  # a is drained and now the most recent
+        store.consume('password_reset_email:c', 1, 1000, now=10)  # a different scope's refilled rate is irrelevant
+        self.assertEqual(list(store._buckets), ['login:a', 'password_reset_email:c'])
+        self.assertFalse(store.consume('login:a', 1, 1, now=0.2)[0])
+
+    def test_login_flood_is_refused_before_hashing(self):
+        payload = {'email': self.user.email, 'password': 'wrong'}
+        for _ in range(2):
+            self.assertEqual(self.client.post(reverse('custom_token_obtain_pair'), payload, format='json').status_code, 401)
+        with mock.patch('django.contrib.auth.hashers.PBKDF2PasswordHasher.verify') as verify:
+            response = self.client.post(reverse('custom_token_obtain_pair'), payload, format='json')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        verify.assert_not_called()
+
+        # Another client is not affected
+        response = self.client.post(reverse('custom_token_obtain_pair'), {**payload, 'password': 'pass12345'},
+                                    format='json', REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(response.status_code, 200)
+
+    def test_forwarded_for_header_does_not_pick_the_bucket(self):
+        payload = {'email': self.user.email, 'password': 'wrong'}
+        statuses = [
+            self.client.post(reverse('custom_token_obtain_pair'), payload, format='json',
+                             HTTP_X_FORWARDED_FOR=f'203.0.113.{i}').status_code
+            for i in range(4)
+        ]
+        self.assertEqual(statuses, [401, 401, 429, 429])
+
+    def test_password_reset_is_limited_per_address(self):
+        url = reverse('password_reset_request')
+        self.assertEqual(self.client.post(url, {'email': self.user.email}).status_code, 200)
+        response = self.client.post(url, {'email': self.user.email.upper()}, REMOTE_ADDR='10.0.0.3')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(OutboundEmail.objects.count(), 1)
+
+    def test_sos_is_never_throttled(self):
+        companion = make_user('companion1', account_type='companions').companions
+        companion.patient = self.user.patients
+        companion.save()
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(self.user))
+        with self.settings(THROTTLE_BUCKETS={'login': (1, 1), 'register': (1, 1)}):
+            for is_active in (True, False) * 5:
+                response = self.client.post(reverse('sos'), {'is_active': is_active}, format='json')
+                self.assertEqual(response.status_code, 200)
+
+
+@override_settings(METRICS_TOKEN='scrape-me')
+class RequestMetricsTests(APITestCase):
+    def setUp(self):
+        metrics.registry.clear()
+        self.patient = make_user('patient1').patients
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(self.patient.user))
+
+    def scrape(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer scrape-me')
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_routes_are_recorded_by_pattern(self):
+        for _ in range(2):
+            self.client.get(reverse('patient-detail', args=[self.patient.pk]))
+        self.client.get(reverse('patient-detail', args=[self.patient.pk + 100]))
+        body = self.scrape()
+
+        labels = 'route="patients/<int:pk>/",method="GET"'
+        self.assertIn(f'http_request_duration_seconds_count{{{labels}}} 3', body)
+        self.assertIn(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 3', body)
+        self.assertIn(f'http_responses_total{{{labels},status="200"}} 2', body)
+        self.assertIn(f'http_responses_total{{{labels},status="404"}} 1', body)
+        for name in ('http_request_db_queries_sum', 'http_request_serializer_seconds_total', 'http_response_bytes_total'):
+            value = re.search(r'^%s\{%s\} (\S+)$' % (name, re.escape(labels)), body, re.M).group(1)
+            self.assertGreater(float(value), 0, name)
+        self.assertNotIn('route="metrics/"', body)
+
+    def test_unknown_methods_share_one_series(self):
+        url = reverse('patient-detail', args=[self.patient.pk])
+        for method in ('FOO', 'BAR', 'PROPFIND'):
+            self.client.generic(method, url)
+        body = self.scrape()
+
+        self.assertIn('http_request_duration_seconds_count{route="patients/<int:pk>/",method="other"} 3', body)
+        self.assertNotIn('method="FOO"', body)
+        self.assertNotIn('method="PROPFIND"', body)
+
+    def test_scrape_needs_the_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    def test_slow_requests_are_logged_with_sql(self):
+        with self.settings(METRICS_SLOW_REQUEST_MS=0), self.assertLogs('Users.metrics', 'WARNING') as logs:
+            self.client.get(reverse('patient-detail', args=[self.patient.pk]))
+        self.assertIn('SELECT', logs.output[0])
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.counts = benchmark.seed(patients=4, locations=40, notifications=10, tasks=8, batch_size=7)
+
+    def test_seed_keeps_counters_consistent(self):
+        self.assertEqual(self.counts, {'patients': 4, 'companions': 4, 'locations': 40, 'notifications': 10, 'tasks': 8})
+        for user in User.objects.filter(account_type='patients'):
+            self.assertEqual(user.unread_notifications, user.notifications.filter(is_read=False).count())
+        self.assertEqual(Companion.objects.filter(patient__isnull=False).count(), 4)
+
+    def test_run_reports_every_scenario_and_rolls_back(self):
+        out = StringIO()
+        call_command('run_benchmark', '--requests', '4', '--warmup', '1', stdout=out)
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(set(report), set(benchmark.SCENARIOS))
+        for name, result in report.items():
+            self.assertEqual(sum(result['statuses'].values()), 4)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+        self.assertEqual(report['login']['statuses'], {'200': 4})
+        self.assertEqual(report['location_ingest']['statuses'], {'201': 4})
+        self.assertEqual(Location.objects.count(), 40)
+
+        slower = {name: {**result, 'p99_ms': result['p99_ms'] / 10, 'queries_max': 0} for name, result in report.items()}
+        self.assertEqual(len(benchmark.regressions(report, slower, 0.25)), 2 * len(report))
+
+
+class GeofenceTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.patient = make_user('patient1').patients
+        self.companions = []
+        for i in range(2):
+            companion = make_user(f'companion{i}', account_type='companions').companions
+            companion.patient = self.patient
+            companion.save()
+            self.companions.append(companion)
+        response = self.client.post(reverse('geofence-list'), {
+            'patient': self.patient.pk, 'name': 'Home', 'shape': 'circle',
+            'center_latitude': 30.0444, 'center_longitude': 31.2357, 'radius_m': 200,
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.fence = Geofence.objects.get(pk=response.data['id'])
+        self.minute = 0
+
+    def send(self, *points):
+        fixes = []
+        for lat, lng in points:
+            self.minute += 1
+            fixes.append({'gps_coordinates': f'{lat},{lng}', 'time_coordinates': f'2025-06-01T10:{self.minute:02d}:00Z'})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f"{reverse('location-bulk')}?patient={self.patient.pk}", fixes, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def alerts(self):
+        return list(Notification.objects.filter(notification_type='security').order_by('id').values_list('user_id', 'message'))
+
+    def test_grid_index_matches_exact_shapes(self):
+        square = {'id': 1, 'name': 'Square', 'shape': 'polygon', 'bbox': (30.0, 30.1, 31.0, 31.1),
+                  'vertices': [(30.0, 31.0), (30.1, 31.0), (30.1, 31.1), (30.0, 31.1)]}
+        circle = {'id': 2, 'name': 'Circle', 'shape': 'circle', 'bbox': bounding_box(30.05, 31.05, 500),
+                  'center': (30.05, 31.05), 'radius_m': 500}
+        huge = {'id': 3, 'name': 'City', 'shape': 'circle', 'bbox': bounding_box(30.0, 31.0, 100000),
+                'center': (30.0, 31.0), 'radius_m': 100000}
+        index = GridIndex([square, circle, huge], cell_degrees=0.01, max_cells=500)
+        self.assertEqual(index.everywhere, [huge])
+        self.assertEqual(index.containing(30.05, 31.05), {1, 2, 3})
+        self.assertEqual(index.containing(30.09, 31.09), {1, 3})
+        self.assertEqual(index.containing(30.2, 31.2), {3})
+        self.assertEqual(index.containing(40.0, 31.0), set())
+
+    def test_leaving_and_returning_notify_companions_once(self):
+        self.send((30.0445, 31.2358))  # first fix only records the state
+        self.assertEqual(self.alerts(), [])
+
+        self.send((30.0500, 31.2500), (30.0600, 31.2600))
+        self.send((30.0700, 31.2700))
+        alerts = self.alerts()
+        self.assertEqual(sorted(user_id for user_id, _ in alerts), sorted(c.user_id for c in self.companions))
+        self.assertIn('خرج', alerts[0][1])
+        self.assertIs(Geofence.objects.get(pk=self.fence.pk).patient_inside, False)
+        self.assertEqual(User.objects.get(pk=self.companions[0].user_id).unread_notifications, 1)
+
+        self.send((30.0444, 31.2357))
+        self.assertEqual(len(self.alerts()), 4)
+        self.assertIn('عاد', self.alerts()[-1][1])
+
+    def test_leaving_and_returning_within_one_upload_alerts_twice(self):
+        self.send((30.0445, 31.2358))
+        # Fixes of one upload arrive out of order; the walk follows their times
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"{reverse('location-bulk')}?patient={self.patient.pk}", [
+                {'gps_coordinates': '30.0446,31.2359', 'time_coordinates': '2025-06-01T10:09:00Z'},
+                {'gps_coordinates': '30.0700,31.2700', 'time_coordinates': '2025-06-01T10:05:00Z'},
+                {'gps_coordinates': '30.0445,31.2358', 'time_coordinates': '2025-06-01T10:03:00Z'},
+            ], format='json')
+        messages = [message for _user_id, message in self.alerts()]
+        self.assertEqual(len(messages), 4)
+        self.assertIn('خرج', messages[0])
+        self.assertIn('عاد', messages[-1])
+        fence = Geofence.objects.get(pk=self.fence.pk)
+        self.assertIs(fence.patient_inside, True)
+        self.assertEqual(fence.state_changed_at, datetime(2025, 6, 1, 10, 9, tzinfo=dt_timezone.utc))
+
+    def test_late_fix_does_not_flip_state_back(self):
+        self.send((30.0445, 31.2358))
+        self.send((30.0700, 31.2700))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"{reverse('location-bulk')}?patient={self.patient.pk}", [
+                {'gps_coordinates': '30.0444,31.2357', 'time_coordinates': '2025-06-01T09:00:00Z'}
+            ], format='json')
+        self.assertEqual(len(self.alerts()), 2)
+        self.assertIs(Geofence.objects.get(pk=self.fence.pk).patient_inside, False)
+
+    def test_fence_changes_reach_the_index(self):
+        self.send((30.0445, 31.2358))
+        with CaptureQueriesContext(connection) as queries:
+            self.send((30.0446, 31.2359))
+        self.assertFalse([q for q in queries.captured_queries if 'users_geofence' in q['sql'] and 'shape' in q['sql']])
+
+        response = self.client.patch(reverse('geofence-detail', args=[self.fence.pk]), {'radius_m': 5}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['patient_inside'])
+        self.send((30.0446, 31.2359))
+        self.assertIs(Geofence.objects.get(pk=self.fence.pk).patient_inside, False)
+        self.assertEqual(self.alerts(), [])
+
+    def test_reassigned_fence_leaves_the_old_patient_and_starts_over(self):
+        self.send((30.0445, 31.2358))
+        other = make_user('patient2').patients
+        response = self.client.patch(reverse('geofence-detail', args=[self.fence.pk]), {'patient': other.pk},
+                                     format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['patient_inside'])
+        self.assertIsNone(response.data['state_changed_at'])
+
+        self.send((30.0700, 31.2700))
+        self.assertEqual(self.alerts(), [])
+        self.assertIsNone(Geofence.objects.get(pk=self.fence.pk).patient_inside)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"{reverse('location-bulk')}?patient={other.pk}", [
+                {'gps_coordinates': '30.0700,31.2700', 'time_coordinates': '2025-06-01T11:00:00Z'}
+            ], format='json')
+        self.assertEqual(self.alerts(), [])
+        self.assertIs(Geofence.objects.get(pk=self.fence.pk).patient_inside, False)
+
+    def test_invalid_shapes_are_rejected(self):
+        response = self.client.post(reverse('geofence-list'), {
+            'patient': self.patient.pk, 'name': 'Bad', 'shape': 'polygon', 'vertices': [[30, 31], [30.1, 31]],
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('vertices', response.data)
+        response = self.client.post(reverse('geofence-list'), {
+            'patient': self.patient.pk, 'name': 'Bad', 'shape': 'circle', 'center_latitude': 30, 'center_longitude': 31,
+        }, format='json')
+        self.assertIn('radius_m', response.data)
+
+
+class LastKnownPositionTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.patient = make_user('patient1').patients
+        companion = make_user('companion1', account_type='companions').companions
+        companion.patient = self.patient
+        companion.save()
+        self.companion_user = companion.user
+
+    def send(self, *fixes):
+        return self.client.post(f"{reverse('location-bulk')}?patient={self.patient.pk}", [
+            {'gps_coordinates': gps, 'time_coordinates': time} for gps, time in fixes
+        ], format='json')
+
+    def test_only_newer_fixes_move_the_position(self):
+        self.send(('30.05,31.05', '2025-06-01T10:05:00Z'), ('30.01,31.01', '2025-06-01T10:01:00Z'))
+        position = LastKnownPosition.objects.get(pk=self.patient.pk)
+        self.assertEqual((position.gps_coordinates, position.latitude), ('30.05,31.05', 30.05))
+
+        self.send(('29.00,30.00', '2025-06-01T09:00:00Z'))  # a late upload from the glasses' buffer
+        self.assertEqual(LastKnownPosition.objects.get(pk=self.patient.pk).gps_coordinates, '30.05,31.05')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.send(('30.06,31.06', '2025-06-01T10:06:00Z'))
+        position = LastKnownPosition.objects.get(pk=self.patient.pk)
+        self.assertEqual(position.gps_coordinates, '30.06,31.06')
+        self.assertEqual(position.location_id, Location.objects.latest('time_coordinates').pk)
+        self.assertEqual(len([q for q in queries.captured_queries if 'users_lastknownposition' in q['sql'].lower()]), 1)
+
+    def test_companion_reads_position_with_its_age(self):
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(self.companion_user))
+        self.assertEqual(self.client.get(reverse('location-latest')).status_code, 404)
+
+        fix_time = timezone.now() - timedelta(seconds=90)
+        self.send(('30.05,31.05', fix_time.isoformat()))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('location-latest'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in queries.captured_queries if '"users_location"' in q['sql'].lower()])
+        self.assertEqual((response.data['patient'], response.data['latitude']), (self.patient.pk, 30.05))
+        self.assertGreaterEqual(response.data['age_seconds'], 90)
+        self.assertIn('no-store', response['Cache-Control'])
+
+        stranger = make_user('companion2', account_type='companions')
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(stranger))
+        self.assertEqual(self.client.get(reverse('location-latest')).status_code, 404)
+
+    def test_editing_and_deleting_fixes_keep_the_position_in_the_history(self):
+        self.send(('30.01,31.01', '2025-06-01T10:01:00Z'), ('30.05,31.05', '2025-06-01T10:05:00Z'))
+        older, newest = Location.objects.order_by('time_coordinates')
+
+        # the held fix moves back in time, so the other one becomes the newest
+        response = self.client.patch(reverse('location-detail', args=[newest.pk]),
+                                     {'time_coordinates': '2025-06-01T09:00:00Z'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(LastKnownPosition.objects.get(pk=self.patient.pk).location_id, older.pk)
+
+        # an edit that makes a fix the newest moves the position to it
+        self.client.patch(reverse('location-detail', args=[newest.pk]),
+                          {'gps_coordinates': '30.07,31.07', 'time_coordinates': '2025-06-01T10:07:00Z'}, format='json')
+        position = LastKnownPosition.objects.get(pk=self.patient.pk)
+        self.assertEqual((position.location_id, position.latitude), (newest.pk, 30.07))
+
+        self.assertEqual(self.client.delete(reverse('location-detail', args=[newest.pk])).status_code, 204)
+        position = LastKnownPosition.objects.get(pk=self.patient.pk)
+        self.assertEqual((position.location_id, position.gps_coordinates), (older.pk, '30.01,31.01'))
+
+        self.client.delete(reverse('location-detail', args=[older.pk]))
+        self.assertFalse(LastKnownPosition.objects.filter(pk=self.patient.pk).exists())
+
+
+class LocationRouteTests(APITestCase):
+    def setUp(self):
+        self.patient = make_user('patient1').patients
+        self.start = timezone.now() - timedelta(hours=3)
+
+    def add_fixes(self, coords, step=timedelta(minutes=1)):
+        Location.objects.bulk_create([
+            Location(patient=self.patient, gps_coordinates=f'{lat},{lng}', latitude=lat, longitude=lng,
+                     time_coordinates=self.start + i * step)
+            for i, (lat, lng) in enumerate(coords)
+        ])
+
+    def test_simplify_keeps_spikes_and_drops_collinear_points(self):
+        x = np.arange(11, dtype=float) * 100
+        y = np.zeros(11)
+        y[5] = 50
+        self.assertEqual(list(routes.simplify(x, y, 10)), [0, 4, 5, 6, 10])
+        self.assertEqual(list(routes.simplify(x, y, 60)), [0, 10])
+        self.assertEqual(len(routes.simplify(x, y, 0)), 11)
+
+    def test_vectorized_distance_matches_scalar_haversine(self):
+        lat = np.array([30.0, 30.01, 30.02, 30.5])
+        lng = np.array([31.0, 31.02, 31.0, 32.0])
+        steps = routes.haversine_m(lat[:-1], lng[:-1], lat[1:], lng[1:])
+        for i, step in enumerate(steps):
+            self.assertAlmostEqual(step, haversine_m(lat[i], lng[i], lat[i + 1], lng[i + 1]), places=6)
+
+    def test_route_reports_distance_dwell_and_polyline(self):
+        walk = [(30.0 + i * 0.001, 31.0) for i in range(10)]  # ~111 m per minute, due north
+        stay = [(30.0091 + (i % 2) * 0.00005, 31.0) for i in range(15)]
+        self.add_fixes(walk + stay)
+
+        route = routes.build_route(self.patient.pk, self.start, self.start + timedelta(hours=1), 10, 50, 10)
+        self.assertEqual((route['resolution'], route['fix_count']), ('raw', 25))
+        self.assertAlmostEqual(route['distance_m'], 9 * 111.2 + 11.1 + 14 * 5.6, delta=2)
+        # The walk collapses to its ends; the jitter in the stay is under the tolerance
+        self.assertLess(len(route['polyline']), 5)
+        self.assertEqual(route['polyline'][0]['latitude'], 30.0)
+        dwell, = route['dwells']
+        self.assertEqual(dwell['fix_count'], 16)
+        self.assertEqual(dwell['duration_s'], 15 * 60)
+
+    def test_slow_walk_is_not_a_dwell(self):
+        self.add_fixes([(30.0 + i * 0.0002, 31.0) for i in range(30)])  # 22 m a minute for half an hour
+        route = routes.build_route(self.patient.pk, self.start, self.start + timedelta(hours=1), 10, 50, 10)
+        self.assertEqual(route['dwells'], [])
+        self.assertEqual(len(route['polyline']), 2)
+
+    def test_route_endpoint(self):
+        self.add_fixes([(30.0, 31.0), (30.001, 31.0)])
+        url = reverse('location-route')
+        response = self.client.get(url, {'patient': self.patient.pk, 'tolerance': 5})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.data['tolerance_m'], response.data['point_count']), (5, 2))
+
+        self.assertEqual(self.client.get(url, {'patient': self.patient.pk, 'tolerance': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'patient': self.patient.pk, 'tolerance': 5000}).status_code, 400)
+        self.assertEqual(self.client.get(url, {
+            'patient': self.patient.pk, 'start': '2025-01-01T00:00:00Z', 'end': '2025-06-01T00:00:00Z',
+        }).status_code, 400)
+        empty = self.client.get(url, {'patient': self.patient.pk + 1})
+        self.assertEqual((empty.data['distance_m'], empty.data['polyline']), (0.0, []))
+
+
+class HistoryExportTests(APITestCase):
+    def setUp(self):
+        self.patient = make_user('patient1').patients
+        self.start = datetime(2025, 6, 1, 10, 0, tzinfo=dt_timezone.utc)
+        Location.objects.bulk_create([
+            Location(patient=self.patient, gps_coordinates=f'30.{i:04d},31.0', latitude=30 + i / 10000,
+                     longitude=31.0, time_coordinates=self.start + timedelta(minutes=i))
+            for i in range(25)
+        ])
+
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(self.patient.user))
+
+    def body(self, response):
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content)
+
+    @override_settings(EXPORT_CHUNK_SIZE=7, EXPORT_FLUSH_BYTES=100)
+    def test_csv_is_streamed_in_chunks(self):
+        chunks = list(exports.stream('locations', self.patient))
+        self.assertGreater(len(chunks), 5)
+        rows = list(csv.reader(b''.join(chunks).decode('utf-8-sig').splitlines()))
+        self.assertEqual(rows[0], ['id', 'time_coordinates', 'gps_coordinates', 'latitude', 'longitude'])
+        self.assertEqual(len(rows), 26)
+        self.assertEqual(rows[1][1], '2025-06-01T10:00:00+00:00')
+
+    def test_ndjson_gzip_endpoint_with_range(self):
+        url = reverse('patient-export', args=[self.patient.pk, 'locations'])
+        response = self.client.get(url, {'output': 'ndjson', 'gzip': '1', 'start': '2025-06-01T10:20:00Z'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn(f'patient-{self.patient.pk}-locations.ndjson.gz', response['Content-Disposition'])
+        lines = gzip.decompress(self.body(response)).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['gps_coordinates'] for line in lines],
+                         [f'30.{i:04d},31.0' for i in range(20, 25)])
+
+        self.assertEqual(self.client.get(reverse('patient-export', args=[self.patient.pk, 'users'])).status_code, 404)
+        self.assertEqual(self.client.get(url, {'output': 'xml'}).status_code, 400)
+
+    def test_export_is_limited_to_the_linked_patient(self):
+        url = reverse('patient-export', args=[self.patient.pk, 'locations'])
+        companion = make_user('companion1', account_type='companions').companions
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(companion.user))
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        companion.patient = self.patient
+        companion.save()
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(companion.user))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        other = make_user('patient2')
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(other))
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.credentials()
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+    def test_notifications_merge_the_archive_by_time(self):
+        user_id = self.patient.user_id
+        Notification.objects.create(user_id=user_id, transmission_time=self.start, notification_type='reminder',
+                                    message='تذكير بالدواء')
+        NotificationArchive.objects.create(
+            original_id=1, user_id=user_id, transmission_time=self.start - timedelta(days=100),
+            notification_type='reminder', message='old', is_read=True, archived_at=self.start,
+        )
+        lines = b''.join(exports.stream('notifications', self.patient, 'ndjson')).decode('utf-8').splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([(row['message'], row['archived']) for row in rows], [('old', True), ('تذكير بالدواء', False)])
+
+    def test_command_writes_gzip_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'locations.csv.gz')
+        call_command('export_history', self.patient.pk, 'locations', '--gzip', '--output', path, stderr=StringIO())
+        with gzip.open(path, 'rt', encoding='utf-8-sig') as handle:
+            self.assertEqual(len(handle.read().splitlines()), 26)
+
+        out = StringIO()
+        call_command('export_history', self.patient.pk, 'tasks', '--output-format', 'ndjson', stdout=out)
+        self.assertEqual(out.getvalue(), '')
+
+
+class BulkProvisioningTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.existing = make_user('patient1').patients
+        companions_of_patient(self.existing.user_id)  # cached, must be dropped by the import
+
+    def rows(self):
+        return [
+            {'username': 'p2', 'email': 'p2@example.com', 'password': 'secret-pass-1', 'account_type': 'patients',
+             'phone_number': '0100000002', 'name': 'P Two', 'medical_condition': 'Glaucoma'},
+            {'username': 'c2', 'email': 'c2@example.com', 'password': 'secret-pass-2', 'account_type': 'companions',
+             'phone_number': '0100000003', 'patient_username': 'p2', 'relationship': 'child'},
+            {'username': 'c3', 'email': 'c3@example.com', 'password': 'secret-pass-3', 'account_type': 'companions',
+             'phone_number': '0100000004', 'patient_username': 'patient1', 'relationship': 'spouse'},
+        ]
+
+    def test_provision_creates_users_profiles_and_links(self):
+        report = provisioning.provision(self.rows(), workers=2)
+
+        self.assertEqual(report['created'], {'patients': 1, 'companions': 2, 'links': 2})
+        patient = Patient.objects.get(user__username='p2')
+        self.assertEqual((patient.name, patient.phone_number, patient.medical_condition),
+                         ('P Two', '0100000002', 'Glaucoma'))
+        self.assertEqual(Companion.objects.get(user__username='c2').patient, patient)
+        self.assertTrue(User.objects.get(username='c3').check_password('secret-pass-3'))
+        self.assertEqual([c['user_id'] for c in companions_of_patient(self.existing.user_id)],
+                         [User.objects.get(username='c3').pk])
+
+    def test_dry_run_reports_every_problem_and_writes_nothing(self):
+        rows = self.rows() + [
+            {'username': 'c4', 'email': 'c2@example.com', 'password': 'x', 'account_type': 'companions',
+             'phone_number': '0100000005', 'patient_username': 'nobody'},
+            {'username': 'patient1', 'email': 'new@example.com', 'password': 'x', 'account_type': 'patients',
+             'phone_number': '0100000006', 'relationship': 'child'},
+            {'username': 'p5', 'email': 'not-an-email', 'account_type': 'patients', 'phone_number': '1'},
+        ]
+        users = User.objects.count()
+        with self.assertNumQueries(4):
+            report = provisioning.provision(rows, dry_run=True)
+
+        self.assertEqual((report['valid'], report['invalid']), (3, 3))
+        errors = {entry['row']: entry['errors'] for entry in report['errors']}
+        self.assertEqual(set(errors[4]), {'email', 'patient_username'})
+        self.assertIn('non_field_errors', errors[5])
+        self.assertEqual(set(errors[6]), {'email', 'password'})
+        self.assertEqual(User.objects.count(), users)
+
+    def test_unknown_account_type_is_rejected_per_row(self):
+        rows = self.rows() + [
+            {'username': 'a1', 'email': 'a1@example.com', 'password': 'secret-pass-9', 'account_type': 'admins',
+             'phone_number': '0100000009'},
+        ]
+        users = User.objects.count()
+        report = provisioning.provision(rows, workers=1)
+
+        self.assertEqual((report['valid'], report['invalid']), (3, 1))
+        self.assertEqual(report['errors'][0]['row'], 4)
+        self.assertEqual(set(report['errors'][0]['errors']), {'account_type'})
+        self.assertEqual(report['created'], {'patients': 0, 'companions': 0, 'links': 0})
+        self.assertEqual(User.objects.count(), users)
+
+    def test_command_reads_csv(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        def write(name, rows):
+            path = os.path.join(directory, name)
+            fields = list(dict.fromkeys(field for row in rows for field in row))
+            with open(path, 'w', newline='') as handle:
+                writer = csv.DictWriter(handle, fieldnames=fields, restval='')
+                writer.writeheader()
+                writer.writerows(rows)
+            return path
+
+        orphan = write('orphan.csv', self.rows()[1:2])  # c2 names p2, which is not in the file
+        with self.assertRaisesRegex(CommandError, 'Nothing was created'):
+            call_command('provision_accounts', orphan, stdout=StringIO())
+
+        path = write('facility.csv', self.rows())
+        out = StringIO()
+        call_command('provision_accounts', path, '--dry-run', stdout=out)
+        self.assertIn('3 valid, 0 invalid', out.getvalue())
+        self.assertFalse(User.objects.filter(username='p2').exists())
+
+        call_command('provision_accounts', path, '--workers', '1', stdout=out)
+        self.assertIn('Created 1 patients and 2 companions', out.getvalue())
+
+    def test_endpoint_is_staff_only(self):
+        url = reverse('provision')
+        self.assertEqual(self.client.post(url, self.rows(), format='json').status_code, 401)
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(self.existing.user))
+        self.assertEqual(self.client.post(url, self.rows(), format='json').status_code, 403)
+
+        admin = make_user('admin', account_type='companions', is_staff=True)
+        self.client.credentials(HTTP_AUTHORIZATION=bearer(admin))
+        with mock.patch.object(provisioning, 'ProcessPoolExecutor') as pool:
+            self.assertEqual(self.client.post(f'{url}?dry_run=1', self.rows(), format='json').status_code, 200)
+            body = 'username,email,password,account_type,phone_number\nx1,x1@example.com,pw,patients,0100000009\n'
+            response = self.client.post(f'{url}?dry_run=1', body, content_type='text/csv')
+            self.assertEqual((response.status_code, response.data['valid']), (200, 1))
+            response = self.client.post(url, self.rows(), format='json')
+        self.assertEqual(response.status_code, 201)
+        pool.assert_not_called()  # no worker processes forked from the web worker
+        self.assertEqual(response.data['created']['companions'], 2)
+        self.assertEqual(self.client.post(url, self.rows(), format='json').status_code, 400)
+        with override_settings(PROVISION_API_MAX_ROWS=2):
+            self.assertEqual(self.client.post(url, self.rows(), format='json').status_code, 400)
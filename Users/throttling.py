@@ -0,0 +1,174 @@
+"""
+Token-bucket throttling for the unauthenticated, expensive endpoints.
+
+Every login attempt runs PBKDF2 and every password reset queues an email, so
+these endpoints are limited per client before any of that work starts. Each
+scope in ``THROTTLE_BUCKETS`` is a bucket of ``burst`` tokens refilled at
+``per_minute``; a request takes one token or is refused with 429 and a
+``Retry-After`` header, which costs a single store round trip.
+
+The store is chosen with ``THROTTLE_STORE``. ``InMemoryBucketStore`` only
+counts requests served by the same process; deployments with several
+workers should use ``RedisBucketStore`` so the limit is shared. If Redis is
+unreachable requests are let through rather than failing logins.
+
+``SOSView`` is deliberately never throttled: an alert must not be refused
+because its sender, or someone on the same network, was rate limited, and
+refused floods are cheap enough not to hold up the workers serving it.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+
+def refill(tokens, stamp, now, burst, rate):
+    """Tokens in a bucket last left at ``tokens`` at time ``stamp``."""
+    if tokens is None:
+        return burst
+    return min(burst, tokens + max(now - stamp, 0) * rate)
+
+
+class InMemoryBucketStore:
+    """Buckets in an LRU dict, shared by the threads of one process."""
+
+    # Past this many buckets the least recently used one is dropped; it has been idle longest, so it is the
+    # likeliest to have refilled, and eviction stays O(1) whatever scopes the buckets belong to
+    MAX_BUCKETS = 10000
+
+    def __init__(self):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, burst, rate, now=None):
+        """Take a token; returns ``(allowed, seconds until one is available)``."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (None, now))
+            tokens = refill(tokens, stamp, now, burst, rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+# KEYS[1] bucket; ARGV burst, rate (tokens per second). Uses the server clock so workers need not agree on time.
+CONSUME_SCRIPT = """
+local burst = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = burst
+if bucket[1] then
+    tokens = math.min(burst, tonumber(bucket[1]) + math.max(now - tonumber(bucket[2]), 0) * rate)
+end
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisBucketStore:
+    """Buckets in Redis hashes, updated atomically by a Lua script."""
+
+    def __init__(self, url=None):
+        import redis
+
+        self.client = redis.Redis.from_url(url or settings.THROTTLE_REDIS_URL)
+        self.script = self.client.register_script(CONSUME_SCRIPT)
+
+    def consume(self, key, burst, rate, now=None):
+        import redis
+
+        try:
+            allowed, tokens = self.script(keys=[f'throttle:{key}'], args=[burst, rate])
+        except redis.RedisError:
+            logger.warning("Throttle store unreachable; letting %s through", key, exc_info=True)
+            return True, 0
+        if allowed:
+            return True, 0
+        return False, (1 - float(tokens)) / rate
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = import_string(settings.THROTTLE_STORE)()
+    return _store
+
+
+@receiver(setting_changed)
+def reset_store(setting, **kwargs):
+    global _store
+    if setting in ('THROTTLE_STORE', 'THROTTLE_REDIS_URL'):
+        _store = None
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Limit per ``scope``, keyed on the user when authenticated, else on the client IP."""
+
+    scope = None
+
+    def get_ident_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            return f'user:{request.user.pk}'
+        return f'ip:{self.get_ident(request)}'
+
+    def allow_request(self, request, view):
+        config = settings.THROTTLE_BUCKETS.get(self.scope)
+        if config is None:
+            return True
+        key = self.get_ident_key(request, view)
+        if key is None:
+            return True
+        burst, per_minute = config
+        allowed, self._wait = get_store().consume(f'{self.scope}:{key}', burst, per_minute / 60)
+        return allowed
+
+    def wait(self):
+        return self._wait
+
+
+class LoginThrottle(TokenBucketThrottle):
+    scope = 'login'
+
+
+class RegistrationThrottle(TokenBucketThrottle):
+    scope = 'register'
+
+
+class PasswordResetThrottle(TokenBucketThrottle):
+    scope = 'password_reset'
+
+
+class PasswordResetEmailThrottle(TokenBucketThrottle):
+    """Per target address, so one inbox cannot be flooded from many IPs."""
+
+    scope = 'password_reset_email'
+
+    def get_ident_key(self, request, view):
+        email = str(request.data.get('email', '')).strip().lower()
+        return f'email:{email}' if email else None
@@ -1,33 +1,141 @@
+import hashlib
+import math
+
 from rest_framework import generics
-from .models import User, Companion, Patient, Reminder, Location, Task, Notification
+from .models import User, Companion, Patient, Reminder, Location, Task, Notification, Geofence, LastKnownPosition
 from .serializers import (
     UserSerializer, CompanionSerializer, PatientSerializer, 
-    ReminderSerializer, LocationSerializer, TaskSerializer, NotificationSerializer,
+    ReminderSerializer, LocationSerializer, LocationIngestSerializer, TaskSerializer, NotificationSerializer,
     ProfileSerializer, CompanionProfileSerializer, PatientProfileSerializer,
-    CustomTokenObtainPairSerializer
+    CustomTokenObtainPairSerializer, InboxNotificationSerializer, NotificationReadSerializer, GeofenceSerializer,
+    LastKnownPositionSerializer
 )
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from django.contrib.auth.tokens import default_token_generator
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.utils.encoding import force_bytes
-from django.core.mail import send_mail
 from rest_framework.views import APIView
 from rest_framework import status
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.authentication import TokenAuthentication, BasicAuthentication
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from rest_framework_simplejwt.views import TokenObtainPairView
-from django.shortcuts import render
+from django.shortcuts import get_object_or_404, render
+from django.http import StreamingHttpResponse
 from django.conf import settings
 from django.utils import timezone
+from django.db import transaction
+from django.db.models import F
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from rest_framework.exceptions import ValidationError
+from .parsers import CSVParser, NDJSONParser
+from .geo import EARTH_RADIUS_M, bounding_box
+from .locations import last_position_holders, recompute_last_positions, record_locations, update_last_positions
+from .alerts import DUPLICATE, NO_RECIPIENTS, dispatch_sos
+from .mail import enqueue_email
+from .authentication import RevocableJWTAuthentication, revoke_session
+from .history import location_history
+from .routes import build_route
+from . import exports, inbox, provisioning
+from .relations import companions_of_patient
+from .throttling import LoginThrottle, PasswordResetEmailThrottle, PasswordResetThrottle, RegistrationThrottle
+from django.utils.dateparse import parse_datetime
+from datetime import timedelta
 
 User = get_user_model()
 
+class EagerLoadingViewMixin:
+    """Builds the view's queryset from the relations its serializer declares."""
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        serializer_class = self.get_serializer_class()
+        if hasattr(serializer_class, 'setup_eager_loading'):
+            queryset = serializer_class.setup_eager_loading(queryset)
+        return queryset
+
+class ConditionalGetMixin:
+    """
+    Strong ETag / Last-Modified for retrieve and list, from ``updated_at`` columns.
+
+    A retrieve reads its validators with one small query (``etag_fields`` of
+    the row), so a matching ``If-None-Match`` or ``If-Modified-Since`` gets a
+    304 without loading or serializing anything. A list builds them from the
+    page it already fetches (the cursor paginator's ``LIMIT n+1`` query): the
+    ids and ``etag_fields`` of its rows and its next/previous links, so a
+    matching page is not serialized and no query ever covers the whole
+    filtered table. ``etag_fields`` must cover every table the serializer
+    reads, e.g. ``user__updated_at`` for a nested user (which the eager
+    loading has already joined).
+    """
+    etag_fields = ('updated_at',)
+
+    def make_validators(self, stamps, *extra):
+        known = [stamp for stamp in stamps if stamp is not None]
+        last_modified = int(max(known).timestamp()) if known else None
+        key = repr((type(self).__name__, self.request.get_full_path(), [str(stamp) for stamp in stamps], extra))
+        return f'"{hashlib.sha1(key.encode()).hexdigest()}"', last_modified
+
+    def detail_validators(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        row = (
+            self.get_queryset().prefetch_related(None)
+            .filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+            .values_list(*self.etag_fields).first()
+        )
+        return None if row is None else self.make_validators(row)
+
+    def list_validators(self, rows):
+        stamps = []
+        for row in rows:
+            for field in self.etag_fields:
+                value = row
+                for attr in field.split('__'):
+                    value = getattr(value, attr, None) if value is not None else None
+                stamps.append(value)
+        links = (self.paginator.get_next_link(), self.paginator.get_previous_link()) if self.paginator else ()
+        return self.make_validators(stamps, [row.pk for row in rows], links)
+
+    def conditional(self, validators, handler, request, *args, honour_modified_since=True, **kwargs):
+        if validators is None:
+            return handler(request, *args, **kwargs)
+        etag, last_modified = validators
+        not_modified = get_conditional_response(
+            request._request, etag=etag, last_modified=last_modified if honour_modified_since else None
+        )
+        response = not_modified or handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(self.detail_validators(), super().retrieve, request, *args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        rows = list(queryset) if page is None else page
+
+        def render_page(request, *args, **kwargs):
+            serializer = self.get_serializer(rows, many=True)
+            if page is None:
+                return Response(serializer.data)
+            return self.get_paginated_response(serializer.data)
+
+        # A deleted row does not move the newest timestamp, so only the ETag (which lists the ids) decides
+        return self.conditional(self.list_validators(rows), render_page, request, *args,
+                                honour_modified_since=False, **kwargs)
+
 class PasswordResetRequestView(APIView):
     permission_classes = [AllowAny]
+    throttle_classes = [PasswordResetThrottle, PasswordResetEmailThrottle]
 
     def post(self, request):
         email = request.data.get("email", "").strip()
@@ -44,12 +152,11 @@ class PasswordResetRequestView(APIView):
         uid = urlsafe_base64_encode(force_bytes(user.pk))
         reset_link = f"https://your-frontend.com/reset-password?uid={uid}&token={token}"
 
-        send_mail(
+        enqueue_email(
             "Reset Your Password",
             f"Click the link below to reset your password:\n{reset_link}",
-            settings.EMAIL_HOST_USER,
             [user.email],
-            fail_silently=False,
+            from_email=settings.EMAIL_HOST_USER,
         )
 
         return Response({"message": "A password reset link has been sent to your email."}, status=status.HTTP_200_OK)
@@ -104,79 +211,402 @@ class PasswordResetConfirmView(APIView):
         except Exception as e:
             return Response({"error": "Failed to reset password. Please try again."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-class UserListCreateView(generics.ListCreateAPIView):
+class UserListCreateView(ConditionalGetMixin, EagerLoadingViewMixin, generics.ListCreateAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [AllowAny]  
+    filter_fields = {'account_type': 'account_type'}
+    cursor_ordering = '-id'
 
-class UserDetailView(generics.RetrieveUpdateDestroyAPIView):
+class UserDetailView(ConditionalGetMixin, EagerLoadingViewMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [AllowAny]  
 
-class PatientListCreateView(generics.ListCreateAPIView):
+class PatientListCreateView(ConditionalGetMixin, EagerLoadingViewMixin, generics.ListCreateAPIView):
     queryset = Patient.objects.all()
     serializer_class = PatientSerializer
     permission_classes = [AllowAny]  
+    etag_fields = ('updated_at', 'user__updated_at')
+    filter_fields = {'user': 'user_id'}
+    cursor_ordering = '-id'
 
-class PatientDetailView(generics.RetrieveUpdateDestroyAPIView):
+class PatientDetailView(ConditionalGetMixin, EagerLoadingViewMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Patient.objects.all()
     serializer_class = PatientSerializer
     permission_classes = [AllowAny]  
+    etag_fields = ('updated_at', 'user__updated_at')
 
-class CompanionListCreateView(generics.ListCreateAPIView):
+class CompanionListCreateView(ConditionalGetMixin, EagerLoadingViewMixin, generics.ListCreateAPIView):
     queryset = Companion.objects.all()
     serializer_class = CompanionSerializer
     permission_classes = [AllowAny] 
+    etag_fields = ('updated_at', 'user__updated_at')
+    filter_fields = {'user': 'user_id', 'patient': 'patient_id'}
+    cursor_ordering = '-id'
 
-class CompanionDetailView(generics.RetrieveUpdateDestroyAPIView):
+class CompanionDetailView(ConditionalGetMixin, EagerLoadingViewMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Companion.objects.all()
     serializer_class = CompanionSerializer
     permission_classes = [AllowAny] 
+    etag_fields = ('updated_at', 'user__updated_at')
 
-class ReminderListCreateView(generics.ListCreateAPIView):
+class ReminderListCreateView(EagerLoadingViewMixin, generics.ListCreateAPIView):
     queryset = Reminder.objects.all()
     serializer_class = ReminderSerializer
     permission_classes = [AllowAny] 
+    filter_fields = {'user': 'user_id'}
+    range_filter_fields = ['transmission_time']
+    cursor_ordering = ('-transmission_time', '-id')
 
-class ReminderDetailView(generics.RetrieveUpdateDestroyAPIView):
+class ReminderDetailView(EagerLoadingViewMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Reminder.objects.all()
     serializer_class = ReminderSerializer
     permission_classes = [AllowAny] 
 
-class LocationListCreateView(generics.ListCreateAPIView):
+class LocationListCreateView(EagerLoadingViewMixin, generics.ListCreateAPIView):
     queryset = Location.objects.all()
     serializer_class = LocationSerializer
     permission_classes = [AllowAny] 
+    filter_fields = {'patient': 'patient_id'}
+    range_filter_fields = ['time_coordinates']
+    cursor_ordering = ('-time_coordinates', '-id')
+
+    def perform_create(self, serializer):
+        location, = record_locations([Location(**serializer.validated_data)])
+        serializer.instance = location
+
+    def _float_param(self, name, low, high):
+        value = self.request.query_params.get(name)
+        if value is None:
+            return None
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValidationError({name: "Must be a number."})
+        if not low <= value <= high:
+            raise ValidationError({name: f"Must be between {low} and {high}."})
+        return value
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+
+        # Bounding box: ?min_lat=&max_lat=&min_lng=&max_lng=
+        bbox = [
+            self._float_param('min_lat', -90, 90), self._float_param('max_lat', -90, 90),
+            self._float_param('min_lng', -180, 180), self._float_param('max_lng', -180, 180),
+        ]
+        if any(v is not None for v in bbox):
+            if any(v is None for v in bbox):
+                raise ValidationError({"bbox": "min_lat, max_lat, min_lng and max_lng are all required."})
+            queryset = queryset.filter(
+                latitude__range=(bbox[0], bbox[1]),
+                longitude__range=(bbox[2], bbox[3]),
+            )
+
+        # Radius: ?lat=&lng=&radius=<metres>
+        lat = self._float_param('lat', -90, 90)
+        lng = self._float_param('lng', -180, 180)
+        radius = self._float_param('radius', 0, 1_000_000)
+        if any(v is not None for v in (lat, lng, radius)):
+            if any(v is None for v in (lat, lng, radius)):
+                raise ValidationError({"radius": "lat, lng and radius are all required."})
+            min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius)
+            # The box narrows the scan through the index; the equirectangular
+            # distance (plain arithmetic, no PostGIS or SQL trig needed) trims the corners.
+            lat_scale = math.radians(1) * EARTH_RADIUS_M
+            lng_scale = lat_scale * math.cos(math.radians(lat))
+            queryset = queryset.filter(
+                latitude__range=(min_lat, max_lat),
+                longitude__range=(min_lng, max_lng),
+            ).alias(
+                dy=(F('latitude') - lat) * lat_scale,
+                dx=(F('longitude') - lng) * lng_scale,
+            ).alias(
+                distance_sq=F('dx') * F('dx') + F('dy') * F('dy'),
+            ).filter(distance_sq__lte=radius * radius)
+
+        return queryset
+
+class LocationBulkCreateView(APIView):
+    permission_classes = [AllowAny]
+    parser_classes = [JSONParser, NDJSONParser]
+
+    def post(self, request):
+        items = request.data
+        default_patient = request.query_params.get('patient')
+        # Accept either a bare list/NDJSON stream or {"patient": id, "locations": [...]}
+        if isinstance(items, dict):
+            default_patient = items.get('patient', default_patient)
+            items = items.get('locations')
+
+        if not isinstance(items, list) or not items:
+            return Response({"error": "Expected a non-empty list of locations"}, status=status.HTTP_400_BAD_REQUEST)
+
+        max_items = settings.LOCATION_BULK_MAX_ITEMS
+        if len(items) > max_items:
+            return Response({"error": f"A batch may contain at most {max_items} locations"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(items)
+        pending = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                results[index] = {"index": index, "errors": {"non_field_errors": ["Expected an object"]}}
+                continue
+            if default_patient is not None and 'patient' not in item:
+                item = {**item, 'patient': default_patient}
+            serializer = LocationIngestSerializer(data=item)
+            if serializer.is_valid():
+                pending.append((index, serializer.validated_data))
+            else:
+                results[index] = {"index": index, "errors": serializer.errors}
+
+        # One query to check every referenced patient instead of one per fix
+        patient_ids = {data['patient_id'] for _, data in pending}
+        existing = set(Patient.objects.filter(pk__in=patient_ids).values_list('pk', flat=True))
+
+        valid = []
+        for index, data in pending:
+            if data['patient_id'] in existing:
+                valid.append((index, Location(**data)))
+            else:
+                results[index] = {"index": index, "errors": {"patient": ["Patient not found."]}}
+
+        if valid:
+            created = record_locations([location for _, location in valid])
+            for (index, _), location in zip(valid, created):
+                results[index] = {"index": index, "id": location.pk}
+
+        created_count = len(valid)
+        failed_count = len(items) - created_count
+        if not created_count:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif failed_count:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_201_CREATED
 
-class LocationDetailView(generics.RetrieveUpdateDestroyAPIView):
+        return Response({
+            "created": created_count,
+            "failed": failed_count,
+            "results": results
+        }, status=response_status)
+
+class TimeRangeMixin:
+    def _datetime_param(self, name, default):
+        value = self.request.query_params.get(name)
+        if value is None:
+            return default
+        parsed = parse_datetime(value)
+        if parsed is None:
+            raise ValidationError({name: "Must be an ISO 8601 datetime."})
+        if timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
+
+    def _float_param(self, name, default, low, high):
+        value = self.request.query_params.get(name)
+        if value is None:
+            return default
+        try:
+            parsed = float(value)
+        except ValueError:
+            raise ValidationError({name: "Must be a number."})
+        if not low <= parsed <= high:
+            raise ValidationError({name: f"Must be between {low} and {high}."})
+        return parsed
+
+    def time_range(self, request):
+        """``(patient_id, start, end)`` from the query string; raises ValidationError."""
+        try:
+            patient_id = int(request.query_params['patient'])
+        except (KeyError, ValueError):
+            raise ValidationError({"error": "patient id is required"})
+
+        end = self._datetime_param('end', timezone.now())
+        start = self._datetime_param('start', end - timedelta(days=1))
+        if start >= end:
+            raise ValidationError({"error": "start must be before end"})
+        return patient_id, start, end
+
+class LocationHistoryView(TimeRangeMixin, APIView):
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        patient_id, start, end = self.time_range(request)
+        resolution, points = location_history(patient_id, start, end)
+        return Response({
+            "patient": patient_id,
+            "start": start,
+            "end": end,
+            "resolution": resolution,
+            "points": points
+        })
+
+class LocationRouteView(TimeRangeMixin, APIView):
+    """Distance, dwells and a simplified polyline for a patient's time window (``Users/routes.py``)."""
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        patient_id, start, end = self.time_range(request)
+        if end - start > settings.ROUTE_MAX_SPAN:
+            return Response({"error": f"The range may span at most {settings.ROUTE_MAX_SPAN.days} days"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        tolerance = self._float_param('tolerance', settings.ROUTE_SIMPLIFY_TOLERANCE_M, 0, 1000)
+        dwell_radius = self._float_param('dwell_radius', settings.ROUTE_DWELL_RADIUS_M, 1, 1000)
+        dwell_minutes = self._float_param('dwell_minutes', settings.ROUTE_DWELL_MINUTES, 1, 24 * 60)
+        route = build_route(patient_id, start, end, tolerance, dwell_radius, dwell_minutes)
+        return Response({
+            "patient": patient_id,
+            "start": start,
+            "end": end,
+            "tolerance_m": tolerance,
+            **route
+        })
+
+class PatientExportView(TimeRangeMixin, APIView):
+    """
+    Streams one kind of a patient's history (``Users/exports.py``):
+    ``?output=csv|ndjson&gzip=1&start=&end=``. ``format`` is taken by DRF's
+    renderer negotiation, hence ``output``. Only the patient and their
+    linked companions may export it, as with ``LastKnownPositionView``.
+    """
+
+    def get(self, request, pk, kind):
+        if request.user.patient_id != pk:
+            return Response({"error": "You can only export the history of your own patient"},
+                            status=status.HTTP_403_FORBIDDEN)
+        if kind not in exports.KINDS:
+            return Response({"error": f"Unknown export, expected one of {', '.join(exports.KINDS)}"},
+                            status=status.HTTP_404_NOT_FOUND)
+        output = request.query_params.get('output', 'csv')
+        if output not in exports.FORMATS:
+            raise ValidationError({"output": f"Must be one of {', '.join(exports.FORMATS)}."})
+        compress = request.query_params.get('gzip') in ('1', 'true')
+        start = self._datetime_param('start', None)
+        end = self._datetime_param('end', None)
+        patient = get_object_or_404(Patient.objects.only('id', 'user_id'), pk=pk)
+
+        response = StreamingHttpResponse(
+            exports.stream(kind, patient, output, compress, start, end),
+            content_type='application/gzip' if compress else exports.FORMATS[output],
+        )
+        response['Content-Disposition'] = f'attachment; filename="{exports.filename(kind, patient, output, compress)}"'
+        patch_cache_control(response, private=True, no_store=True)
+        return response
+
+class LastKnownPositionView(APIView):
+    """The newest fix of the caller's patient (own or linked), read by primary key."""
+
+    def get(self, request):
+        patient_id = request.user.patient_id
+        position = LastKnownPosition.objects.filter(pk=patient_id).first() if patient_id is not None else None
+        if position is None:
+            return Response({"error": "No position recorded yet"}, status=status.HTTP_404_NOT_FOUND)
+        response = Response(LastKnownPositionSerializer(position).data)
+        # The age changes every second, so clients must not reuse a stored copy
+        patch_cache_control(response, private=True, no_store=True)
+        return response
+
+class LocationDetailView(EagerLoadingViewMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Location.objects.all()
     serializer_class = LocationSerializer
     permission_classes = [AllowAny] 
 
-class TaskListCreateView(generics.ListCreateAPIView):
+    # Edits bypass record_locations, so keep LastKnownPosition on a fix that still exists
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            holders = last_position_holders(serializer.instance.pk)
+            location = serializer.save()
+            recompute_last_positions(holders)
+            update_last_positions([location])
+
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            holders = last_position_holders(instance.pk)
+            instance.delete()
+            recompute_last_positions(holders)
+
+class TaskListCreateView(ConditionalGetMixin, EagerLoadingViewMixin, generics.ListCreateAPIView):
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
     permission_classes = [AllowAny] 
+    filter_fields = {'patient': 'patient_id', 'companion': 'companion_id', 'is_sent': 'is_sent'}
+    range_filter_fields = ['reminder_time']
+    cursor_ordering = ('-reminder_time', '-id')
 
-class TaskDetailView(generics.RetrieveUpdateDestroyAPIView):
+class TaskDetailView(ConditionalGetMixin, EagerLoadingViewMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Task.objects.all()
     serializer_class = TaskSerializer
     permission_classes = [AllowAny] 
 
-class NotificationListCreateView(generics.ListCreateAPIView):
+class GeofenceListCreateView(ConditionalGetMixin, EagerLoadingViewMixin, generics.ListCreateAPIView):
+    queryset = Geofence.objects.all()
+    serializer_class = GeofenceSerializer
+    permission_classes = [AllowAny] 
+    filter_fields = {'patient': 'patient_id', 'is_active': 'is_active'}
+    cursor_ordering = ('-id',)
+
+class GeofenceDetailView(ConditionalGetMixin, EagerLoadingViewMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = Geofence.objects.all()
+    serializer_class = GeofenceSerializer
+    permission_classes = [AllowAny] 
+
+class NotificationListCreateView(ConditionalGetMixin, EagerLoadingViewMixin, generics.ListCreateAPIView):
     queryset = Notification.objects.all()
     serializer_class = NotificationSerializer
     permission_classes = [AllowAny] 
+    filter_fields = {'user': 'user_id', 'notification_type': 'notification_type', 'is_read': 'is_read'}
+    range_filter_fields = ['transmission_time']
+    cursor_ordering = ('-transmission_time', '-id')
 
-class NotificationDetailView(generics.RetrieveUpdateDestroyAPIView):
+class NotificationDetailView(ConditionalGetMixin, EagerLoadingViewMixin, generics.RetrieveUpdateDestroyAPIView):
     queryset = Notification.objects.all()
     serializer_class = NotificationSerializer
     permission_classes = [AllowAny] 
 
+    def perform_destroy(self, instance):
+        inbox.discard(Notification.objects.filter(pk=instance.pk))
+
+class NotificationInboxView(APIView):
+    """The caller's notifications newer than ``since`` (an id), oldest first."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = int(request.query_params.get('limit', settings.NOTIFICATION_SYNC_PAGE_SIZE))
+        except ValueError:
+            return Response({"error": "since and limit must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+
+        notifications, has_more = inbox.sync(request.user.id, since, max(limit, 1))
+        return Response({
+            "results": InboxNotificationSerializer(notifications, many=True).data,
+            "since": notifications[-1].id if notifications else since,
+            "has_more": has_more,
+            "unread_count": inbox.unread_count(request.user.id)
+        })
+
+class NotificationReadView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = NotificationReadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        marked = inbox.mark_read(request.user.id, **serializer.validated_data)
+        return Response({"marked": marked, "unread_count": inbox.unread_count(request.user.id)})
+
+class NotificationUnreadCountView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        return Response({"unread_count": inbox.unread_count(request.user.id)})
+
 class UserRegistrationView(generics.CreateAPIView):
     serializer_class = UserSerializer
     permission_classes = [AllowAny]  # Allow unauthenticated access
+    throttle_classes = [RegistrationThrottle]
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -191,6 +621,39 @@ class UserRegistrationView(generics.CreateAPIView):
             "errors": serializer.errors
         }, status=status.HTTP_400_BAD_REQUEST)
 
+class BulkProvisionView(APIView):
+    """
+    Creates the accounts of a JSON list or CSV body in one transaction
+    (``Users/provisioning.py``); ``?dry_run=1`` only returns the validation
+    report. Staff only: it bypasses the registration throttle. Passwords are
+    hashed in the request's own process (no pool is forked from a web
+    worker), hence the ``PROVISION_API_MAX_ROWS`` cap.
+    """
+    authentication_classes = [RevocableJWTAuthentication]
+    permission_classes = [IsAdminUser]
+    parser_classes = [JSONParser, CSVParser]
+
+    def post(self, request):
+        rows = request.data
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            return Response({"error": "Expected a list of accounts"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > settings.PROVISION_API_MAX_ROWS:
+            return Response({"error": f"At most {settings.PROVISION_API_MAX_ROWS} accounts per request, "
+                                      "use the provision_accounts command for more"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        dry_run = request.query_params.get('dry_run') in ('1', 'true')
+        try:
+            report = provisioning.provision(rows, dry_run=dry_run, workers=1)
+        except provisioning.ProvisioningError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_409_CONFLICT)
+        if report['invalid']:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif dry_run:
+            response_status = status.HTTP_200_OK
+        else:
+            response_status = status.HTTP_201_CREATED
+        return Response(report, status=response_status)
+
 class UserLogoutView(APIView):
     permission_classes = [AllowAny]
 
@@ -198,30 +661,32 @@ class UserLogoutView(APIView):
         try:
             refresh_token = request.data["refresh"]
             token = RefreshToken(refresh_token)
-            token.blacklist()
+            # Denies the session's refresh and access tokens (see authentication.py)
+            revoke_session(token)
             return Response({"message": "Logged out successfully"}, status=status.HTTP_205_RESET_CONTENT)
         except Exception:
             return Response({"error": "Invalid token"}, status=status.HTTP_400_BAD_REQUEST)
 
-class ProfileUpdateView(generics.UpdateAPIView):
+class ProfileUpdateView(ConditionalGetMixin, generics.RetrieveUpdateAPIView):
     serializer_class = ProfileSerializer
+    authentication_classes = [RevocableJWTAuthentication]
     permission_classes = [IsAuthenticated]
     parser_classes = [MultiPartParser, FormParser, JSONParser]
 
     def get_object(self):
         return self.request.user
 
+    def detail_validators(self):
+        # The user row is already loaded by the authenticator
+        return self.make_validators((self.request.user.updated_at,), self.request.user.pk)
+
     def update(self, request, *args, **kwargs):
         instance = self.get_object()
         
-        # Handle file upload
+        # Handle file upload; the old file and its variants are removed by the photo worker
         if 'profile_photo' in request.FILES:
-            # Delete old photo if exists
-            if instance.profile_photo:
-                instance.profile_photo.delete()
-            # Save new photo
             instance.profile_photo = request.FILES['profile_photo']
-            instance.save()
+            instance.save(update_fields=['profile_photo', 'profile_photo_variants', 'updated_at'])
 
         # Handle other fields
         data = request.data.copy()
@@ -234,35 +699,42 @@ class ProfileUpdateView(generics.UpdateAPIView):
 
         if instance.account_type == 'companions':
             companion = instance.companions
+            changed = []
             if 'relationship' in request.data:
                 companion.relationship = request.data['relationship']
+                changed.append('relationship')
             if 'patient_username' in request.data:
                 try:
-                    patient = Patient.objects.get(user__username=request.data['patient_username'])
-                    companion.patient = patient
+                    companion.patient_id = Patient.objects.values_list('id', flat=True).get(
+                        user__username=request.data['patient_username']
+                    )
                 except Patient.DoesNotExist:
                     return Response({"error": "Patient not found"}, status=status.HTTP_404_NOT_FOUND)
-            companion.save()
+                changed.append('patient')
+            if changed:
+                companion.save(update_fields=changed + ['updated_at'])
 
         elif instance.account_type == 'patients':
             patient = instance.patients
             if 'companion_username' in request.data:
                 try:
                     companion = Companion.objects.get(user__username=request.data['companion_username'])
-                    old_companion = patient.companions.first()
-                    if old_companion and old_companion != companion:
+                    linked = companions_of_patient(instance.pk)
+                    if linked and linked[0]['companion_id'] != companion.pk:
+                        old_companion = Companion.objects.get(pk=linked[0]['companion_id'])
                         old_companion.patient = None
-                        old_companion.save()
-                    companion.patient = patient
-                    companion.save()
+                        old_companion.save(update_fields=['patient', 'updated_at'])
+                    if companion.patient_id != patient.pk:
+                        companion.patient = patient
+                        companion.save(update_fields=['patient', 'updated_at'])
                 except Companion.DoesNotExist:
                     return Response({"error": "Companion not found"}, status=status.HTTP_404_NOT_FOUND)
-            patient.save()
 
         return Response(self.get_serializer(instance).data)
 
 class CompanionProfileUpdateView(generics.UpdateAPIView):
     serializer_class = CompanionProfileSerializer
+    authentication_classes = [RevocableJWTAuthentication]
     permission_classes = [AllowAny]
     parser_classes = [MultiPartParser, FormParser]
 
@@ -278,6 +750,7 @@ class CompanionProfileUpdateView(generics.UpdateAPIView):
 
 class PatientProfileUpdateView(generics.UpdateAPIView):
     serializer_class = PatientProfileSerializer
+    authentication_classes = [RevocableJWTAuthentication]
     permission_classes = [IsAuthenticated]
     parser_classes = [MultiPartParser, FormParser]
 
@@ -293,9 +766,11 @@ class PatientProfileUpdateView(generics.UpdateAPIView):
 
 class CustomTokenObtainPairView(TokenObtainPairView):
     serializer_class = CustomTokenObtainPairSerializer
+    throttle_classes = [LoginThrottle]
 
 class SOSView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_classes = []  # never rate limited, see Users/throttling.py
 
     def post(self, request):
         user = request.user
@@ -310,58 +785,26 @@ class SOSView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        if user.account_type not in ('companions', 'patients'):
+            return Response({
+                "success": False,
+                "message": "نوع الحساب غير معروف"
+            }, status=status.HTTP_400_BAD_REQUEST)
+
         try:
-            if user.account_type == 'companions':
-                companion = user.companions
-                companion.sos_alert = is_active
-                if is_active:
-                    companion.last_sos_time = timezone.now()
-                    # إرسال إشعار للمريض
-                    if companion.patient:
-                        Notification.objects.create(
-                            user=companion.patient.user,
-                            transmission_time=timezone.now(),
-                            notification_type='security',
-                            message=f"تنبيه SOS من {companion.user.name}"
-                        )
-                companion.save()
-
-                if is_active and not companion.patient:
-                    return Response({
-                        "success": False,
-                        "message": "لا يوجد مريض مرتبط بك"
-                    }, status=status.HTTP_400_BAD_REQUEST)
-
-            elif user.account_type == 'patients':
-                patient = user.patients
-                patient.sos_alert = is_active
-                if is_active:
-                    patient.last_sos_time = timezone.now()
-                    # إرسال إشعار لجميع المرافقين
-                    for companion in patient.companions.all():
-                        Notification.objects.create(
-                            user=companion.user,
-                            transmission_time=timezone.now(),
-                            notification_type='security',
-                            message=f"تنبيه SOS من {patient.user.name}"
-                        )
-                patient.save()
-
-                if is_active and not patient.companions.exists():
-                    return Response({
-                        "success": False,
-                        "message": "لا يوجد مرافقون مرتبطون بك"
-                    }, status=status.HTTP_400_BAD_REQUEST)
+            # request.user is a ClaimsUser: ids and name come from the token, not the DB
+            outcome = dispatch_sos(user, is_active)
 
-            else:
+            if outcome == NO_RECIPIENTS:
                 return Response({
                     "success": False,
-                    "message": "نوع الحساب غير معروف"
+                    "message": "لا يوجد مريض مرتبط بك" if user.account_type == 'companions' else "لا يوجد مرافقون مرتبطون بك"
                 }, status=status.HTTP_400_BAD_REQUEST)
 
             return Response({
                 "success": True,
-                "message": "تم تفعيل التنبيه بنجاح" if is_active else "تم إيقاف التنبيه بنجاح"
+                "message": "تم تفعيل التنبيه بنجاح" if is_active else "تم إيقاف التنبيه بنجاح",
+                "duplicate": outcome == DUPLICATE
             }, status=status.HTTP_200_OK)
 
         except Exception as e: